@@ -25,7 +25,7 @@ cimport libc.string
 from .stream cimport InputStream, OutputStream
 
 
-cdef object loads, dumps, create_InputStream, create_OutputStream
+cdef object loads, dumps, itemgetter, create_InputStream, create_OutputStream
 
 
 cdef class CoderImpl(object):
@@ -33,6 +33,7 @@ cdef class CoderImpl(object):
   cpdef decode_from_stream(self, InputStream stream, bint nested)
   cpdef bytes encode(self, value)
   cpdef decode(self, bytes encoded)
+  cpdef decode_range(self, bytes buffer, size_t start, size_t end)
 
 
 cdef class SimpleCoderImpl(CoderImpl):
@@ -52,12 +53,61 @@ cdef class BytesCoderImpl(CoderImpl):
   pass
 
 
+cdef class StrUtf8CoderImpl(CoderImpl):
+  pass
+
+
+cdef class FloatCoderImpl(StreamCoderImpl):
+  pass
+
+
 cdef list small_ints
 cdef class VarIntCoderImpl(StreamCoderImpl):
   @cython.locals(ivalue=libc.stdint.int64_t)
   cpdef bytes encode(self, value)
 
 
+cdef class SequenceCoderImpl(StreamCoderImpl):
+  cdef CoderImpl _elem_coder
+
+
+cdef class SetCoderImpl(StreamCoderImpl):
+  cdef CoderImpl _elem_coder
+
+  @cython.locals(elem_out=OutputStream)
+  cpdef encode_to_stream(self, value, OutputStream stream, bint nested)
+
+
+cdef class MapCoderImpl(StreamCoderImpl):
+  cdef CoderImpl _key_coder
+  cdef CoderImpl _value_coder
+
+  @cython.locals(key_out=OutputStream)
+  cpdef encode_to_stream(self, value, OutputStream stream, bint nested)
+
+
+cdef class UnionCoderImpl(StreamCoderImpl):
+  cdef tuple _types
+  cdef tuple _coder_impls
+  cdef dict _type_index
+
+  cdef int _get_index(self, value) except -1
+  @cython.locals(c=CoderImpl)
+  cpdef decode_from_stream(self, InputStream stream, bint nested)
+
+
+cdef class SingletonCoderImpl(CoderImpl):
+  cdef object _value
+
+
+cdef class GlobalWindowCoderImpl(SingletonCoderImpl):
+  pass
+
+
+cdef class IntervalWindowCoderImpl(StreamCoderImpl):
+  cdef object _window_type
+
+
 cdef class AbstractComponentCoderImpl(StreamCoderImpl):
   cdef tuple _coder_impls
 
@@ -21,6 +21,7 @@ encode many elements with minimial overhead.
 
 import collections
 from cPickle import loads, dumps
+from operator import itemgetter
 
 
 # pylint: disable=g-import-not-at-top
@@ -58,6 +59,20 @@ class CoderImpl(object):
     """Encodes an object to an unnested string."""
     raise NotImplementedError
 
+  def decode_range(self, buffer, start, end):
+    """Decodes the unnested encoding stored in buffer[start:end].
+
+    Unlike decode(buffer[start:end]), this does not copy the encoding out of
+    the buffer first.
+    """
+    return self.decode_from_stream(
+        create_InputStream(buffer, start, end), False)
+
+  def iter_decode_each(self, encoded_values):
+    """Lazily decodes each string of an iterable of unnested encodings."""
+    for encoded in encoded_values:
+      yield self.decode(encoded)
+
 
 class SimpleCoderImpl(CoderImpl):
   """Subclass of CoderImpl implementing stream methods using encode/decode."""
@@ -124,6 +139,35 @@ class BytesCoderImpl(CoderImpl):
     return encoded
 
 
+class StrUtf8CoderImpl(CoderImpl):
+  """A coder for unicode objects, encoded as UTF-8."""
+
+  def encode_to_stream(self, value, out, nested):
+    if isinstance(value, unicode):
+      out.write_utf8(value, nested)
+    else:
+      out.write(value.encode('utf-8'), nested)
+
+  def decode_from_stream(self, in_stream, nested):
+    return in_stream.read_utf8(nested)
+
+  def encode(self, value):
+    return value.encode('utf-8')
+
+  def decode(self, encoded):
+    return encoded.decode('utf-8')
+
+
+class FloatCoderImpl(StreamCoderImpl):
+  """A coder for float objects, encoded as 8 little-endian bytes."""
+
+  def encode_to_stream(self, value, out, nested):
+    out.write_double(value)
+
+  def decode_from_stream(self, in_stream, nested):
+    return in_stream.read_double()
+
+
 small_ints = [chr(_) for _ in range(128)]
 
 
@@ -151,6 +195,173 @@ class VarIntCoderImpl(StreamCoderImpl):
     return StreamCoderImpl.decode(self, encoded)
 
 
+class SequenceCoderImpl(StreamCoderImpl):
+  """A coder for sequences of elements, decoded as lists.
+
+  The encoding is the number of elements followed by the nested encoding of
+  each element.
+  """
+
+  def __init__(self, elem_coder):
+    self._elem_coder = elem_coder
+
+  def encode_to_stream(self, value, out, nested):
+    out.write_var_int64(len(value))
+    for elem in value:
+      self._elem_coder.encode_to_stream(elem, out, True)
+
+  def decode_from_stream(self, in_stream, nested):
+    size = in_stream.read_var_int64()
+    return [self._elem_coder.decode_from_stream(in_stream, True)
+            for _ in range(size)]
+
+
+class SetCoderImpl(StreamCoderImpl):
+  """A coder for sets of elements.
+
+  The encoding is the number of elements followed by the nested encodings of
+  the elements in sorted order, so that it does not depend on the iteration
+  order of the set.
+  """
+
+  def __init__(self, elem_coder):
+    self._elem_coder = elem_coder
+
+  def encode_to_stream(self, value, out, nested):
+    elem_out = create_OutputStream()
+    encoded_elems = []
+    for elem in value:
+      self._elem_coder.encode_to_stream(elem, elem_out, True)
+      encoded_elems.append(elem_out.get())
+      elem_out.clear()
+    encoded_elems.sort()
+    out.write_var_int64(len(encoded_elems))
+    for encoded in encoded_elems:
+      out.write(encoded)
+
+  def decode_from_stream(self, in_stream, nested):
+    size = in_stream.read_var_int64()
+    return set([self._elem_coder.decode_from_stream(in_stream, True)
+                for _ in range(size)])
+
+
+class MapCoderImpl(StreamCoderImpl):
+  """A coder for dictionaries.
+
+  The encoding is the number of entries followed by the nested encodings of
+  each key and value, with entries sorted by the encoding of their keys.
+  """
+
+  def __init__(self, key_coder, value_coder):
+    self._key_coder = key_coder
+    self._value_coder = value_coder
+
+  def encode_to_stream(self, value, out, nested):
+    key_out = create_OutputStream()
+    encoded_entries = []
+    for k, v in value.iteritems():
+      self._key_coder.encode_to_stream(k, key_out, True)
+      encoded_entries.append((key_out.get(), v))
+      key_out.clear()
+    encoded_entries.sort(key=itemgetter(0))
+    out.write_var_int64(len(encoded_entries))
+    for encoded_key, v in encoded_entries:
+      out.write(encoded_key)
+      self._value_coder.encode_to_stream(v, out, True)
+
+  def decode_from_stream(self, in_stream, nested):
+    size = in_stream.read_var_int64()
+    result = {}
+    for _ in range(size):
+      k = self._key_coder.decode_from_stream(in_stream, True)
+      result[k] = self._value_coder.decode_from_stream(in_stream, True)
+    return result
+
+
+class UnionCoderImpl(StreamCoderImpl):
+  """A coder for values of one of several types.
+
+  The encoding is the index of the value's type as a single byte followed by
+  the value encoded with the coder for that type.
+  """
+
+  def __init__(self, types, coder_impls):
+    assert len(types) == len(coder_impls) <= 256
+    # An int or long type matches both ints and longs.
+    self._types = tuple((int, long) if t in (int, long) else t for t in types)
+    self._coder_impls = tuple(coder_impls)
+    self._type_index = {}
+
+  def _get_index(self, value):
+    value_type = type(value)
+    index = self._type_index.get(value_type)
+    if index is None:
+      for i, t in enumerate(self._types):
+        # Bools are ints, but the coder of an int alternative would decode
+        # them as ints, so they only match a bool alternative.
+        if isinstance(value, t) and (value_type is not bool or t is bool):
+          index = self._type_index[value_type] = i
+          break
+      else:
+        raise TypeError('Cannot encode %r as any of %r.' % (value, self._types))
+    return index
+
+  def encode_to_stream(self, value, out, nested):
+    index = self._get_index(value)
+    out.write_byte(index)
+    self._coder_impls[index].encode_to_stream(value, out, nested)
+
+  def decode_from_stream(self, in_stream, nested):
+    c = self._coder_impls[in_stream.read_byte()]
+    return c.decode_from_stream(in_stream, nested)
+
+
+class SingletonCoderImpl(CoderImpl):
+  """A coder for a single constant value, which is encoded as zero bytes."""
+
+  def __init__(self, value):
+    self._value = value
+
+  def encode_to_stream(self, value, out, nested):
+    pass
+
+  def decode_from_stream(self, in_stream, nested):
+    return self._value
+
+  def encode(self, value):
+    return b''
+
+  def decode(self, encoded):
+    return self._value
+
+
+class GlobalWindowCoderImpl(SingletonCoderImpl):
+  """A coder for the global window, which is encoded as zero bytes."""
+
+  def __init__(self):
+    # Window classes are resolved here rather than at module import time since
+    # coders are imported while the transforms package is being initialized.
+    from google.cloud.dataflow.transforms import window
+    super(GlobalWindowCoderImpl, self).__init__(window.GlobalWindow())
+
+
+class IntervalWindowCoderImpl(StreamCoderImpl):
+  """A coder for interval windows, encoded as their start and end."""
+
+  def __init__(self):
+    # See GlobalWindowCoderImpl.__init__.
+    from google.cloud.dataflow.transforms import window
+    self._window_type = window.IntervalWindow
+
+  def encode_to_stream(self, value, out, nested):
+    out.write_double(value.start)
+    out.write_double(value.end)
+
+  def decode_from_stream(self, in_stream, nested):
+    start = in_stream.read_double()
+    return self._window_type(start, in_stream.read_double())
+
+
 class AbstractComponentCoderImpl(StreamCoderImpl):
 
   def __init__(self, coder_impls):
@@ -16,7 +16,6 @@
 
 import base64
 import cPickle as pickle
-import struct
 
 from google.cloud.dataflow.coders import coder_impl
 
@@ -72,6 +71,10 @@ class Coder(object):
     """
     return False
 
+  def estimate_size(self, value):
+    """Estimates the encoded size of the given value, in bytes."""
+    return len(self.encode(value))
+
   # ===========================================================================
   # Methods below are internal SDK details that don't need to be modified for
   # user-defined coders.
@@ -151,19 +154,6 @@ class Coder(object):
     # pylint: enable=protected-access
 
 
-class StrUtf8Coder(Coder):
-  """A coder used for reading and writing strings as UTF-8."""
-
-  def encode(self, value):
-    return value.encode('utf-8')
-
-  def decode(self, value):
-    return value.decode('utf-8')
-
-  def is_deterministic(self):
-    return True
-
-
 class ToStringCoder(Coder):
   """A default string coder used if no sink coder is specified."""
 
@@ -202,6 +192,16 @@ class FastCoder(Coder):
     raise NotImplementedError
 
 
+class StrUtf8Coder(FastCoder):
+  """A coder used for reading and writing strings as UTF-8."""
+
+  def _create_impl(self):
+    return coder_impl.StrUtf8CoderImpl()
+
+  def is_deterministic(self):
+    return True
+
+
 class BytesCoder(FastCoder):
   """Byte string coder."""
 
@@ -222,15 +222,11 @@ class VarIntCoder(FastCoder):
     return True
 
 
-# TODO(ccy): Write a Cython implementation of FloatCoder.
-class FloatCoder(Coder):
+class FloatCoder(FastCoder):
   """A coder used for floating-point values."""
 
-  def encode(self, value):
-    return struct.pack('<d', value)
-
-  def decode(self, encoded):
-    return struct.unpack('<d', encoded)[0]
+  def _create_impl(self):
+    return coder_impl.FloatCoderImpl()
 
   def is_deterministic(self):
     return True
@@ -371,6 +367,137 @@ class TupleCoder(FastCoder):
     return 'TupleCoder[%s]' % ', '.join(str(c) for c in self._coders)
 
 
+class ListCoder(FastCoder):
+  """Coder of lists of elements that are all encoded with the same coder."""
+
+  def __init__(self, elem_coder):
+    self._elem_coder = elem_coder
+
+  def _create_impl(self):
+    return coder_impl.SequenceCoderImpl(self._elem_coder.get_impl())
+
+  def is_deterministic(self):
+    return self._elem_coder.is_deterministic()
+
+  @staticmethod
+  def from_type_hint(typehint, registry):
+    return ListCoder(registry.get_coder(typehint.inner_type))
+
+  def _get_component_coders(self):
+    return [self._elem_coder]
+
+  def __repr__(self):
+    return 'ListCoder[%s]' % self._elem_coder
+
+
+class SetCoder(FastCoder):
+  """Coder of sets, encoded in an order independent of iteration order."""
+
+  def __init__(self, elem_coder):
+    self._elem_coder = elem_coder
+
+  def _create_impl(self):
+    return coder_impl.SetCoderImpl(self._elem_coder.get_impl())
+
+  def is_deterministic(self):
+    return self._elem_coder.is_deterministic()
+
+  @staticmethod
+  def from_type_hint(typehint, registry):
+    return SetCoder(registry.get_coder(typehint.inner_type))
+
+  def _get_component_coders(self):
+    return [self._elem_coder]
+
+  def __repr__(self):
+    return 'SetCoder[%s]' % self._elem_coder
+
+
+class DictCoder(FastCoder):
+  """Coder of dictionaries, encoded with entries sorted by encoded key."""
+
+  def __init__(self, key_coder, value_coder):
+    self._key_coder = key_coder
+    self._value_coder = value_coder
+
+  def _create_impl(self):
+    return coder_impl.MapCoderImpl(
+        self._key_coder.get_impl(), self._value_coder.get_impl())
+
+  def is_deterministic(self):
+    return (self._key_coder.is_deterministic()
+            and self._value_coder.is_deterministic())
+
+  @staticmethod
+  def from_type_hint(typehint, registry):
+    return DictCoder(registry.get_coder(typehint.key_type),
+                     registry.get_coder(typehint.value_type))
+
+  def _get_component_coders(self):
+    return [self._key_coder, self._value_coder]
+
+  def __repr__(self):
+    return 'DictCoder[%s, %s]' % (self._key_coder, self._value_coder)
+
+
+class NoneCoder(FastCoder):
+  """Coder of None, which is encoded as zero bytes."""
+
+  def _create_impl(self):
+    return coder_impl.SingletonCoderImpl(None)
+
+  def is_deterministic(self):
+    return True
+
+
+class UnionCoder(FastCoder):
+  """Coder of values of one of several Python types.
+
+  Values are encoded as the index of their type followed by their encoding
+  with the coder of that type.
+  """
+
+  def __init__(self, types, components):
+    self._types = tuple(types)
+    self._coders = tuple(components)
+
+  def _create_impl(self):
+    return coder_impl.UnionCoderImpl(
+        self._types, [c.get_impl() for c in self._coders])
+
+  def is_deterministic(self):
+    return all(c.is_deterministic() for c in self._coders)
+
+  @staticmethod
+  def from_type_hint(typehint, registry):
+    # pylint: disable=g-import-not-at-top
+    from google.cloud.dataflow.typehints import typehints
+    # pylint: enable=g-import-not-at-top
+    constraint_types = {
+        typehints.ListConstraint: list,
+        typehints.SetTypeConstraint: set,
+        typehints.DictConstraint: dict,
+        typehints.TupleConstraint: tuple,
+        typehints.TupleSequenceConstraint: tuple,
+    }
+    # Order the alternatives consistently so that equal type hints produce
+    # equal coders.
+    hints = sorted((type(None) if t is None else t
+                    for t in typehint.union_types), key=repr)
+    types = [constraint_types.get(type(t), t) for t in hints]
+    if (not all(isinstance(t, type) for t in types)
+        or len(set(types)) < len(types)):
+      # Values cannot be unambiguously dispatched on their Python type.
+      return PickleCoder()
+    return UnionCoder(types, [registry.get_coder(t) for t in hints])
+
+  def _get_component_coders(self):
+    return self._coders
+
+  def __repr__(self):
+    return 'UnionCoder[%s]' % ', '.join(str(c) for c in self._coders)
+
+
 class WindowCoder(PickleCoder):
   """Coder for windows in windowed values."""
 
@@ -387,6 +514,49 @@ class WindowCoder(PickleCoder):
     return super(WindowCoder, self).as_cloud_object(is_pair_like=False)
 
 
+class GlobalWindowCoder(FastCoder):
+  """Coder for the global window, which is encoded as zero bytes."""
+
+  def _create_impl(self):
+    return coder_impl.GlobalWindowCoderImpl()
+
+  def is_deterministic(self):
+    return True
+
+
+class IntervalWindowCoder(FastCoder):
+  """Coder for interval windows, encoded as two 8-byte timestamps."""
+
+  def _create_impl(self):
+    return coder_impl.IntervalWindowCoderImpl()
+
+  def is_deterministic(self):
+    return True
+
+
+class WindowListCoder(FastCoder):
+  """Coder for the windows of windowed values.
+
+  Windows are encoded as their count followed by each window encoded with
+  window_coder, and decoded as a list.
+  """
+
+  def __init__(self, window_coder):
+    self.window_coder = window_coder
+
+  def _create_impl(self):
+    return coder_impl.SequenceCoderImpl(self.window_coder.get_impl())
+
+  def is_deterministic(self):
+    return self.window_coder.is_deterministic()
+
+  def _get_component_coders(self):
+    return [self.window_coder]
+
+  def __repr__(self):
+    return 'WindowListCoder[%r]' % self.window_coder
+
+
 class WindowedValueCoder(FastCoder):
   """Coder for windowed values."""
 
@@ -20,6 +20,7 @@ import sys
 import unittest
 
 import coders
+from google.cloud.dataflow.transforms import window
 
 
 class CodersTest(unittest.TestCase):
@@ -37,7 +38,7 @@ class CodersTest(unittest.TestCase):
     standard = set(
         c for c in coders.__dict__.values()
         if isinstance(c, type) and issubclass(c, coders.Coder))
-    standard -= set([coders.Coder, coders.ToStringCoder, coders.FloatCoder,
+    standard -= set([coders.Coder, coders.ToStringCoder,
                      coders.Base64PickleCoder, coders.FastCoder,
                      coders.WindowCoder, coders.WindowedValueCoder])
     assert not standard - cls.seen, standard - cls.seen
@@ -57,8 +58,14 @@ class CodersTest(unittest.TestCase):
 
   def check_coder(self, coder, *values):
     self._observe(coder)
+    impl = coder.get_impl()
     for v in values:
-      self.assertEqual(v, coder.decode(coder.encode(v)))
+      encoded = coder.encode(v)
+      self.assertEqual(v, coder.decode(encoded))
+      self.assertEqual(
+          v, impl.decode_range('xx' + encoded + 'yyy', 2, 2 + len(encoded)))
+    encoded_values = [coder.encode(v) for v in values]
+    self.assertEqual(list(values), list(impl.iter_decode_each(encoded_values)))
 
   def test_custom_coder(self):
     class CustomCoder(coders.Coder):
@@ -109,12 +116,130 @@ class CodersTest(unittest.TestCase):
         ((1, 2), 'a'),
         ((-2, 5), u'a\u0101' * 100),
         ((300, 1), 'abc\0' * 5))
+    self.check_coder(
+        coders.TupleCoder(
+            (coders.FloatCoder(), coders.StrUtf8Coder(), coders.FloatCoder())),
+        (1.5, u'a\u0101', -2.25),
+        (float('inf'), u'', 0.0))
+
+  def test_list_coder(self):
+    coder = coders.ListCoder(coders.VarIntCoder())
+    self.assertTrue(coder.is_deterministic())
+    self.check_coder(coder, [], [1], [-1, 2, 300] * 50)
+    self.check_coder(
+        coders.TupleCoder((coders.BytesCoder(), coder)),
+        ('a', [1, 2]), ('', []))
+    self.assertFalse(
+        coders.ListCoder(coders.PickleCoder()).is_deterministic())
+
+  def test_set_coder(self):
+    coder = coders.SetCoder(coders.BytesCoder())
+    self.assertTrue(coder.is_deterministic())
+    self.check_coder(coder, set(), set(['a']), set(['a', 'bb', '', 'c' * 200]))
+    self.check_coder(
+        coders.TupleCoder((coder, coders.VarIntCoder())), (set(['a', 'b']), 1))
+    # Sets with different insertion histories encode identically.
+    values = [str(i) for i in range(100)]
+    self.assertEqual(coder.encode(set(values)),
+                     coder.encode(set(reversed(values))))
+
+  def test_dict_coder(self):
+    coder = coders.DictCoder(coders.StrUtf8Coder(), coders.VarIntCoder())
+    self.assertTrue(coder.is_deterministic())
+    self.check_coder(coder, {}, {u'a': 1}, {u'a': 1, u'\u0101': 2, u'': 3})
+    self.check_coder(
+        coders.TupleCoder((coder, coder)), ({u'x': 1}, {u'y': 2, u'z': 3}))
+    keys = [unicode(i) for i in range(100)]
+    self.assertEqual(coder.encode(dict((k, 0) for k in keys)),
+                     coder.encode(dict((k, 0) for k in reversed(keys))))
+    self.assertFalse(
+        coders.DictCoder(
+            coders.BytesCoder(), coders.PickleCoder()).is_deterministic())
+
+  def test_none_coder(self):
+    coder = coders.NoneCoder()
+    self.assertEqual('', coder.encode(None))
+    self.assertEqual(None, coder.decode(''))
+    self._observe(coder)
+    self.check_coder(coders.TupleCoder((coders.VarIntCoder(), coder)),
+                     (1, None))
+
+  def test_union_coder(self):
+    coder = coders.UnionCoder(
+        [int, str, type(None)],
+        [coders.VarIntCoder(), coders.BytesCoder(), coders.NoneCoder()])
+    self.assertTrue(coder.is_deterministic())
+    self.check_coder(coder, 1, 'a', None, -5, '')
+    self.check_coder(
+        coders.TupleCoder((coder, coder)), (1, None), (None, 'abc'))
+    with self.assertRaises(TypeError):
+      coder.encode(1.5)
+    # Both ints and longs are encoded as the int alternative.
+    self.check_coder(coder, 5L, 1 << 62, -(1 << 62))
+    self.assertEqual(coder.encode(5), coder.encode(5L))
+    long_coder = coders.UnionCoder(
+        [long, type(None)], [coders.VarIntCoder(), coders.NoneCoder()])
+    self.check_coder(long_coder, 5, 5L, None)
+    # Bools keep their type rather than matching the int alternative.
+    bool_coder = coders.UnionCoder(
+        [int, bool], [coders.VarIntCoder(), coders.PickleCoder()])
+    self.check_coder(bool_coder, 1, True, 0, False)
+    for value in (1, True, 0, False):
+      self.assertIs(
+          type(value), type(bool_coder.decode(bool_coder.encode(value))))
+    with self.assertRaises(TypeError):
+      coder.encode(True)
+
+  def test_global_window_coder(self):
+    coder = coders.GlobalWindowCoder()
+    value = window.GlobalWindow()
+    self.assertEqual('', coder.encode(value))
+    self.check_coder(coder, value)
+    self.check_coder(coders.TupleCoder((coders.VarIntCoder(), coder)),
+                     (1, value), (-2, value))
+
+  def test_interval_window_coder(self):
+    coder = coders.IntervalWindowCoder()
+    values = [window.IntervalWindow(start, end)
+              for start, end in [(0, 10), (-1.5, 2.25), (1e9, 1e9 + 60)]]
+    self.assertEqual(16, len(coder.encode(values[0])))
+    self.check_coder(coder, *values)
+    self.check_coder(coders.TupleCoder((coders.VarIntCoder(), coder)),
+                     *[(i, w) for i, w in enumerate(values)])
+
+  def test_window_list_coder(self):
+    coder = coders.WindowListCoder(coders.IntervalWindowCoder())
+    self.assertTrue(coder.is_deterministic())
+    self.check_coder(
+        coder,
+        [], [window.IntervalWindow(0, 10)],
+        [window.IntervalWindow(s, s + 10) for s in range(0, 100, 5)])
+    self.check_coder(
+        coders.TupleCoder(
+            (coders.WindowListCoder(coders.GlobalWindowCoder()),
+             coders.BytesCoder())),
+        ([window.GlobalWindow()], 'a'))
+    self.assertFalse(
+        coders.WindowListCoder(coders.PickleCoder()).is_deterministic())
+
+  def test_windowed_value_coder(self):
+    coder = coders.WindowedValueCoder(
+        coders.VarIntCoder(),
+        window_coder=coders.WindowListCoder(coders.IntervalWindowCoder()))
+    self.assertTrue(coder.is_deterministic())
+    value = window.WindowedValue(
+        5, 12.5, [window.IntervalWindow(10, 20), window.IntervalWindow(5, 15)])
+    decoded = coder.decode(coder.encode(value))
+    self.assertEqual(
+        (value.value, value.timestamp, value.windows),
+        (decoded.value, decoded.timestamp, decoded.windows))
 
   def test_base64_pickle_coder(self):
     self.check_coder(coders.Base64PickleCoder(), 'a', 1, 1.5, (1, 2, 3))
 
   def test_utf8_coder(self):
-    self.check_coder(coders.StrUtf8Coder(), 'a', u'ab\u00FF', u'\u0101\0')
+    self.check_coder(coders.StrUtf8Coder(), 'a', u'ab\u00FF', u'\u0101\0',
+                     unichr(0x10000))
 
 
 if __name__ == '__main__':
@@ -14,6 +14,8 @@
 
 """A pure Python implementation of stream.pyx."""
 
+import struct
+
 
 class OutputStream(object):
   """A pure Python implementation of stream.OutputStream."""
@@ -44,28 +46,53 @@ class OutputStream(object):
       if not v:
         break
 
+  def write_double(self, d):
+    self.data.append(struct.pack('<d', d))
+
+  def write_utf8(self, s, nested=False):
+    self.write(s.encode('utf-8'), nested)
+
   def get(self):
     return ''.join(self.data)
 
+  def clear(self):
+    self.data = []
+
 
 class InputStream(object):
   """A pure Python implementation of stream.InputStream."""
 
-  def __init__(self, data):
+  def __init__(self, data, start=0, end=None):
     self.data = data
-    self.pos = 0
+    self.end = len(data) if end is None else end
+    if not 0 <= start <= self.end <= len(data):
+      raise ValueError('Invalid range [%d, %d) of a buffer of size %d.'
+                       % (start, self.end, len(data)))
+    self.pos = start
 
   def size(self):
-    return len(self.data) - self.pos
+    return self.end - self.pos
 
   def read(self, size):
+    if size > self.end - self.pos:
+      raise ValueError('Not enough bytes to read %d bytes.' % size)
     self.pos += size
     return self.data[self.pos - size : self.pos]
 
   def read_all(self, nested):
     return self.read(self.read_var_int64() if nested else self.size())
 
+  def read_double(self):
+    if self.size() < 8:
+      raise ValueError('Not enough bytes to read a double.')
+    return struct.unpack('<d', self.read(8))[0]
+
+  def read_utf8(self, nested=False):
+    return self.read_all(nested).decode('utf-8')
+
   def read_byte(self):
+    if self.pos >= self.end:
+      raise ValueError('Not enough bytes to read a byte.')
     self.pos += 1
     return ord(self.data[self.pos - 1])
 
@@ -23,14 +23,18 @@ cdef class OutputStream(object):
   cpdef write(self, bytes b, bint nested=*)
   cpdef write_byte(self, unsigned char val)
   cpdef write_var_int64(self, libc.stdint.int64_t v)
+  cpdef write_double(self, double d)
+  cpdef write_utf8(self, unicode s, bint nested=*)
 
   cpdef bytes get(self)
+  cpdef clear(self)
 
   cdef extend(self, size_t missing)
 
 
 cdef class InputStream(object):
   cdef size_t pos
+  cdef size_t end
   cdef bytes all
   cdef char* allc
 
@@ -39,3 +43,5 @@ cdef class InputStream(object):
   cpdef long read_byte(self) except? -1
   cpdef libc.stdint.int64_t read_var_int64(self) except? -1
   cpdef bytes read_all(self, bint nested=*)
+  cpdef double read_double(self) except? -1
+  cpdef unicode read_utf8(self, bint nested=*)
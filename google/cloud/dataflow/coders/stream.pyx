@@ -12,9 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+cimport libc.stdint
 cimport libc.stdlib
 cimport libc.string
 
+from cpython.unicode cimport PyUnicode_AS_UNICODE
+from cpython.unicode cimport PyUnicode_DecodeUTF8
+from cpython.unicode cimport PyUnicode_GET_SIZE
+
+
+cdef inline libc.stdint.uint32_t _next_code_point(
+    Py_UNICODE* chars, Py_ssize_t length, Py_ssize_t* i):
+  """Returns the code point at chars[i[0]], advancing i past it.
+
+  Surrogate pairs are combined and lone surrogates are returned as is, which
+  matches the behavior of unicode.encode('utf-8').
+  """
+  cdef libc.stdint.uint32_t c = chars[i[0]]
+  cdef libc.stdint.uint32_t low
+  i[0] += 1
+  if 0xD800 <= c < 0xDC00 and i[0] < length:
+    low = chars[i[0]]
+    if 0xDC00 <= low < 0xE000:
+      i[0] += 1
+      return 0x10000 + ((c - 0xD800) << 10) + (low - 0xDC00)
+  return c
+
 
 cdef class OutputStream(object):
   """An output string stream implementation supporting write() and get()."""
@@ -59,9 +82,70 @@ cdef class OutputStream(object):
       if not v:
         break
 
+  cpdef write_double(self, double d):
+    """Writes a double as 8 little-endian bytes."""
+    cdef libc.stdint.uint64_t v
+    cdef int i
+    libc.string.memcpy(&v, &d, sizeof(double))
+    if 8 > self.size - self.pos:
+      self.extend(8)
+    for i in range(8):
+      self.data[self.pos + i] = <char>((v >> (8 * i)) & 0xFF)
+    self.pos += 8
+
+  cpdef write_utf8(self, unicode s, bint nested=False):
+    """Writes the UTF-8 encoding of s without an intermediate bytes object."""
+    cdef Py_UNICODE* chars = PyUnicode_AS_UNICODE(s)
+    cdef Py_ssize_t length = PyUnicode_GET_SIZE(s)
+    cdef Py_ssize_t i = 0
+    cdef size_t blen = 0
+    cdef libc.stdint.uint32_t c
+    cdef unsigned char* out
+    while i < length:
+      c = _next_code_point(chars, length, &i)
+      if c < 0x80:
+        blen += 1
+      elif c < 0x800:
+        blen += 2
+      elif c < 0x10000:
+        blen += 3
+      else:
+        blen += 4
+    if nested:
+      self.write_var_int64(blen)
+    if blen > self.size - self.pos:
+      self.extend(blen)
+    out = <unsigned char*>(self.data + self.pos)
+    i = 0
+    while i < length:
+      c = _next_code_point(chars, length, &i)
+      if c < 0x80:
+        out[0] = c
+        out += 1
+      elif c < 0x800:
+        out[0] = 0xC0 | (c >> 6)
+        out[1] = 0x80 | (c & 0x3F)
+        out += 2
+      elif c < 0x10000:
+        out[0] = 0xE0 | (c >> 12)
+        out[1] = 0x80 | ((c >> 6) & 0x3F)
+        out[2] = 0x80 | (c & 0x3F)
+        out += 3
+      else:
+        out[0] = 0xF0 | (c >> 18)
+        out[1] = 0x80 | ((c >> 12) & 0x3F)
+        out[2] = 0x80 | ((c >> 6) & 0x3F)
+        out[3] = 0x80 | (c & 0x3F)
+        out += 4
+    self.pos += blen
+
   cpdef bytes get(self):
     return self.data[:self.pos]
 
+  cpdef clear(self):
+    """Discards the written bytes, keeping the allocated buffer for reuse."""
+    self.pos = 0
+
   cdef extend(self, size_t missing):
     while missing > self.size - self.pos:
       self.size *= 2
@@ -69,16 +153,30 @@ cdef class OutputStream(object):
 
 
 cdef class InputStream(object):
-  """An input string stream implementation supporting read() and size()."""
+  """An input string stream implementation supporting read() and size().
 
-  def __init__(self, all):
+  The stream can be restricted to the range [start, end) of the string, which
+  allows reading parts of a large buffer in place rather than slicing them
+  out first.
+  """
+
+  def __init__(self, all, size_t start=0, end=None):
     self.allc = self.all = all
+    self.end = len(all) if end is None else end
+    if start > self.end or self.end > len(all):
+      raise ValueError('Invalid range [%d, %d) of a buffer of size %d.'
+                       % (start, self.end, len(all)))
+    self.pos = start
 
   cpdef bytes read(self, size_t size):
+    if size > self.end - self.pos:
+      raise ValueError('Not enough bytes to read %d bytes.' % size)
     self.pos += size
     return self.allc[self.pos - size : self.pos]
 
   cpdef long read_byte(self) except? -1:
+    if self.pos >= self.end:
+      raise ValueError('Not enough bytes to read a byte.')
     self.pos += 1
     # Note: the C++ compiler on Dataflow workers treats the char array below as
     # a signed char.  This causes incorrect coder behavior unless explicitly
@@ -86,11 +184,33 @@ cdef class InputStream(object):
     return <long>(<unsigned char> self.allc[self.pos - 1])
 
   cpdef size_t size(self) except? -1:
-    return len(self.all) - self.pos
+    return self.end - self.pos
 
   cpdef bytes read_all(self, bint nested=False):
     return self.read(self.read_var_int64() if nested else self.size())
 
+  cpdef double read_double(self) except? -1:
+    """Reads a double written as 8 little-endian bytes."""
+    cdef libc.stdint.uint64_t v = 0
+    cdef double d
+    cdef int i
+    if self.size() < 8:
+      raise ValueError('Not enough bytes to read a double.')
+    for i in range(8):
+      v |= (<libc.stdint.uint64_t>(<unsigned char>self.allc[self.pos + i])
+            << (8 * i))
+    self.pos += 8
+    libc.string.memcpy(&d, &v, sizeof(double))
+    return d
+
+  cpdef unicode read_utf8(self, bint nested=False):
+    """Decodes UTF-8 directly from the underlying buffer."""
+    cdef size_t size = self.read_var_int64() if nested else self.size()
+    if size > self.size():
+      raise ValueError('Not enough bytes to read a string of length %d.' % size)
+    self.pos += size
+    return PyUnicode_DecodeUTF8(self.allc + self.pos - size, size, NULL)
+
   cpdef libc.stdint.int64_t read_var_int64(self) except? -1:
     """Decode a variable-length encoded long from a stream."""
     cdef long byte
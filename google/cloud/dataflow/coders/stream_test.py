@@ -15,6 +15,7 @@
 """Tests for the stream implementations."""
 
 import math
+import struct
 import unittest
 
 
@@ -42,6 +43,28 @@ class StreamTest(unittest.TestCase):
     in_s = self.InputStream(out_s.get())
     self.assertEquals('abc', in_s.read_all(False))
 
+  def test_read_range(self):
+    in_s = self.InputStream('abc\x02xyz123', 3, 9)
+    self.assertEquals(6, in_s.size())
+    self.assertEquals('xy', in_s.read_all(True))
+    self.assertEquals(3, in_s.size())
+    self.assertEquals('z12', in_s.read_all(False))
+    self.assertEquals(0, in_s.size())
+    with self.assertRaises(ValueError):
+      in_s.read(1)
+    with self.assertRaises(ValueError):
+      in_s.read_byte()
+    with self.assertRaises(ValueError):
+      self.InputStream('abc', 2, 4)
+
+  def test_clear(self):
+    out_s = self.OutputStream()
+    out_s.write('abc' * 1000)
+    out_s.clear()
+    self.assertEquals('', out_s.get())
+    out_s.write('xyz', True)
+    self.assertEquals('\x03xyz', out_s.get())
+
   def test_read_write_byte(self):
     out_s = self.OutputStream()
     out_s.write_byte(1)
@@ -72,6 +95,42 @@ class StreamTest(unittest.TestCase):
   def test_large_var_int64(self):
     self.run_read_write_var_int64([0, 2**63 - 1, -2**63, 2**63 - 3])
 
+  def test_read_write_double(self):
+    values = [0.0, -0.0, 1.5, -1e300, 1e-300, float('inf'), float('-inf')]
+    out_s = self.OutputStream()
+    for v in values:
+      out_s.write_double(v)
+    encoded = out_s.get()
+    self.assertEquals(''.join(struct.pack('<d', v) for v in values), encoded)
+    in_s = self.InputStream(encoded)
+    for v in values:
+      self.assertEquals(v, in_s.read_double())
+    self.assertTrue(math.isnan(
+        self.InputStream(struct.pack('<d', float('nan'))).read_double()))
+
+  def test_read_double_truncated(self):
+    with self.assertRaises(ValueError):
+      self.InputStream('\0' * 7).read_double()
+
+  def test_read_write_utf8(self):
+    values = [u'', u'abc', u'ab\u00FF', u'\u0101\0', u'\u20ac' * 10,
+              unichr(0xD800) + unichr(0xDC00), unichr(0xDBFF) + u'x',
+              unichr(0xDC00) + unichr(0xD800)]
+    out_s = self.OutputStream()
+    for v in values:
+      out_s.write_utf8(v, True)
+    out_s.write_utf8(u'\u0101 tail')
+    encoded = out_s.get()
+    self.assertEquals(
+        ''.join(chr(len(v.encode('utf-8'))) + v.encode('utf-8')
+                for v in values) + u'\u0101 tail'.encode('utf-8'),
+        encoded)
+    in_s = self.InputStream(encoded)
+    for v in values:
+      self.assertEquals(v.encode('utf-8').decode('utf-8'),
+                        in_s.read_utf8(True))
+    self.assertEquals(u'\u0101 tail', in_s.read_utf8(False))
+
 
 try:
   # pylint: disable=g-import-not-at-top
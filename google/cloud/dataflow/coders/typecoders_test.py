@@ -112,6 +112,44 @@ class TypeCodersTest(unittest.TestCase):
         real_coder.encode('abc'), expected_coder.encode('abc'))
     self.assertEqual('abc', real_coder.decode(real_coder.encode('abc')))
 
+  def test_composite_typehint_coders(self):
+    registry = typecoders.registry
+    coder = registry.get_coder(typehints.KV[str, typehints.List[int]])
+    self.assertEqual(
+        coders.TupleCoder(
+            [coders.BytesCoder(), coders.ListCoder(coders.VarIntCoder())]),
+        coder)
+    self.assertTrue(coder.is_deterministic())
+    self.assertEqual(
+        coders.DictCoder(coders.StrUtf8Coder(), coders.FloatCoder()),
+        registry.get_coder(typehints.Dict[unicode, float]))
+    self.assertEqual(
+        coders.SetCoder(coders.TupleCoder([coders.VarIntCoder()] * 2)),
+        registry.get_coder(typehints.Set[typehints.Tuple[int, int]]))
+    self.assertFalse(
+        registry.get_coder(typehints.List[typehints.Any]).is_deterministic())
+
+  def test_union_typehint_coders(self):
+    coder = typecoders.registry.get_coder(typehints.Optional[int])
+    self.assertEqual(
+        coders.UnionCoder([type(None), int],
+                          [coders.NoneCoder(), coders.VarIntCoder()]),
+        coder)
+    for value in (None, 5):
+      self.assertEqual(value, coder.decode(coder.encode(value)))
+    coder = typecoders.registry.get_coder(
+        typehints.Union[str, typehints.List[str]])
+    self.assertTrue(coder.is_deterministic())
+    for value in ('a', ['a', 'b']):
+      self.assertEqual(value, coder.decode(coder.encode(value)))
+    revived_coder = pickler.loads(pickler.dumps(coder))
+    self.assertEqual(['a'], revived_coder.decode(revived_coder.encode(['a'])))
+    # Alternatives sharing a Python type are not distinguishable.
+    self.assertEqual(
+        coders.PickleCoder(),
+        typecoders.registry.get_coder(
+            typehints.Union[typehints.List[int], typehints.List[str]]))
+
 
 if __name__ == '__main__':
   unittest.main()
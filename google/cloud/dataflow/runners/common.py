@@ -71,21 +71,34 @@ class DoFnRunner(object):
     self.tagged_counters = tagged_counters
     self.logger = logger or FakeLogger()
     self.step_name = step_name
+    # The receivers of each output tag, resolved as the tag is first used.
+    self._tagged_outputs = {}
+    self._main_output = None
+
+  def _output_for(self, tag):
+    output = self._tagged_outputs.get(tag)
+    if output is None:
+      output = self._tagged_outputs[tag] = TaggedOutput(
+          self.tagged_receivers[tag], self.tagged_counters[tag])
+    return output
 
   def start(self):
-    self.context.set_element(None)
-    self._process_outputs(None, self.dofn.start_bundle(self.context))
+    with self.logger.PerThreadLoggingContext(step_name=self.step_name):
+      self.context.set_element(None)
+      self._process_outputs(None, self.dofn.start_bundle(self.context))
 
   def finish(self):
     logging.debug('Finishing %s', self)
-    self.context.set_element(None)
-    self._process_outputs(None, self.dofn.finish_bundle(self.context))
+    with self.logger.PerThreadLoggingContext(step_name=self.step_name):
+      self.context.set_element(None)
+      self._process_outputs(None, self.dofn.finish_bundle(self.context))
 
   def process(self, element):
-    with self.logger.PerThreadLoggingContext(step_name=self.step_name):
-      assert isinstance(element, WindowedValue)
-      self.context.set_element(element)
-      self._process_outputs(element, self.dofn.process(self.context))
+    # The logging context is set by the caller, which already scopes the
+    # processing of each element to its step.
+    assert isinstance(element, WindowedValue)
+    self.context.set_element(element)
+    self._process_outputs(element, self.dofn.process(self.context))
 
   def _process_outputs(self, element, results):
     """Dispatch the result of computation to the appropriate receivers.
@@ -95,41 +108,74 @@ class DoFnRunner(object):
     """
     if results is None:
       return
+    if element is None:
+      for result in results:
+        self._process_output(None, result)
+      return
+    # Plain values, by far the most common results, go to the main output
+    # with the timestamp and windows of the input element.
+    main_output = self._main_output
+    timestamp = element.timestamp
+    windows = element.windows
     for result in results:
-      tag = None
-      if isinstance(result, SideOutputValue):
-        tag = result.tag
-        if not isinstance(tag, basestring):
-          raise TypeError('In %s, tag %s is not a string' % (self, tag))
-        result = result.value
-      if isinstance(result, WindowedValue):
-        windowed_value = result
-      elif element is None:
-        # Start and finish have no element from which to grab context,
-        # but may emit elements.
-        if isinstance(result, TimestampedValue):
-          value = result.value
-          timestamp = result.timestamp
-          assign_context = NoContext(value, timestamp)
-        else:
-          value = result
-          timestamp = -1
-          assign_context = NoContext(value)
-        windowed_value = WindowedValue(
-            value, timestamp, self.window_fn.assign(assign_context))
-      elif isinstance(result, TimestampedValue):
-        assign_context = WindowFn.AssignContext(
-            result.timestamp, result.value, element.windows)
-        windowed_value = WindowedValue(
-            result.value, result.timestamp,
-            self.window_fn.assign(assign_context))
+      if isinstance(result, _SPECIAL_OUTPUT_TYPES):
+        self._process_output(element, result)
+      else:
+        if main_output is None:
+          main_output = self._main_output = self._output_for(None)
+        main_output.output(WindowedValue(result, timestamp, windows))
+
+  def _process_output(self, element, result):
+    tag = None
+    if isinstance(result, SideOutputValue):
+      tag = result.tag
+      if not isinstance(tag, basestring):
+        raise TypeError('In %s, tag %s is not a string' % (self, tag))
+      result = result.value
+    if isinstance(result, WindowedValue):
+      windowed_value = result
+    elif element is None:
+      # Start and finish have no element from which to grab context,
+      # but may emit elements.
+      if isinstance(result, TimestampedValue):
+        value = result.value
+        timestamp = result.timestamp
+        assign_context = NoContext(value, timestamp)
       else:
-        windowed_value = WindowedValue(
-            result, element.timestamp, element.windows)
-      for receiver in self.tagged_receivers[tag]:
-        # TODO(robertwb): Should the counters be on the context?
-        self.tagged_counters[tag].update(windowed_value)
-        receiver.process(windowed_value)
+        value = result
+        timestamp = -1
+        assign_context = NoContext(value)
+      windowed_value = WindowedValue(
+          value, timestamp, self.window_fn.assign(assign_context))
+    elif isinstance(result, TimestampedValue):
+      assign_context = WindowFn.AssignContext(
+          result.timestamp, result.value, element.windows)
+      windowed_value = WindowedValue(
+          result.value, result.timestamp,
+          self.window_fn.assign(assign_context))
+    else:
+      windowed_value = WindowedValue(
+          result, element.timestamp, element.windows)
+    self._output_for(tag).output(windowed_value)
+
+
+# Results that are not simply values for the main output.
+_SPECIAL_OUTPUT_TYPES = (SideOutputValue, WindowedValue, TimestampedValue)
+
+
+class TaggedOutput(object):
+  """The receivers of one output of a DoFn, along with its counter."""
+
+  def __init__(self, receivers, counter):
+    self.receivers = receivers
+    self.counter = counter
+
+  def output(self, windowed_value):
+    for receiver in self.receivers:
+      # TODO(robertwb): Should the counters be on the context?
+      self.counter.update(windowed_value)
+      receiver.process(windowed_value)
+
 
 class NoContext(WindowFn.AssignContext):
   """An uninspectable WindowFn.AssignContext."""
@@ -156,19 +156,30 @@ class DataflowPipelineRunner(PipelineRunner):
             % getattr(self, 'last_error_msg', None), self.result)
     return self.result
 
-  def _get_typehint_based_encoding(self, typehint, window_value=True):
+  def _get_typehint_based_encoding(self, typehint, window_value=True,
+                                   window_coder=None):
     """Returns an encoding based on a typehint onject."""
     return self._get_cloud_encoding(self._get_coder(typehint,
-                                                    window_value=window_value))
+                                                    window_value=window_value,
+                                                    window_coder=window_coder))
 
-  def _get_coder(self, typehint, window_value=True):
+  def _get_coder(self, typehint, window_value=True, window_coder=None):
     """Returns a coder based on a typehint onject."""
     if window_value:
-      coder = coders.registry.get_windowed_coder(typehint)
+      coder = coders.registry.get_windowed_coder(
+          typehint, window_coder=window_coder)
     else:
       coder = coders.registry.get_coder(typehint)
     return coder
 
+  def _get_transform_window_coder(self, transform_node):
+    """Returns a coder for the windows of an applied transform node's outputs.
+
+    The coder is chosen by the WindowFn of the transform's main output.
+    """
+    windowfn = transform_node.outputs[0].windowing.windowfn
+    return coders.WindowListCoder(windowfn.get_window_coder())
+
   def _get_cloud_encoding(self, coder):
     """Returns an encoding based on a coder object."""
     if not isinstance(coder, coders.Coder):
@@ -278,7 +289,8 @@ class DataflowPipelineRunner(PipelineRunner):
            PropertyNames.OUTPUT_NAME: input_step.get_output(one_input.tag)})
     step.add_property(PropertyNames.INPUTS, inputs)
     step.encoding = self._get_typehint_based_encoding(
-        self._get_transform_type_hint(transform_node))
+        self._get_transform_type_hint(transform_node),
+        window_coder=self._get_transform_window_coder(transform_node))
     step.add_property(
         PropertyNames.OUTPUT_INFO,
         [{PropertyNames.USER_NAME: (
@@ -314,7 +326,8 @@ class DataflowPipelineRunner(PipelineRunner):
          PropertyNames.STEP_NAME: input_step.proto.name,
          PropertyNames.OUTPUT_NAME: input_step.get_output(input_tag)})
     step.encoding = self._get_typehint_based_encoding(
-        self._get_transform_type_hint(transform_node))
+        self._get_transform_type_hint(transform_node),
+        window_coder=self._get_transform_window_coder(transform_node))
     step.add_property(
         PropertyNames.OUTPUT_INFO,
         [{PropertyNames.USER_NAME: (
@@ -371,7 +384,8 @@ class DataflowPipelineRunner(PipelineRunner):
     # be transformed into 'out_out' internally.
     outputs = []
     step.encoding = self._get_typehint_based_encoding(
-        self._get_transform_type_hint(transform_node))
+        self._get_transform_type_hint(transform_node),
+        window_coder=self._get_transform_window_coder(transform_node))
 
     # Add the main output to the description.
     outputs.append(
@@ -417,7 +431,8 @@ class DataflowPipelineRunner(PipelineRunner):
     accumulator_encoding = self._get_typehint_based_encoding(
         self._get_transform_type_hint(transform_node), window_value=False)
     output_encoding = self._get_typehint_based_encoding(
-        self._get_transform_type_hint(transform_node))
+        self._get_transform_type_hint(transform_node),
+        window_coder=self._get_transform_window_coder(transform_node))
 
     step.encoding = output_encoding
     step.add_property(PropertyNames.ENCODING, accumulator_encoding)
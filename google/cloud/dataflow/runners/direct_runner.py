@@ -22,15 +22,24 @@ of transformations belonging to a pipeline on the local machine.
 from __future__ import absolute_import
 
 import collections
+import heapq
 import itertools
+import multiprocessing
+import operator
+import os
+import struct
+import tempfile
 
 from google.cloud.dataflow import coders
 from google.cloud.dataflow import error
+from google.cloud.dataflow.internal import pickler
 from google.cloud.dataflow.pvalue import AsIter
 from google.cloud.dataflow.pvalue import AsSingleton
 from google.cloud.dataflow.pvalue import EmptySideInput
+from google.cloud.dataflow.pvalue import PCollection
 from google.cloud.dataflow.runners.common import DoFnRunner
 from google.cloud.dataflow.runners.common import DoFnState
+from google.cloud.dataflow.runners.runner import PersistentPValueCache
 from google.cloud.dataflow.runners.runner import PipelineRunner
 from google.cloud.dataflow.runners.runner import PValueCache
 from google.cloud.dataflow.transforms import DoFnProcessContext
@@ -39,6 +48,7 @@ from google.cloud.dataflow.transforms.window import WindowedValue
 from google.cloud.dataflow.typehints.typecheck import OutputCheckWrapperDoFn
 from google.cloud.dataflow.typehints.typecheck import TypeCheckError
 from google.cloud.dataflow.typehints.typecheck import TypeCheckWrapperDoFn
+from google.cloud.dataflow.utils.options import DirectOptions
 from google.cloud.dataflow.utils.options import TypeOptions
 
 
@@ -46,12 +56,173 @@ class DirectPipelineRunner(PipelineRunner):
   """A local pipeline runner.
 
   The runner computes everything locally and does not make any attempt to
-  optimize for time or space.
+  optimize for space. By default everything runs in the main process; with
+  --direct_num_workers set above 1 the input of every ParDo is split into
+  bundles which are processed on a pool of worker processes, and
+  GroupByKeyOnly is hash-partitioned by key across the same pool. DoFns and
+  their side inputs must be picklable for this mode, and aggregator values
+  updated inside the worker processes are not reported back.
+
+  By default every PCollection is materialized as a list. With
+  --direct_pipelined_execution a PCollection read by exactly one transform,
+  and not as a side input, is instead produced lazily and streamed into its
+  consumer, so that chains of ParDos (and the Read, Create or Flatten feeding
+  them) only hold one element at a time. Values are dropped from the cache as
+  soon as the last transform reading them has run, so only the PCollections
+  that no transform reads can be inspected with get_pvalue() afterwards.
+
+  With --direct_cache_dir the runner uses a PersistentPValueCache, so that a
+  later run of the same pipeline only recomputes the transforms that changed
+  and the transforms downstream of them.
+
+  Side inputs are materialized once per PCollection and shared by all the
+  ParDos reading them: AsIter and AsList get the same list of values, and
+  AsSingleton looks its value up only once. The ToList and ToDict transforms
+  behind AsList and AsDict are run natively on globally windowed inputs, as a
+  list and a dict built directly from the input instead of a
+  CombineGlobally.
   """
 
   def __init__(self, cache=None):
     # Cache of values computed while the runner executes a pipeline.
     self._cache = cache if cache is not None else PValueCache()
+    self._owns_cache = cache is None
+    # Pool of worker processes, created on first use by a step that runs
+    # with more than one worker.
+    self._pool = None
+    self._pool_size = 0
+    # Whether the current run streams single-consumer PCollections, and the
+    # cache keys of the PCollections used as side inputs in that run.
+    self._pipelined = False
+    self._side_input_keys = set()
+    # Materialized views of cached values, shared by all the transforms using
+    # them. Maps id() of a cached value to the value, so that the entry is
+    # not confused with a later value at the same address, and a dict of the
+    # views built so far keyed by view kind.
+    self._views = {}
+
+  def run(self, pipeline, node=None):
+    options = pipeline.options
+    direct_options = (
+        options.view_as(DirectOptions) if options is not None else None)
+    self._pipelined = (
+        direct_options is not None and
+        direct_options.direct_pipelined_execution)
+    if (direct_options is not None and direct_options.direct_cache_dir and
+        self._owns_cache and
+        not isinstance(self._cache, PersistentPValueCache)):
+      max_mb = direct_options.direct_cache_max_mb
+      self._cache = PersistentPValueCache(
+          direct_options.direct_cache_dir,
+          max_bytes=None if max_mb is None else int(max_mb * 1024 * 1024))
+    self._cache.clear_consumers()
+    self._side_input_keys = set()
+    if self._pipelined:
+      self._register_consumers(pipeline, node)
+    try:
+      return super(DirectPipelineRunner, self).run(pipeline, node=node)
+    finally:
+      self._close_pool()
+      self._views.clear()
+
+  def _register_consumers(self, pipeline, node):
+    """Registers the inputs of all transforms to run with the cache."""
+
+    # Imported here to avoid circular dependencies.
+    # pylint: disable=g-import-not-at-top
+    from google.cloud.dataflow.pipeline import PipelineVisitor
+
+    class ConsumerVisitor(PipelineVisitor):
+
+      def __init__(self, runner):
+        self.runner = runner
+
+      def visit_transform(self, transform_node):
+        # pylint: disable=protected-access
+        cache = self.runner._cache
+        for pcoll in transform_node.inputs:
+          if pcoll.producer is not None:
+            cache.add_consumer(pcoll)
+        for side_input in transform_node.side_inputs:
+          self.runner._side_input_keys.add(
+              cache.add_consumer(side_input.pvalue))
+
+    pipeline.visit(ConsumerVisitor(self), node=node)
+
+  def run_transform(self, transform_node):
+    super(DirectPipelineRunner, self).run_transform(transform_node)
+    self._cache.finish_transform(transform_node)
+    if self._pipelined:
+      released = [pcoll for pcoll in transform_node.inputs
+                  if pcoll.producer is not None]
+      released.extend(si.pvalue for si in transform_node.side_inputs)
+      for pcoll in released:
+        dropped = self._cache.release(pcoll)
+        if dropped is not None:
+          self._views.pop(id(dropped), None)
+
+  def _get_view(self, values, kind, build):
+    """Returns the view of a cached value, building it on first use."""
+    if id(values) in self._views and self._views[id(values)][0] is values:
+      views = self._views[id(values)][1]
+    else:
+      views = {}
+      self._views[id(values)] = values, views
+    if kind not in views:
+      views[kind] = build(values)
+    return views[kind]
+
+  def _get_materialized_pvalue(self, pvalue):
+    """Returns the cached value of a PValue as a list."""
+    values = self._cache.get_pvalue(pvalue)
+    if not isinstance(values, list):
+      # Lazily produced values are only read by one transform, so the list
+      # need not be cached.
+      values = list(values)
+    return values
+
+  def _can_stream(self, transform_node):
+    """Returns whether the main output of a transform can be produced lazily.
+
+    This is the case only if a single transform reads the main output, not as
+    a side input, since a lazily produced value can only be iterated once, and
+    none of the other outputs of the transform are read.
+    """
+    return (self._pipelined and
+            self._cache.consumer_counts(transform_node) == {None: 1} and
+            (id(transform_node), None) not in self._side_input_keys)
+
+  def _get_parallelism(self, transform_node):
+    """Returns the (num_workers, bundle_size) to use for a transform."""
+    options = transform_node.inputs[0].pipeline.options
+    if options is None:
+      return 1, None
+    direct_options = options.view_as(DirectOptions)
+    return direct_options.direct_num_workers, direct_options.direct_bundle_size
+
+  def _get_group_by_key_budget(self, transform_node):
+    """Returns the GroupByKey memory budget in bytes, or None if unbounded."""
+    options = transform_node.inputs[0].pipeline.options
+    if options is None:
+      return None
+    memory_mb = options.view_as(DirectOptions).direct_group_by_key_memory_mb
+    if memory_mb is None:
+      return None
+    return max(1, int(memory_mb * 1024 * 1024))
+
+  def _get_pool(self, num_workers):
+    if self._pool is None or self._pool_size != num_workers:
+      self._close_pool()
+      self._pool = multiprocessing.Pool(num_workers)
+      self._pool_size = num_workers
+    return self._pool
+
+  def _close_pool(self):
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+      self._pool_size = 0
 
   def get_pvalue(self, pvalue):
     """Gets the PValue's computed value from the runner's cache."""
@@ -83,15 +254,13 @@ class DirectPipelineRunner(PipelineRunner):
     # Construct the list of values from side-input PCollections that we'll
     # substitute into the arguments for DoFn methods.
     def get_side_input_value(si):
+      pcoll_vals = self._cache.get_pvalue(si.pvalue)
       if isinstance(si, AsSingleton):
         # User wants one item from the PCollection as side input, or an
         # EmptySideInput if no value exists.
-        pcoll_vals = self._cache.get_pvalue(si.pvalue)
-        if len(pcoll_vals) == 1:
-          return pcoll_vals[0].value
-        elif len(pcoll_vals) > 1:
-          raise ValueError("PCollection with more than one element "
-                           "accessed as a singleton view.")
+        singleton = self._get_view(pcoll_vals, 'singleton', _singleton_view)
+        if singleton:
+          return singleton[0]
         elif si.default_value != si._NO_DEFAULT:
           return si.default_value
         else:
@@ -100,7 +269,7 @@ class DirectPipelineRunner(PipelineRunner):
       if isinstance(si, AsIter):
         # User wants the entire PCollection as side input. List permits
         # repeatable iteration.
-        return [v.value for v in self._cache.get_pvalue(si.pvalue)]
+        return self._get_view(pcoll_vals, 'list', _list_view)
     side_inputs = [get_side_input_value(e) for e in transform_node.side_inputs]
 
     # TODO(robertwb): Do this type checking inside DoFnRunner to get it on
@@ -114,33 +283,57 @@ class DirectPipelineRunner(PipelineRunner):
     transform.dofn = OutputCheckWrapperDoFn(
         transform.dofn, transform_node.full_label)
 
-    class NoOpCounters(object):
-      def update(self, element):
-        pass
-
-    class RecordingReciever(object):
-      def __init__(self, tag):
-        self.tag = tag
-      def process(self, element):
-        results[self.tag].append(element)
-
-    class TaggedRecievers(dict):
-      def __missing__(self, key):
-        return [RecordingReciever(key)]
-
-    results = collections.defaultdict(list)
-    # Some tags may be empty.
-    for tag in transform.side_output_tags:
-      results[tag] = []
-
-    runner = DoFnRunner(transform.dofn, transform.args, transform.kwargs,
-                        side_inputs, transform_node.inputs[0].windowing,
-                        context, TaggedRecievers(),
-                        collections.defaultdict(NoOpCounters))
-    runner.start()
-    for v in self._cache.get_pvalue(transform_node.inputs[0]):
-      runner.process(v)
-    runner.finish()
+    num_workers, bundle_size = self._get_parallelism(transform_node)
+    # Outputs read by later transforms must exist even if nothing was emitted
+    # to them, since their producer's main output may be dropped earlier.
+    side_output_tags = list(transform.side_output_tags) + [
+        tag for tag in self._cache.consumer_counts(transform_node)
+        if tag is not None and tag not in transform.side_output_tags]
+    elements = self._cache.get_pvalue(transform_node.inputs[0])
+    if num_workers <= 1 and self._can_stream(transform_node):
+      # Side outputs are still recorded in lists that are filled in as the
+      # main output is consumed. Nothing else reads them during this run.
+      cache = self._cache
+
+      class CachedSideOutputs(dict):
+
+        def __missing__(self, tag):
+          value = self[tag] = []
+          cache.cache_output(transform_node, tag, value)
+          return value
+
+      side_outputs = CachedSideOutputs()
+      for tag in side_output_tags:
+        side_outputs.__missing__(tag)
+      self._cache.cache_output(
+          transform_node,
+          _iter_dofn_outputs(
+              transform.dofn, transform.args, transform.kwargs, side_inputs,
+              transform_node.inputs[0].windowing, context, side_outputs,
+              elements))
+      return
+
+    if num_workers <= 1:
+      results = _run_dofn_bundle(
+          transform.dofn, transform.args, transform.kwargs, side_inputs,
+          transform_node.inputs[0].windowing, context, side_output_tags,
+          elements)
+    else:
+      serialized_fn = pickler.dumps(
+          (transform.dofn, transform.args, transform.kwargs, side_inputs,
+           transform_node.inputs[0].windowing, transform.label,
+           side_output_tags))
+      # Pool.map returns the bundle results in input order, so concatenating
+      # them per tag keeps the outputs in the same order as the input.
+      results = collections.defaultdict(list)
+      for tag in side_output_tags:
+        results[tag] = []
+      bundles = _split_into_bundles(elements, bundle_size, num_workers)
+      for bundle_results in self._get_pool(num_workers).map(
+          _run_serialized_dofn_bundle,
+          [(serialized_fn, bundle) for bundle in bundles]):
+        for tag, value in bundle_results.items():
+          results[tag].extend(value)
 
     self._cache.cache_output(transform_node, [])
     for tag, value in results.items():
@@ -148,43 +341,85 @@ class DirectPipelineRunner(PipelineRunner):
 
   @skip_if_cached
   def run_GroupByKeyOnly(self, transform_node):
-    result_dict = collections.defaultdict(list)
     # The input type of a GroupByKey will be KV[Any, Any] or more specific.
     kv_type_hint = transform_node.transform.get_type_hints().input_types[0]
     key_coder = coders.registry.get_coder(kv_type_hint[0].tuple_types[0])
+    elements = self._cache.get_pvalue(transform_node.inputs[0])
 
-    for wv in self._cache.get_pvalue(transform_node.inputs[0]):
-      if (isinstance(wv, WindowedValue) and
-          isinstance(wv.value, collections.Iterable) and len(wv.value) == 2):
-        k, v = wv.value
-        # We use as key a string encoding of the key object to support keys
-        # that are based on custom classes. This mimics also the remote
-        # execution behavior where key objects are encoded before being written
-        # to the shuffler system responsible for grouping.
-        result_dict[key_coder.encode(k)].append(v)
-      else:
-        raise TypeCheckError('Input to GroupByKeyOnly must be a PCollection of '
-                             'windowed key-value pairs. Instead received: %r.'
-                             % wv)
+    num_workers, bundle_size = self._get_parallelism(transform_node)
+    budget = self._get_group_by_key_budget(transform_node)
+    if num_workers <= 1 and budget is not None:
+      value_coder = coders.registry.get_coder(kv_type_hint[0].tuple_types[1])
+      grouped = _external_group_by_key(
+          key_coder, value_coder, _encode_keys(key_coder, elements), budget)
+      if not self._can_stream(transform_node):
+        grouped = list(grouped)
+    elif num_workers <= 1:
+      grouped = _group_by_encoded_key(
+          key_coder, _encode_keys(key_coder, elements))
+    else:
+      # Each worker first encodes the keys of one bundle and splits it into
+      # hash partitions, then each worker groups all the pieces of one
+      # partition. Keys with equal encodings always land in the same
+      # partition, so the per-partition groups are complete.
+      pool = self._get_pool(num_workers)
+      serialized_coder = pickler.dumps(key_coder)
+      bundles = _split_into_bundles(elements, bundle_size, num_workers)
+      partitioned_bundles = pool.map(
+          _partition_bundle,
+          [(serialized_coder, num_workers, bundle) for bundle in bundles])
+      grouped = list(itertools.chain.from_iterable(pool.map(
+          _group_partition,
+          [(serialized_coder, [partitions[i]
+                               for partitions in partitioned_bundles])
+           for i in xrange(num_workers)])))
+
+    self._cache.cache_output(transform_node, grouped)
+
+  def apply_ToList(self, transform, pcoll):
+    if not isinstance(pcoll.windowing.windowfn, GlobalWindows):
+      return transform.apply(pcoll)
+    # Run natively by run_ToList rather than expanded into a CombineGlobally.
+    return PCollection(pipeline=pcoll.pipeline, transform=transform)
+
+  def apply_ToDict(self, transform, pcoll):
+    if not isinstance(pcoll.windowing.windowfn, GlobalWindows):
+      return transform.apply(pcoll)
+    # Run natively by run_ToDict rather than expanded into a CombineGlobally.
+    return PCollection(pipeline=pcoll.pipeline, transform=transform)
 
+  @skip_if_cached
+  def run_ToList(self, transform_node):
+    values = self._get_materialized_pvalue(transform_node.inputs[0])
     self._cache.cache_output(
         transform_node,
-        map(GlobalWindows.WindowedValue,
-            ((key_coder.decode(k), v) for k, v in result_dict.iteritems())))
+        [GlobalWindows.WindowedValue(
+            self._get_view(values, 'list', _list_view))])
 
   @skip_if_cached
-  def run_Create(self, transform_node):
-    transform = transform_node.transform
+  def run_ToDict(self, transform_node):
+    values = self._get_materialized_pvalue(transform_node.inputs[0])
     self._cache.cache_output(
         transform_node,
-        [GlobalWindows.WindowedValue(v) for v in transform.value])
+        [GlobalWindows.WindowedValue(
+            self._get_view(values, 'dict', _dict_view))])
+
+  @skip_if_cached
+  def run_Create(self, transform_node):
+    transform = transform_node.transform
+    values = (GlobalWindows.WindowedValue(v) for v in transform.value)
+    if not self._can_stream(transform_node):
+      values = list(values)
+    self._cache.cache_output(transform_node, values)
 
   @skip_if_cached
   def run_Flatten(self, transform_node):
-    self._cache.cache_output(
-        transform_node,
-        list(itertools.chain.from_iterable(
-            self._cache.get_pvalue(pc) for pc in transform_node.inputs)))
+    # The inputs are looked up now since they are released once this returns.
+    values = itertools.chain.from_iterable(
+        [self._cache.get_pvalue(pc) for pc in transform_node.inputs])
+    if not self._can_stream(transform_node):
+      values = list(values)
+    self._cache.cache_output(transform_node, values)
 
   @skip_if_cached
   def run_Read(self, transform_node):
@@ -192,9 +427,10 @@ class DirectPipelineRunner(PipelineRunner):
     # to sources when using DirectRunner.
     source = transform_node.transform.source
     source.pipeline_options = transform_node.inputs[0].pipeline.options
-    with source.reader() as reader:
-      self._cache.cache_output(
-          transform_node, [GlobalWindows.WindowedValue(e) for e in reader])
+    values = _read_source(source)
+    if not self._can_stream(transform_node):
+      values = list(values)
+    self._cache.cache_output(transform_node, values)
 
   @skip_if_cached
   def run__NativeWrite(self, transform_node):
@@ -202,3 +438,269 @@ class DirectPipelineRunner(PipelineRunner):
     with transform.sink.writer() as writer:
       for v in self._cache.get_pvalue(transform_node.inputs[0]):
         writer.Write(v.value)
+
+
+def _list_view(windowed_values):
+  """Returns a list of the values of windowed values."""
+  return [wv.value for wv in windowed_values]
+
+
+def _singleton_view(windowed_values):
+  """Returns a list holding the only value of a singleton side input."""
+  if len(windowed_values) > 1:
+    raise ValueError("PCollection with more than one element "
+                     "accessed as a singleton view.")
+  return [wv.value for wv in windowed_values]
+
+
+def _dict_view(windowed_values):
+  """Returns a dict indexing the values of windowed key-value pairs."""
+  return dict(wv.value for wv in windowed_values)
+
+
+def _split_into_bundles(elements, bundle_size, num_workers):
+  """Splits elements into consecutive lists of elements.
+
+  If bundle_size is not set the elements are split into a few bundles per
+  worker process so that uneven bundles still keep all workers busy. An empty
+  input yields a single empty bundle, so that start_bundle and finish_bundle
+  still run once as they do in the single process mode.
+  """
+  if not isinstance(elements, list):
+    elements = list(elements)
+  if not elements:
+    return [[]]
+  if not bundle_size:
+    bundle_size = max(1, -(-len(elements) // (4 * num_workers)))
+  return [elements[i:i + bundle_size]
+          for i in xrange(0, len(elements), bundle_size)]
+
+
+def _run_dofn_bundle(dofn, args, kwargs, side_inputs, windowing, context,
+                     side_output_tags, elements):
+  """Runs a DoFn over one bundle and returns its outputs keyed by tag."""
+  results = collections.defaultdict(list)
+  # Some tags may be empty.
+  for tag in side_output_tags:
+    results[tag] = []
+  results[None] = list(_iter_dofn_outputs(
+      dofn, args, kwargs, side_inputs, windowing, context, results, elements))
+  return results
+
+
+def _iter_dofn_outputs(dofn, args, kwargs, side_inputs, windowing, context,
+                       side_outputs, elements):
+  """Runs a DoFn over one bundle, yielding main outputs as they are produced.
+
+  The bundle is processed lazily: elements are read and processed only as the
+  main outputs are consumed. Outputs to other tags are appended to the lists
+  in side_outputs, which must create the list of a missing tag on access.
+  """
+  main_outputs = []
+
+  class NoOpCounters(object):
+    def update(self, element):
+      pass
+
+  class RecordingReciever(object):
+    def __init__(self, tag):
+      self.outputs = main_outputs if tag is None else side_outputs[tag]
+    def process(self, element):
+      self.outputs.append(element)
+
+  class TaggedRecievers(dict):
+    def __missing__(self, key):
+      return [RecordingReciever(key)]
+
+  runner = DoFnRunner(dofn, args, kwargs, side_inputs, windowing,
+                      context, TaggedRecievers(),
+                      collections.defaultdict(NoOpCounters))
+  runner.start()
+  for v in elements:
+    runner.process(v)
+    for output in main_outputs:
+      yield output
+    del main_outputs[:]
+  runner.finish()
+  for output in main_outputs:
+    yield output
+
+
+def _run_serialized_dofn_bundle(args):
+  """Worker process entry point for running one bundle of a ParDo."""
+  serialized_fn, elements = args
+  (dofn, dofn_args, dofn_kwargs, side_inputs, windowing, label,
+   side_output_tags) = pickler.loads(serialized_fn)
+  context = DoFnProcessContext(label=label, state=DoFnState())
+  return dict(_run_dofn_bundle(
+      dofn, dofn_args, dofn_kwargs, side_inputs, windowing, context,
+      side_output_tags, elements))
+
+
+def _read_source(source):
+  """Yields the elements read from a source as windowed values."""
+  with source.reader() as reader:
+    for e in reader:
+      yield GlobalWindows.WindowedValue(e)
+
+
+def _encode_keys(key_coder, elements):
+  """Yields (encoded key, value) pairs for windowed key-value elements."""
+  for wv in elements:
+    if (isinstance(wv, WindowedValue) and
+        isinstance(wv.value, collections.Iterable) and len(wv.value) == 2):
+      k, v = wv.value
+      # We use as key a string encoding of the key object to support keys
+      # that are based on custom classes. This mimics also the remote
+      # execution behavior where key objects are encoded before being written
+      # to the shuffler system responsible for grouping.
+      yield key_coder.encode(k), v
+    else:
+      raise TypeCheckError('Input to GroupByKeyOnly must be a PCollection of '
+                           'windowed key-value pairs. Instead received: %r.'
+                           % wv)
+
+
+def _group_by_encoded_key(key_coder, encoded_pairs):
+  """Groups (encoded key, value) pairs into windowed (key, values) pairs."""
+  result_dict = collections.defaultdict(list)
+  for k, v in encoded_pairs:
+    result_dict[k].append(v)
+  return map(GlobalWindows.WindowedValue,
+             ((key_coder.decode(k), v) for k, v in result_dict.iteritems()))
+
+
+def _partition_bundle(args):
+  """Worker process entry point splitting a bundle into key partitions."""
+  serialized_coder, num_partitions, elements = args
+  key_coder = pickler.loads(serialized_coder)
+  partitions = [[] for _ in xrange(num_partitions)]
+  for k, v in _encode_keys(key_coder, elements):
+    partitions[hash(k) % num_partitions].append((k, v))
+  return partitions
+
+
+def _group_partition(args):
+  """Worker process entry point grouping all pieces of one key partition."""
+  serialized_coder, pieces = args
+  return _group_by_encoded_key(
+      pickler.loads(serialized_coder), itertools.chain.from_iterable(pieces))
+
+
+class _SpilledRun(object):
+  """A run of encoded key-value records, sorted by key, in a local file.
+
+  Each record is the length of the key and of the value, as two big-endian
+  unsigned 32-bit integers, followed by the key and the value bytes. The file
+  is deleted once the run is garbage collected.
+  """
+
+  _HEADER = struct.Struct('>II')
+
+  def __init__(self, records):
+    fd, self.path = tempfile.mkstemp(prefix='dataflow-gbk-')
+    with os.fdopen(fd, 'wb') as f:
+      for k, v in records:
+        f.write(self._HEADER.pack(len(k), len(v)))
+        f.write(k)
+        f.write(v)
+
+  def __del__(self):
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+
+  def read(self, offset=0):
+    """Yields (offset, key, value) for the records starting at an offset."""
+    header_size = self._HEADER.size
+    with open(self.path, 'rb') as f:
+      f.seek(offset)
+      while True:
+        header = f.read(header_size)
+        if not header:
+          return
+        key_length, value_length = self._HEADER.unpack(header)
+        k = f.read(key_length)
+        v = f.read(value_length)
+        yield offset, k, v
+        offset += header_size + key_length + value_length
+
+
+class _SpilledValues(object):
+  """The values of one key, decoded lazily from spilled runs.
+
+  The values are stored as segments of consecutive records, at most one per
+  run, and are read back from disk every time they are iterated over.
+  """
+
+  def __init__(self, value_coder, segments):
+    self._value_coder = value_coder
+    # List of (run, offset, count) triples in run order.
+    self._segments = segments
+
+  def __iter__(self):
+    for run, offset, count in self._segments:
+      for _, _, v in itertools.islice(run.read(offset), count):
+        yield self._value_coder.decode(v)
+
+  def __len__(self):
+    return sum(count for _, _, count in self._segments)
+
+  def __repr__(self):
+    return '<%s of %d values>' % (type(self).__name__, len(self))
+
+  def __reduce__(self):
+    # Pickled as the list of values since the runs are local temporary files.
+    return list, (list(self),)
+
+
+def _external_group_by_key(key_coder, value_coder, encoded_pairs,
+                           budget_bytes):
+  """Groups (encoded key, value) pairs within a bounded memory buffer.
+
+  Values are encoded and buffered until the encoded keys and values exceed
+  budget_bytes; the buffer is then sorted by key and spilled to a local file.
+  The spilled runs are merged by key at the end, yielding windowed (key,
+  values) pairs where values lazily reads the records back from the runs, so
+  no group needs to fit in memory. If nothing was spilled the buffer is
+  grouped in memory. Within each group values keep their input order.
+  """
+  runs = []
+  buffered = []
+  buffered_bytes = 0
+  for k, v in encoded_pairs:
+    v = value_coder.encode(v)
+    buffered.append((k, v))
+    buffered_bytes += len(k) + len(v)
+    if buffered_bytes >= budget_bytes:
+      # The sort is stable, so values of a key stay in input order.
+      runs.append(_SpilledRun(sorted(buffered, key=operator.itemgetter(0))))
+      buffered = []
+      buffered_bytes = 0
+
+  if not runs:
+    for wv in _group_by_encoded_key(
+        key_coder, ((k, value_coder.decode(v)) for k, v in buffered)):
+      yield wv
+    return
+  if buffered:
+    runs.append(_SpilledRun(sorted(buffered, key=operator.itemgetter(0))))
+    buffered = []
+
+  # Records with equal keys are ordered by run, then by position in the run,
+  # which is the order in which their values were received.
+  def run_keys(i):
+    for offset, k, _ in runs[i].read():
+      yield k, i, offset
+  merged = heapq.merge(*[run_keys(i) for i in xrange(len(runs))])
+  for k, records in itertools.groupby(merged, key=operator.itemgetter(0)):
+    segments = []
+    for _, i, offset in records:
+      if segments and segments[-1][0] is runs[i]:
+        run, first_offset, count = segments[-1]
+        segments[-1] = run, first_offset, count + 1
+      else:
+        segments.append((runs[i], offset, 1))
+    yield GlobalWindows.WindowedValue(
+        (key_coder.decode(k), _SpilledValues(value_coder, segments)))
@@ -17,6 +17,15 @@
 from __future__ import absolute_import
 
 import copy
+import glob
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+
+from google.cloud.dataflow import coders
+from google.cloud.dataflow.internal import pickler
 
 
 def create_runner(runner_name):
@@ -165,6 +174,10 @@ class PValueCache(object):
     # since a PValue is associated with one and only one pipeline. The keys of
     # the dictionary are PValue instance addresses obtained using id().
     self._cache = {}
+    # Number of consumers that have yet to read each cached value, for the
+    # values registered with add_consumer(). A value is dropped from the cache
+    # as soon as its last consumer releases it.
+    self._consumer_counts = {}
 
   def __len__(self):
     return len(self._cache)
@@ -231,6 +244,241 @@ class PValueCache(object):
   def key(self, pobj):
     return id(pobj.producer), pobj.tag
 
+  def add_consumer(self, pvalue):
+    """Registers one more consumer that will read the value of a PValue.
+
+    Args:
+      pvalue: A PValue instance that will be read by one more transform.
+
+    Returns:
+      The key under which the value of the PValue is cached.
+    """
+    key = self.key(self._get_pvalue_with_real_producer(pvalue))
+    self._consumer_counts[key] = self._consumer_counts.get(key, 0) + 1
+    return key
+
+  def consumer_counts(self, transform):
+    """Returns a dict mapping output tags of a transform to consumer counts."""
+    return dict((tag, count)
+                for (transform_id, tag), count
+                in self._consumer_counts.iteritems()
+                if transform_id == id(transform))
+
+  def release(self, pvalue):
+    """Releases a consumer of a PValue, dropping its value after the last.
+
+    Args:
+      pvalue: A PValue instance registered with add_consumer().
+
+    Returns:
+      The value dropped from the cache, or None if it is still cached.
+    """
+    key = self.key(self._get_pvalue_with_real_producer(pvalue))
+    count = self._consumer_counts.get(key)
+    if count is None:
+      return None
+    if count > 1:
+      self._consumer_counts[key] = count - 1
+      return None
+    else:
+      del self._consumer_counts[key]
+      return self._cache.pop(key, None)
+
+  def clear_consumers(self):
+    """Forgets all registered consumers without dropping any values."""
+    self._consumer_counts.clear()
+
+  def finish_transform(self, transform):
+    """Called by runners once a transform has cached all of its outputs."""
+    pass
+
+
+class PersistentPValueCache(PValueCache):
+  """A PValueCache that also stores computed values in a local directory.
+
+  Every primitive AppliedPTransform is identified by a fingerprint of its full
+  label, its pickled state (including its DoFn and arguments) and the
+  fingerprints of the transforms producing its inputs and side inputs. Once a
+  transform has run, all its outputs are written to an entry named after the
+  fingerprint. When the same transform, with the same upstream transforms, is
+  run again, even from another process, its outputs are loaded from the entry
+  instead of being recomputed.
+
+  Only the transform objects are fingerprinted, not the data they read, so an
+  entry for a Read is not invalidated when the file it reads changes, and
+  functions that are pickled by reference are identified by their names
+  only. Outputs that are not materialized lists, or that cannot be pickled,
+  are not stored.
+
+  Entries are evicted, least recently used first, whenever the entries in the
+  directory add up to more than max_bytes.
+  """
+
+  ENTRY_SUFFIX = '.pcache'
+
+  # Transform attributes that refer to the pipeline graph rather than to what
+  # the transform computes. Inputs are fingerprinted through their producers.
+  _UNFINGERPRINTED_ATTRIBUTES = frozenset(
+      ['pipeline', 'side_inputs', 'raw_side_inputs'])
+
+  _LENGTH = struct.Struct('>I')
+
+  def __init__(self, cache_dir, max_bytes=None):
+    super(PersistentPValueCache, self).__init__()
+    self._cache_dir = cache_dir
+    self._max_bytes = max_bytes
+    self._coder = coders.PickleCoder()
+    # Fingerprints of the transforms seen so far, keyed by id(). A None value
+    # means the transform cannot be fingerprinted, and neither can any
+    # transform reading its outputs.
+    self._fingerprints = {}
+    # Fingerprints of the entries known to be in the directory already.
+    self._stored = set()
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def fingerprint(self, transform):
+    """Returns the fingerprint of an AppliedPTransform, or None."""
+    if id(transform) not in self._fingerprints:
+      self._fingerprints[id(transform)] = self._compute_fingerprint(transform)
+    return self._fingerprints[id(transform)]
+
+  def _compute_fingerprint(self, transform):
+    h = hashlib.sha1()
+    h.update(transform.full_label)
+    cls = type(transform.transform)
+    h.update('%s.%s' % (cls.__module__, cls.__name__))
+    state = sorted(
+        (name, value)
+        for name, value in transform.transform.__dict__.iteritems()
+        if name not in self._UNFINGERPRINTED_ATTRIBUTES)
+    try:
+      h.update(pickler.dumps(state))
+    except Exception:  # pylint: disable=broad-except
+      logging.info('Not caching the outputs of %s: cannot pickle transform.',
+                   transform.full_label, exc_info=True)
+      return None
+    upstream = [(pcoll, None) for pcoll in transform.inputs
+                if pcoll.producer is not None]
+    upstream.extend((side_input.pvalue, type(side_input).__name__)
+                    for side_input in transform.side_inputs)
+    for pcoll, view in upstream:
+      pcoll = self._get_pvalue_with_real_producer(pcoll)
+      producer_fingerprint = self.fingerprint(pcoll.producer)
+      if producer_fingerprint is None:
+        return None
+      h.update(repr((producer_fingerprint, pcoll.tag, view)))
+    return h.hexdigest()
+
+  def _entry_path(self, fingerprint):
+    return os.path.join(self._cache_dir, fingerprint + self.ENTRY_SUFFIX)
+
+  def is_cached(self, pobj):
+    if super(PersistentPValueCache, self).is_cached(pobj):
+      return True
+    # Import here to avoid circular dependencies.
+    from google.cloud.dataflow.pipeline import AppliedPTransform
+    if isinstance(pobj, AppliedPTransform):
+      transform = pobj
+    else:
+      transform = self._get_pvalue_with_real_producer(pobj).producer
+    fingerprint = self.fingerprint(transform)
+    if fingerprint is None:
+      return False
+    try:
+      outputs = self._read_entry(self._entry_path(fingerprint))
+    except (IOError, EOFError, struct.error):
+      return False
+    for tag, value in outputs:
+      self._cache[id(transform), tag] = value
+    self._stored.add(fingerprint)
+    logging.info('Loaded the outputs of %s from the cache.',
+                 transform.full_label)
+    return True
+
+  def finish_transform(self, transform):
+    fingerprint = self.fingerprint(transform)
+    if fingerprint is None or fingerprint in self._stored:
+      return
+    outputs = [(tag, value) for (transform_id, tag), value
+               in self._cache.iteritems() if transform_id == id(transform)]
+    if not all(isinstance(value, list) for _, value in outputs):
+      return
+    path = self._entry_path(fingerprint)
+    try:
+      self._write_entry(path, outputs)
+    except Exception:  # pylint: disable=broad-except
+      logging.info('Not caching the outputs of %s: cannot encode outputs.',
+                   transform.full_label, exc_info=True)
+      return
+    self._stored.add(fingerprint)
+    self._evict(keep=path)
+
+  def _write_record(self, f, encoded):
+    f.write(self._LENGTH.pack(len(encoded)))
+    f.write(encoded)
+
+  def _read_record(self, f):
+    header = f.read(self._LENGTH.size)
+    if len(header) != self._LENGTH.size:
+      raise EOFError('Truncated cache entry.')
+    return f.read(self._LENGTH.unpack(header)[0])
+
+  def _write_entry(self, path, outputs):
+    # Written to a temporary file first so that readers, possibly in other
+    # processes, never see a partial entry.
+    fd, temp_path = tempfile.mkstemp(dir=self._cache_dir, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        self._write_record(f, self._LENGTH.pack(len(outputs)))
+        for tag, value in outputs:
+          self._write_record(f, self._coder.encode(tag))
+          self._write_record(f, self._LENGTH.pack(len(value)))
+          for element in value:
+            self._write_record(f, self._coder.encode(element))
+      os.rename(temp_path, path)
+    except Exception:
+      os.remove(temp_path)
+      raise
+
+  def _read_entry(self, path):
+    outputs = []
+    with open(path, 'rb') as f:
+      num_outputs, = self._LENGTH.unpack(self._read_record(f))
+      for _ in xrange(num_outputs):
+        tag = self._coder.decode(self._read_record(f))
+        count, = self._LENGTH.unpack(self._read_record(f))
+        outputs.append(
+            (tag, [self._coder.decode(self._read_record(f))
+                   for _ in xrange(count)]))
+    # Reading an entry makes it the most recently used one.
+    os.utime(path, None)
+    return outputs
+
+  def _evict(self, keep):
+    """Removes the least recently used entries above the size limit."""
+    if self._max_bytes is None:
+      return
+    entries = []
+    for path in glob.glob(
+        os.path.join(self._cache_dir, '*' + self.ENTRY_SUFFIX)):
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total_bytes <= self._max_bytes:
+        break
+      if path == keep:
+        continue
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total_bytes -= size
+
 
 class PipelineState(object):
   """State of the Pipeline, as returned by PipelineResult.current_state().
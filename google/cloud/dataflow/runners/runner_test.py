@@ -19,14 +19,29 @@ the other unit tests. In this file we choose to test only aspects related to
 caching and clearing values that are not tested elsewhere.
 """
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
+from google.cloud.dataflow import error
 from google.cloud.dataflow.internal import apiclient
 from google.cloud.dataflow.pipeline import Pipeline
+from google.cloud.dataflow.pvalue import AsDict
+from google.cloud.dataflow.pvalue import AsIter
+from google.cloud.dataflow.pvalue import AsList
+from google.cloud.dataflow.pvalue import AsSingleton
+from google.cloud.dataflow.pvalue import SideOutputValue
 from google.cloud.dataflow.runners import create_runner
 from google.cloud.dataflow.runners import DataflowPipelineRunner
 from google.cloud.dataflow.runners import DirectPipelineRunner
+from google.cloud.dataflow.runners.runner import PersistentPValueCache
 import google.cloud.dataflow.transforms as ptransform
+from google.cloud.dataflow.transforms import DoFn
+from google.cloud.dataflow.transforms.core import GroupByKeyOnly
+from google.cloud.dataflow.transforms.util import assert_that
+from google.cloud.dataflow.transforms.util import equal_to
 from google.cloud.dataflow.utils.options import PipelineOptions
 
 
@@ -62,5 +77,201 @@ class RunnerTest(unittest.TestCase):
     super(DataflowPipelineRunner, remote_runner).run(p)
 
 
+class BundleMarkingDoFn(DoFn):
+  """Tags each element with the first element of its bundle."""
+
+  def start_bundle(self, context):
+    self.first = None
+    self.count = 0
+
+  def process(self, context):
+    if self.first is None:
+      self.first = context.element
+    self.count += 1
+    if context.element % 2:
+      yield SideOutputValue('odd', context.element)
+    yield (self.first, context.element)
+
+  def finish_bundle(self, context):
+    yield SideOutputValue('bundles', (self.first, self.count))
+
+
+class CountingDoFn(DoFn):
+  """Counts the elements it processes across all instances."""
+
+  processed = []
+
+  def process(self, context):
+    CountingDoFn.processed.append(context.element)
+    yield context.element
+
+
+class DirectPipelineRunnerTest(unittest.TestCase):
+
+  def run_pipeline(self, *args):
+    runner = DirectPipelineRunner()
+    p = Pipeline(runner, options=PipelineOptions(list(args)))
+    results = (p
+               | ptransform.Create('create', range(10))
+               | ptransform.ParDo('do', BundleMarkingDoFn()).with_outputs(
+                   'odd', 'bundles', main='main'))
+    grouped = results.main | ptransform.GroupByKey('gbk')
+    p.run()
+    return (
+        [wv.value for wv in runner.get_pvalue(results.main)],
+        [wv.value for wv in runner.get_pvalue(results.odd)],
+        [wv.value for wv in runner.get_pvalue(results.bundles)],
+        sorted((k, sorted(v)) for k, v in (
+            wv.value for wv in runner.get_pvalue(grouped))))
+
+  def test_single_process(self):
+    main, odd, bundles, grouped = self.run_pipeline()
+    self.assertEqual([(0, i) for i in range(10)], main)
+    self.assertEqual([1, 3, 5, 7, 9], odd)
+    self.assertEqual([(0, 10)], bundles)
+    self.assertEqual([(0, range(10))], grouped)
+
+  def test_multiple_processes(self):
+    main, odd, bundles, grouped = self.run_pipeline(
+        '--direct_num_workers=3', '--direct_bundle_size=4')
+    self.assertEqual([(i - i % 4, i) for i in range(10)], main)
+    self.assertEqual([1, 3, 5, 7, 9], odd)
+    self.assertEqual([(0, 4), (4, 4), (8, 2)], bundles)
+    self.assertEqual(
+        [(0, [0, 1, 2, 3]), (4, [4, 5, 6, 7]), (8, [8, 9])], grouped)
+
+  def test_pipelined_execution(self):
+    events = []
+
+    def record(name):
+      def fn(x):
+        events.append((name, x))
+        return x
+      return fn
+
+    runner = DirectPipelineRunner()
+    p = Pipeline(runner,
+                 options=PipelineOptions(['--direct_pipelined_execution']))
+    first = p | ptransform.Create('create', range(3)) | ptransform.Map(
+        'first', record('first'))
+    second = first | ptransform.Map('second', record('second'))
+    side = p | ptransform.Create('side', [10])
+    sums = (second
+            | ptransform.Map('pair', lambda x: (x % 2, x))
+            | ptransform.GroupByKey('gbk')
+            | ptransform.Map('sum', lambda (k, vs), s: (k, sum(vs) + s),
+                             AsSingleton(side)))
+    p.run()
+
+    # Each element went through the whole chain before the next was read.
+    self.assertEqual(
+        [('first', 0), ('second', 0), ('first', 1), ('second', 1),
+         ('first', 2), ('second', 2)],
+        events)
+    self.assertEqual([(0, 12), (1, 11)],
+                     sorted(wv.value for wv in runner.get_pvalue(sums)))
+    # Intermediate values were dropped once their consumers had run.
+    self.assertRaises(error.PValueError, runner.get_pvalue, first)
+    self.assertRaises(error.PValueError, runner.get_pvalue, second)
+    self.assertRaises(error.PValueError, runner.get_pvalue, side)
+
+  def test_group_by_key_spills_to_disk(self):
+    runner = DirectPipelineRunner()
+    # A budget of about a hundred bytes spills every few elements.
+    p = Pipeline(runner, options=PipelineOptions(
+        ['--direct_group_by_key_memory_mb=0.0001']))
+    grouped = (p
+               | ptransform.Create('create',
+                                   [(i % 3, 'v%d' % i) for i in range(50)])
+               | GroupByKeyOnly('gbk'))
+    p.run()
+
+    groups = sorted(wv.value for wv in runner.get_pvalue(grouped))
+    self.assertEqual([0, 1, 2], [k for k, _ in groups])
+    for k, values in groups:
+      self.assertFalse(isinstance(values, list))
+      expected = ['v%d' % i for i in range(k, 50, 3)]
+      # Values keep their input order and can be iterated more than once.
+      self.assertEqual(expected, list(values))
+      self.assertEqual(expected, list(values))
+      self.assertEqual(len(expected), len(values))
+
+  def test_side_input_views_are_shared(self):
+    seen = {}
+
+    def record(name):
+      def fn(unused_x, side):
+        seen[name] = side
+      return fn
+
+    p = Pipeline(DirectPipelineRunner())
+    main = p | ptransform.Create('main', [0])
+    side = p | ptransform.Create('side', [('a', 1), ('b', 2)])
+    main | ptransform.Map('iter1', record('iter1'), AsIter(side))
+    main | ptransform.Map('iter2', record('iter2'), AsIter(side))
+    main | ptransform.Map('list', record('list'), AsList(side))
+    main | ptransform.Map('dict1', record('dict1'), AsDict(side))
+    main | ptransform.Map(
+        'dict2', record('dict2'), AsDict(side, label='AsDict2'))
+    p.run()
+
+    self.assertEqual([('a', 1), ('b', 2)], list(seen['iter1']))
+    self.assertEqual([('a', 1), ('b', 2)], seen['list'])
+    self.assertEqual(('b', 2), seen['list'][1])
+    self.assertEqual({'a': 1, 'b': 2}, seen['dict1'])
+    # Every view of the side PCollection is built only once.
+    self.assertIs(seen['iter1'], seen['iter2'])
+    self.assertIs(seen['iter1'], seen['list'])
+    self.assertIs(seen['dict1'], seen['dict2'])
+
+  def test_list_side_input_is_a_list(self):
+    p = Pipeline(DirectPipelineRunner())
+    main = p | ptransform.Create('main', [0])
+    side = p | ptransform.Create('side', [1, 2, 3])
+    result = main | ptransform.Map(
+        'use', lambda x, s: (isinstance(s, list), s + [4], json.dumps(s)),
+        AsList(side))
+    assert_that(result, equal_to([(True, [1, 2, 3, 4], '[1, 2, 3]')]))
+    p.run()
+
+
+class PersistentPValueCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+    CountingDoFn.processed = []
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def run_pipeline(self, last_fn):
+    runner = DirectPipelineRunner()
+    p = Pipeline(runner, options=PipelineOptions(
+        ['--direct_cache_dir=%s' % self.cache_dir]))
+    last = (p
+            | ptransform.Create('create', [1, 2, 3])
+            | ptransform.ParDo('count', CountingDoFn())
+            | ptransform.Map('last', last_fn))
+    p.run()
+    return sorted(wv.value for wv in runner.get_pvalue(last))
+
+  def test_unchanged_transforms_are_loaded(self):
+    self.assertEqual([2, 3, 4], self.run_pipeline(lambda x: x + 1))
+    self.assertEqual([1, 2, 3], CountingDoFn.processed)
+    # Only the changed last step is recomputed in a new pipeline.
+    self.assertEqual([10, 20, 30], self.run_pipeline(lambda x: x * 10))
+    self.assertEqual([1, 2, 3], CountingDoFn.processed)
+
+  def test_eviction(self):
+    cache = PersistentPValueCache(self.cache_dir, max_bytes=1)
+    runner = DirectPipelineRunner(cache=cache)
+    p = Pipeline(runner)
+    p | ptransform.Create('create', [1, 2, 3]) | ptransform.Map(
+        'map', lambda x: x)
+    p.run()
+    # Every entry is above the limit, so only the last one written is kept.
+    self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+
 if __name__ == '__main__':
   unittest.main()
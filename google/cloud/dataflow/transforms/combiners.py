@@ -20,6 +20,7 @@ import heapq
 import itertools
 import random
 
+from google.cloud.dataflow.coders import coders
 from google.cloud.dataflow.transforms import core
 from google.cloud.dataflow.transforms import ptransform
 from google.cloud.dataflow.typehints import Any
@@ -125,6 +126,9 @@ class CountCombineFn(core.CombineFn):
   def extract_output(self, accumulator):
     return accumulator
 
+  def get_accumulator_coder(self):
+    return coders.VarIntCoder()
+
 
 class Top(object):
   """Combiners for obtaining extremal elements."""
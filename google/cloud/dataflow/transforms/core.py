@@ -23,6 +23,7 @@ import warnings
 
 from google.cloud.dataflow import pvalue
 from google.cloud.dataflow import typehints
+from google.cloud.dataflow.coders import coders
 from google.cloud.dataflow.coders import typecoders
 from google.cloud.dataflow.internal import util
 from google.cloud.dataflow.pvalue import AsIter
@@ -323,6 +324,14 @@ class CombineFn(WithTypeHints):
     """
     raise NotImplementedError(str(self))
 
+  def get_accumulator_coder(self):
+    """Returns a coder for the accumulators of this CombineFn.
+
+    The default pickles each accumulator. CombineFns whose accumulators are of
+    a known type should override this with a more compact coder.
+    """
+    return coders.PickleCoder()
+
   def apply(self, elements, *args, **kwargs):
     """Returns result of applying this CombineFn to the input values.
 
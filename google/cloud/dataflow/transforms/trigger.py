@@ -21,7 +21,9 @@ from abc import ABCMeta
 from abc import abstractmethod
 import collections
 import copy
+import heapq
 
+from google.cloud.dataflow.coders import coders
 from google.cloud.dataflow.transforms import combiners
 from google.cloud.dataflow.transforms import core
 from google.cloud.dataflow.transforms.window import GlobalWindow
@@ -43,53 +45,63 @@ class StateTag(object):
   The given tag must be unique for this stage.  If CombineFn is None then
   all elements will be returned as a list, otherwise the given CombineFn
   will be applied (possibly incrementally and eagerly) when adding elements.
+
+  The coder, if any, is used by backends which store state remotely to encode
+  the stored values; backends fall back to pickling when it is None.
   """
   __metaclass__ = ABCMeta
 
-  def __init__(self, tag):
+  def __init__(self, tag, coder=None):
     self.tag = tag
+    self.coder = coder
 
 
 class ValueStateTag(StateTag):
   """StateTag pointing to an element."""
 
   def __repr__(self):
-    return 'ValueStateTag(%s, %s)' % (self.tag, self.combine_fn)
+    return 'ValueStateTag(%s)' % self.tag
 
   def with_prefix(self, prefix):
-    return ValueStateTag(prefix + self.tag)
+    return ValueStateTag(prefix + self.tag, self.coder)
 
 
 class CombiningValueStateTag(StateTag):
-  """StateTag pointing to an element, accumulated with a combiner."""
+  """StateTag pointing to an element, accumulated with a combiner.
+
+  The coder encodes accumulators and defaults to the accumulator coder of the
+  combine_fn.
+  """
 
-  # TODO(robertwb): Also store the coder (perhaps extracted from the combine_fn)
-  def __init__(self, tag, combine_fn):
-    super(CombiningValueStateTag, self).__init__(tag)
+  def __init__(self, tag, combine_fn, coder=None):
     if not combine_fn:
       raise ValueError('combine_fn must be specified.')
     if not isinstance(combine_fn, core.CombineFn):
       combine_fn = core.CombineFn.from_callable(combine_fn)
+    if coder is None:
+      coder = combine_fn.get_accumulator_coder()
+    super(CombiningValueStateTag, self).__init__(tag, coder)
     self.combine_fn = combine_fn
 
   def __repr__(self):
     return 'CombiningValueStateTag(%s, %s)' % (self.tag, self.combine_fn)
 
   def with_prefix(self, prefix):
-    return CombiningValueStateTag(prefix + self.tag, self.combine_fn)
+    return CombiningValueStateTag(prefix + self.tag, self.combine_fn,
+                                  self.coder)
 
 
 class ListStateTag(StateTag):
   """StateTag pointing to a list of elements."""
 
-  def __init__(self, tag):
-    super(ListStateTag, self).__init__(tag)
+  def __init__(self, tag, coder=None):
+    super(ListStateTag, self).__init__(tag, coder)
 
   def __repr__(self):
     return 'ListStateTag(%s)' % self.tag
 
   def with_prefix(self, prefix):
-    return ListStateTag(prefix + self.tag)
+    return ListStateTag(prefix + self.tag, self.coder)
 
 
 # pylint: disable=unused-argument
@@ -536,6 +548,14 @@ class SimpleState(object):
   def clear_state(self, window, tag):
     pass
 
+  def prefetch_state(self, window, tag):
+    """Hints that the state at the given window and tag will be read.
+
+    Backends reading state remotely may fetch all hinted state together with
+    the next read; the default implementation ignores the hint.
+    """
+    pass
+
   def at(self, window):
     return TriggerContext(self, window)
 
@@ -553,20 +573,85 @@ class UnmergedState(SimpleState):
   @abstractmethod
   def get_global_state(self, tag, default=None):
     pass
+
+  @abstractmethod
+  def add_global_state(self, tag, value):
+    """Appends the given value to the global list state at the given tag."""
+    pass
+
+  @abstractmethod
+  def clear_global_state(self, tag):
+    pass
 # pylint: enable=unused-argument
 
 
+class _ConcatenatedIterable(object):
+  """An iterable over the values of several iterables, without copying them."""
+
+  def __init__(self, iterables):
+    self.iterables = iterables
+
+  def __iter__(self):
+    for iterable in self.iterables:
+      for value in iterable:
+        yield value
+
+
 class MergeableStateAdapter(SimpleState):
-  """Wraps a UnmergedState, tracking merged windows."""
+  """Wraps a UnmergedState, tracking merged windows.
+
+  The state of each window is stored under the ids of the windows merged into
+  it.  The ids of the windows are persisted as a log of (window, ids) entries,
+  each replacing the ids of its window, or removing the window if ids is empty,
+  so that adding or merging a window only appends to the log.  The log is
+  rewritten when read once it holds more than MAX_LOG_ENTRIES_PER_WINDOW
+  entries per window.
+
+  Earlier versions persisted all the window ids as a single {window: ids}
+  value; while the log is empty, such a value is moved to the log.
+  """
   # TODO(robertwb): A similar indirection could be used for sliding windows
   # or other window_fns when a single element typically belongs to many windows.
 
-  WINDOW_IDS = ValueStateTag('window_ids')
+  WINDOW_IDS = ListStateTag('window_id_log')
+  LEGACY_WINDOW_IDS = ValueStateTag('window_ids')
+  MAX_LOG_ENTRIES_PER_WINDOW = 2
 
-  def __init__(self, raw_state):
+  def __init__(self, raw_state, window_coder=None):
     self.raw_state = raw_state
-    self.window_ids = self.raw_state.get_global_state(self.WINDOW_IDS, {})
-    self.counter = None
+    if window_coder is None:
+      self.window_ids_tag = self.WINDOW_IDS
+    else:
+      self.window_ids_tag = ListStateTag(
+          self.WINDOW_IDS.tag,
+          coders.TupleCoder(
+              [window_coder, coders.ListCoder(coders.VarIntCoder())]))
+    self.window_ids = {}
+    num_log_entries = 0
+    for window, ids in self.raw_state.get_global_state(self.window_ids_tag, ()):
+      num_log_entries += 1
+      if ids:
+        self.window_ids[window] = list(ids)
+      else:
+        self.window_ids.pop(window, None)
+    if not num_log_entries:
+      legacy_window_ids = self.raw_state.get_global_state(
+          self.LEGACY_WINDOW_IDS)
+      if legacy_window_ids:
+        self.raw_state.clear_global_state(self.LEGACY_WINDOW_IDS)
+        for window, ids in legacy_window_ids.iteritems():
+          self.window_ids[window] = list(ids)
+          self._log_window_ids(window)
+    # The window each window id was merged into.
+    self.id_windows = dict((window_id, window)
+                           for window, ids in self.window_ids.iteritems()
+                           for window_id in ids)
+    self.counter = max(self.id_windows) if self.id_windows else 0
+    if num_log_entries > (
+        self.MAX_LOG_ENTRIES_PER_WINDOW * max(1, len(self.window_ids))):
+      self.raw_state.clear_global_state(self.window_ids_tag)
+      for window in self.window_ids:
+        self._log_window_ids(window)
 
   def set_timer(self, window, tag, timestamp):
     self.raw_state.set_timer(self._get_id(window), tag, timestamp)
@@ -582,8 +667,12 @@ class MergeableStateAdapter(SimpleState):
     self.raw_state.add_state(self._get_id(window), tag, value)
 
   def get_state(self, window, tag):
+    window_ids = self._get_ids(window)
+    if len(window_ids) > 1:
+      for window_id in window_ids:
+        self.raw_state.prefetch_state(window_id, tag)
     values = [self.raw_state.get_state(window_id, tag)
-              for window_id in self._get_ids(window)]
+              for window_id in window_ids]
     if isinstance(tag, ValueStateTag):
       raise ValueError(
           'Merging requested for non-mergeable state tag: %r.' % tag)
@@ -598,7 +687,9 @@ class MergeableStateAdapter(SimpleState):
         # TODO(robertwb): Store the merged value in the first tag.
       return tag.combine_fn.extract_output(accumulator)
     elif isinstance(tag, ListStateTag):
-      return [v for vs in values for v in vs]
+      if len(values) == 1:
+        return values[0]
+      return _ConcatenatedIterable(values)
     else:
       raise ValueError('Invalid tag.', tag)
 
@@ -606,28 +697,36 @@ class MergeableStateAdapter(SimpleState):
     for window_id in self._get_ids(window):
       self.raw_state.clear_state(window_id, tag)
     if tag is None:
-      del self.window_ids[window]
-      self._persist_window_ids()
+      for window_id in self.window_ids.pop(window):
+        del self.id_windows[window_id]
+      self._log_window_ids(window)
+
+  def prefetch_state(self, window, tag):
+    for window_id in self._get_ids(window):
+      self.raw_state.prefetch_state(window_id, tag)
 
   def merge(self, to_be_merged, merge_result):
+    merged = False
     for window in to_be_merged:
       if window != merge_result:
         if window in self.window_ids:
-          if merge_result in self.window_ids:
-            merge_window_ids = self.window_ids[merge_result]
-          else:
-            merge_window_ids = self.window_ids[merge_result] = []
-          merge_window_ids.extend(self.window_ids.pop(window))
-          self._persist_window_ids()
+          window_ids = self.window_ids.pop(window)
+          self.window_ids.setdefault(merge_result, []).extend(window_ids)
+          for window_id in window_ids:
+            self.id_windows[window_id] = merge_result
+          self._log_window_ids(window)
+          merged = True
+    if merged:
+      self._log_window_ids(merge_result)
 
   def known_windows(self):
     return self.window_ids.keys()
 
   def get_window(self, timer_id):
-    for window, ids in self.window_ids.items():
-      if timer_id in ids:
-        return window
-    raise ValueError('No window for %s' % timer_id)
+    window_id = self.raw_state.get_window(timer_id)
+    if window_id not in self.id_windows:
+      raise ValueError('No window for %s' % timer_id)
+    return self.id_windows[window_id]
 
   def _get_id(self, window):
     if window in self.window_ids:
@@ -635,7 +734,8 @@ class MergeableStateAdapter(SimpleState):
     else:
       window_id = self._get_next_counter()
       self.window_ids[window] = [window_id]
-      self._persist_window_ids()
+      self.id_windows[window_id] = window
+      self._log_window_ids(window)
       return window_id
 
   def _get_ids(self, window):
@@ -644,26 +744,25 @@ class MergeableStateAdapter(SimpleState):
   def _get_next_counter(self):
     if not self.window_ids:
       self.counter = 0
-    elif self.counter is None:
-      self.counter = max(k for ids in self.window_ids.values() for k in ids)
     self.counter += 1
     return self.counter
 
-  def _persist_window_ids(self):
-    self.raw_state.set_global_state(self.WINDOW_IDS, self.window_ids)
+  def _log_window_ids(self, window):
+    self.raw_state.add_global_state(
+        self.window_ids_tag, (window, self.window_ids.get(window, [])))
 
   def __repr__(self):
     return '\n\t'.join([repr(self.window_ids)] +
                        repr(self.raw_state).split('\n'))
 
 
-def create_trigger_driver(windowing, is_batch=False):
+def create_trigger_driver(windowing, is_batch=False, element_coder=None):
   # TODO(robertwb): We can do more if we know elements are in timestamp
   # sorted order.
   if windowing.is_default() and is_batch:
     return DefaultGlobalBatchTriggerDriver()
   else:
-    return GeneralTriggerDriver(windowing)
+    return GeneralTriggerDriver(windowing, element_coder)
 
 
 class TriggerDriver(object):
@@ -704,20 +803,26 @@ class DefaultGlobalBatchTriggerDriver(TriggerDriver):
 class GeneralTriggerDriver(TriggerDriver):
   """Breaks a series of bundle and timer firings into window (pane)s.
 
-  Suitable for all variants of Windowing.
+  Suitable for all variants of Windowing.  If an element_coder is given, the
+  elements of each window are stored encoded with it.
   """
   ELEMENTS = ListStateTag('elements')
   TOMBSTONE = CombiningValueStateTag('tombstone', combiners.CountCombineFn())
 
-  def __init__(self, windowing):
+  def __init__(self, windowing, element_coder=None):
     self.window_fn = windowing.windowfn
     self.trigger_fn = windowing.triggerfn
     self.accumulation_mode = windowing.accumulation_mode
     self.is_merging = True
+    if element_coder is not None:
+      self.ELEMENTS = ListStateTag(self.ELEMENTS.tag, element_coder)
+
+  def _mergeable_state(self, state):
+    return MergeableStateAdapter(state, self.window_fn.get_window_coder())
 
   def process_elements(self, windowed_values, state):
     if self.is_merging:
-      state = MergeableStateAdapter(state)
+      state = self._mergeable_state(state)
 
     windows_to_elements = collections.defaultdict(list)
     for wv in windowed_values:
@@ -752,6 +857,8 @@ class GeneralTriggerDriver(TriggerDriver):
         windows_to_elements = merged_windows_to_elements
 
     # Next handle element adding.
+    for window in windows_to_elements:
+      state.prefetch_state(window, self.TOMBSTONE)
     for window, values in windows_to_elements.items():
       if state.get_state(window, self.TOMBSTONE):
         continue
@@ -768,8 +875,16 @@ class GeneralTriggerDriver(TriggerDriver):
 
   def process_timer(self, timer_id, timestamp, unused_tag, state):
     if self.is_merging:
-      state = MergeableStateAdapter(state)
-    window = state.get_window(timer_id)
+      state = self._mergeable_state(state)
+      try:
+        window = state.get_window(timer_id)
+      except ValueError:
+        # The window of the timer was cleared since the timer was set.
+        return
+    else:
+      window = state.get_window(timer_id)
+    state.prefetch_state(window, self.TOMBSTONE)
+    state.prefetch_state(window, self.ELEMENTS)
     if state.get_state(window, self.TOMBSTONE):
       return
     if not self.is_merging or window in state.known_windows():
@@ -797,6 +912,11 @@ class InMemoryUnmergedState(UnmergedState):
   def __init__(self, defensive_copy=True):
     # TODO(robertwb): Skip defensive_copy in production if it's too expensive.
     self.timers = collections.defaultdict(dict)
+    # A heap of (timestamp, seq, window, tag) entries indexing the timers by
+    # timestamp.  Entries of timers that were cleared or set again are only
+    # dropped as they are popped, or when the heap is rebuilt.
+    self._timer_heap = []
+    self._timer_seq = 0
     self.state = collections.defaultdict(lambda: collections.defaultdict(list))
     self.global_state = {}
     self.defensive_copy = defensive_copy
@@ -810,11 +930,36 @@ class InMemoryUnmergedState(UnmergedState):
   def get_global_state(self, tag, default=None):
     return self.global_state.get(tag.tag, default)
 
+  def add_global_state(self, tag, value):
+    assert isinstance(tag, ListStateTag)
+    if self.defensive_copy:
+      value = copy.deepcopy(value)
+    self.global_state.setdefault(tag.tag, []).append(value)
+
+  def clear_global_state(self, tag):
+    self.global_state.pop(tag.tag, None)
+
   def set_timer(self, window, tag, timestamp):
     self.timers[window][tag] = timestamp
+    self._timer_seq += 1
+    heapq.heappush(self._timer_heap, (timestamp, self._timer_seq, window, tag))
+    if len(self._timer_heap) > 2 * len(self.timers) + 64:
+      self._rebuild_timer_heap()
 
   def clear_timer(self, window, tag):
-    self.timers[window].pop(tag, None)
+    timers = self.timers.get(window)
+    if timers is not None:
+      timers.pop(tag, None)
+      if not timers:
+        del self.timers[window]
+
+  def _rebuild_timer_heap(self):
+    self._timer_heap = []
+    for window, timers in self.timers.items():
+      for tag, timestamp in timers.items():
+        self._timer_seq += 1
+        self._timer_heap.append((timestamp, self._timer_seq, window, tag))
+    heapq.heapify(self._timer_heap)
 
   def get_window(self, timer_id):
     return timer_id
@@ -838,7 +983,8 @@ class InMemoryUnmergedState(UnmergedState):
     elif isinstance(tag, CombiningValueStateTag):
       return tag.combine_fn.apply(values)
     elif isinstance(tag, ListStateTag):
-      return values
+      # Copy, as the list may be added to while the returned value is in use.
+      return list(values)
     else:
       raise ValueError('Invalid tag.', tag)
 
@@ -849,12 +995,16 @@ class InMemoryUnmergedState(UnmergedState):
       self.state[window].pop(tag.tag, None)
 
   def get_and_clear_timers(self, watermark=float('inf')):
+    """Clears and returns the timers at or before watermark, in time order."""
     expired = []
-    for window, timers in list(self.timers.items()):
-      for tag, timestamp in list(timers.items()):
-        if timestamp <= watermark:
-          expired.append((window, (tag, timestamp)))
-          del timers[tag]
+    while self._timer_heap and self._timer_heap[0][0] <= watermark:
+      timestamp, _, window, tag = heapq.heappop(self._timer_heap)
+      timers = self.timers.get(window)
+      if timers is None or timers.get(tag) != timestamp:
+        # The timer was cleared, or set again with another timestamp.
+        continue
+      expired.append((window, (tag, timestamp)))
+      del timers[tag]
       if not timers:
         del self.timers[window]
     return expired
@@ -21,7 +21,9 @@ import unittest
 import yaml
 
 import google.cloud.dataflow as df
+from google.cloud.dataflow.coders import coders
 from google.cloud.dataflow.pipeline import Pipeline
+from google.cloud.dataflow.transforms.combiners import CountCombineFn
 from google.cloud.dataflow.transforms.core import Windowing
 from google.cloud.dataflow.transforms.trigger import AccumulationMode
 from google.cloud.dataflow.transforms.trigger import AfterAll
@@ -29,9 +31,12 @@ from google.cloud.dataflow.transforms.trigger import AfterCount
 from google.cloud.dataflow.transforms.trigger import AfterEach
 from google.cloud.dataflow.transforms.trigger import AfterFirst
 from google.cloud.dataflow.transforms.trigger import AfterWatermark
+from google.cloud.dataflow.transforms.trigger import CombiningValueStateTag
 from google.cloud.dataflow.transforms.trigger import DefaultTrigger
 from google.cloud.dataflow.transforms.trigger import GeneralTriggerDriver
 from google.cloud.dataflow.transforms.trigger import InMemoryUnmergedState
+from google.cloud.dataflow.transforms.trigger import ListStateTag
+from google.cloud.dataflow.transforms.trigger import MergeableStateAdapter
 from google.cloud.dataflow.transforms.trigger import Repeatedly
 from google.cloud.dataflow.transforms.util import assert_that, equal_to
 from google.cloud.dataflow.transforms.window import FixedWindows
@@ -347,6 +352,100 @@ class TriggerTest(unittest.TestCase):
         2)
 
 
+class StateTagTest(unittest.TestCase):
+
+  def test_combining_tag_uses_accumulator_coder(self):
+    tag = CombiningValueStateTag('count', CountCombineFn())
+    self.assertIsInstance(tag.coder, coders.VarIntCoder)
+    tag = CombiningValueStateTag('sum', sum)
+    self.assertIsInstance(tag.coder, coders.PickleCoder)
+
+  def test_with_prefix_keeps_coder(self):
+    coder = coders.StrUtf8Coder()
+    tag = ListStateTag('elements', coder).with_prefix('0_')
+    self.assertEqual('0_elements', tag.tag)
+    self.assertIs(coder, tag.coder)
+
+
+class MergeableStateAdapterTest(unittest.TestCase):
+
+  def test_window_ids_survive_reload(self):
+    raw_state = InMemoryUnmergedState()
+    state = MergeableStateAdapter(raw_state)
+    windows = [IntervalWindow(i, i + 10) for i in range(4)]
+    for window in windows:
+      state.add_state(window, ListStateTag('elements'), window.start)
+    state.merge(windows[:3], IntervalWindow(0, 12))
+    state.clear_state(windows[3], None)
+
+    state = MergeableStateAdapter(raw_state)
+    self.assertEqual([IntervalWindow(0, 12)], state.known_windows())
+    self.assertEqual([0, 1, 2], sorted(
+        state.get_state(IntervalWindow(0, 12), ListStateTag('elements'))))
+    self.assertEqual(IntervalWindow(0, 12), state.get_window(2))
+    self.assertRaises(ValueError, state.get_window, 4)
+
+  def test_window_ids_log_is_compacted(self):
+    raw_state = InMemoryUnmergedState()
+    merged = IntervalWindow(0, 100)
+    for i in range(10):
+      state = MergeableStateAdapter(raw_state)
+      state.add_state(IntervalWindow(i, i + 10), ListStateTag('elements'), i)
+      state.merge([merged, IntervalWindow(i, i + 10)], merged)
+    log = raw_state.get_global_state(MergeableStateAdapter.WINDOW_IDS)
+    self.assertLessEqual(
+        len(log), MergeableStateAdapter.MAX_LOG_ENTRIES_PER_WINDOW + 3)
+    state = MergeableStateAdapter(raw_state)
+    self.assertEqual([merged], state.known_windows())
+    self.assertEqual(range(10), sorted(
+        state.get_state(merged, ListStateTag('elements'))))
+
+  def test_legacy_window_ids_are_moved_to_the_log(self):
+    raw_state = InMemoryUnmergedState()
+    windows = [IntervalWindow(0, 12), IntervalWindow(20, 30)]
+    raw_state.set_global_state(MergeableStateAdapter.LEGACY_WINDOW_IDS,
+                               {windows[0]: [1, 2], windows[1]: [3]})
+    state = MergeableStateAdapter(raw_state)
+    self.assertEqual(sorted(windows), sorted(state.known_windows()))
+    self.assertEqual(windows[0], state.get_window(2))
+    self.assertIsNone(
+        raw_state.get_global_state(MergeableStateAdapter.LEGACY_WINDOW_IDS))
+    # New windows get ids that were not used yet.
+    state.add_state(IntervalWindow(40, 50), ListStateTag('elements'), 40)
+    self.assertEqual(IntervalWindow(40, 50), state.get_window(4))
+
+    state = MergeableStateAdapter(raw_state)
+    self.assertEqual(3, len(state.known_windows()))
+    self.assertEqual(windows[1], state.get_window(3))
+
+
+
+class InMemoryUnmergedStateTest(unittest.TestCase):
+
+  def test_timers(self):
+    state = InMemoryUnmergedState()
+    state.set_timer('w1', 'a', 30)
+    state.set_timer('w2', 'a', 10)
+    state.set_timer('w1', 'b', 20)
+    state.set_timer('w2', 'a', 40)  # Resets the timer.
+    state.set_timer('w3', 'a', 5)
+    state.clear_timer('w3', 'a')
+    self.assertEqual([('w1', ('b', 20))], state.get_and_clear_timers(25))
+    self.assertEqual([('w1', ('a', 30)), ('w2', ('a', 40))],
+                     state.get_and_clear_timers())
+    self.assertFalse(state.timers)
+
+  def test_many_timers(self):
+    state = InMemoryUnmergedState()
+    for i in range(1000):
+      state.set_timer(i, '', 1000 - i)
+      if i % 2:
+        state.clear_timer(i, '')
+    expired = state.get_and_clear_timers(500)
+    self.assertEqual(range(998, 499, -2), [window for window, _ in expired])
+    self.assertEqual(250, len(state.get_and_clear_timers()))
+
+
 class TriggerPipelineTest(unittest.TestCase):
 
   def test_after_count(self):
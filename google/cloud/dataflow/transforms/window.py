@@ -45,6 +45,16 @@ MIN_TIMESTAMP = float('-Inf')
 MAX_TIMESTAMP = float('Inf')
 
 
+def _coders():
+  """Returns the coders module.
+
+  It is imported on first use since the coders import this module.
+  """
+  # pylint: disable=g-import-not-at-top
+  from google.cloud.dataflow.coders import coders
+  return coders
+
+
 class WindowFn(object):
   """An abstract windowing function defining a basic assign and merge."""
 
@@ -73,6 +83,14 @@ class WindowFn(object):
     """Returns a window that is the result of merging a set of windows."""
     raise NotImplementedError
 
+  def get_window_coder(self):
+    """Returns a coder for the windows assigned by this windowing function.
+
+    The default pickles each window. Windowing functions assigning windows of a
+    known type should override this with a compact, deterministic coder.
+    """
+    return _coders().PickleCoder()
+
 
 class BoundedWindow(object):
   """A window for timestamps in range (-infinity, end).
@@ -211,6 +229,9 @@ class GlobalWindows(WindowFn):
   def merge(self, merge_context):
     pass  # No merging.
 
+  def get_window_coder(self):
+    return _coders().GlobalWindowCoder()
+
   def __hash__(self):
     return hash(type(self))
 
@@ -251,6 +272,9 @@ class FixedWindows(WindowFn):
   def merge(self, merge_context):
     pass  # No merging.
 
+  def get_window_coder(self):
+    return _coders().IntervalWindowCoder()
+
 
 class SlidingWindows(WindowFn):
   """A windowing function that assigns each element to a set of sliding windows.
@@ -284,6 +308,9 @@ class SlidingWindows(WindowFn):
   def merge(self, merge_context):
     pass  # No merging.
 
+  def get_window_coder(self):
+    return _coders().IntervalWindowCoder()
+
 
 class Sessions(WindowFn):
   """A windowing function that groups elements into sessions.
@@ -304,6 +331,9 @@ class Sessions(WindowFn):
     timestamp = context.timestamp
     return [IntervalWindow(timestamp, timestamp + self.gap_size)]
 
+  def get_window_coder(self):
+    return _coders().IntervalWindowCoder()
+
   def merge(self, merge_context):
     to_merge = []
     for w in sorted(merge_context.windows, key=lambda w: w.start):
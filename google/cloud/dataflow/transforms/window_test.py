@@ -16,6 +16,7 @@
 
 import unittest
 
+from google.cloud.dataflow import coders
 from google.cloud.dataflow.pipeline import Pipeline
 from google.cloud.dataflow.transforms import CombinePerKey
 from google.cloud.dataflow.transforms import combiners
@@ -84,6 +85,16 @@ class WindowTest(unittest.TestCase):
     self.assertEqual(expected, windowfn.assign(context('v', 8, [])))
     self.assertEqual(expected, windowfn.assign(context('v', 11, [])))
 
+  def test_window_coders(self):
+    self.assertEqual(coders.GlobalWindowCoder(),
+                     window.GlobalWindows().get_window_coder())
+    for windowfn in (FixedWindows(10), SlidingWindows(10, 5), Sessions(10)):
+      coder = windowfn.get_window_coder()
+      self.assertEqual(coders.IntervalWindowCoder(), coder)
+      windows = windowfn.assign(context('v', 7, []))
+      self.assertEqual(windows,
+                       [coder.decode(coder.encode(w)) for w in windows])
+
   def test_sessions_merging(self):
     windowfn = Sessions(10)
 
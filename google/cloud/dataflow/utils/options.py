@@ -274,6 +274,59 @@ class DebugOptions(PipelineOptions):
                         help='Debug file to write the workflow specification.')
 
 
+class DirectOptions(PipelineOptions):
+
+  @classmethod
+  def _add_argparse_args(cls, parser):
+    parser.add_argument(
+        '--direct_num_workers',
+        type=int,
+        default=1,
+        help=('Number of worker processes the DirectPipelineRunner uses to '
+              'execute ParDo and GroupByKey steps. The default of 1 runs '
+              'everything in the main process.'))
+    parser.add_argument(
+        '--direct_bundle_size',
+        type=int,
+        default=None,
+        help=('Number of elements per bundle when the DirectPipelineRunner '
+              'runs with more than one worker process. If not set, each '
+              'input is split into a few bundles per worker.'))
+    parser.add_argument(
+        '--direct_pipelined_execution',
+        default=False,
+        action='store_true',
+        help=('Stream elements through the DirectPipelineRunner instead of '
+              'materializing every PCollection. Only PCollections read by '
+              'several transforms, used as side inputs or not read by any '
+              'transform are kept in memory, and intermediate PCollections '
+              'are freed once all their consumers have run.'))
+    parser.add_argument(
+        '--direct_group_by_key_memory_mb',
+        type=float,
+        default=None,
+        help=('Memory budget, in megabytes of encoded keys and values, for '
+              'each GroupByKey run by the DirectPipelineRunner in the main '
+              'process. Once exceeded, the buffered elements are sorted and '
+              'spilled to local temporary files which are merged afterwards. '
+              'If not set, every GroupByKey is done in memory.'))
+    parser.add_argument(
+        '--direct_cache_dir',
+        default=None,
+        help=('Local directory in which the DirectPipelineRunner stores the '
+              'outputs of every transform, keyed by a fingerprint of the '
+              'transform and of its upstream transforms. Transforms that are '
+              'unchanged since a previous run load their outputs from there '
+              'instead of being recomputed.'))
+    parser.add_argument(
+        '--direct_cache_max_mb',
+        type=float,
+        default=None,
+        help=('Maximum size of the --direct_cache_dir directory, above which '
+              'the least recently used entries are removed. If not set, '
+              'entries are never removed.'))
+
+
 class SetupOptions(PipelineOptions):
 
   @classmethod
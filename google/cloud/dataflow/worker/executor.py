@@ -15,9 +15,11 @@
 """Worker operations executor."""
 
 import collections
+import heapq
 import itertools
 import logging
 import random
+import sys
 
 
 from google.cloud.dataflow.internal import pickler
@@ -53,13 +55,34 @@ class Operation(object):
     """
     self.spec = spec
     self.receivers = collections.defaultdict(list)
+    # The coders of the outputs, if known, used to measure output elements.
+    self.output_coders = None
+    # The fns unpickled by previous executions of the map task, if any.
+    self.fn_cache = None
     # Initially we have no counters.  Initializing this here makes it
     # safe to call itercounters() at any time, even if start() has
     # not been called yet.
     self.counters = collections.defaultdict(self.new_operation_counters)
 
   def new_operation_counters(self, output_index=0):
-    return opcounters.OperationCounters(self.step_name, output_index)
+    coder = None
+    if self.output_coders and output_index < len(self.output_coders):
+      coder = self.output_coders[output_index]
+    return opcounters.OperationCounters(self.step_name, output_index, coder)
+
+  def load_fn(self, serialized_fn):
+    """Unpickles one of the serialized objects of the operation's spec.
+
+    If the operation has an fn_cache, the unpickled object is stored there
+    and reused by later executions of the same map task.
+    """
+    if self.fn_cache is None:
+      return pickler.loads(serialized_fn)
+    key = self.step_name, serialized_fn
+    fn = self.fn_cache.get(key)
+    if fn is None:
+      fn = self.fn_cache[key] = pickler.loads(serialized_fn)
+    return fn
 
   def start(self):
     # If the operation has receivers, create one counter set per receiver.
@@ -74,6 +97,11 @@ class Operation(object):
   def finish(self):
     pass
 
+  def process_batch(self, batch):
+    """Processes a list of elements, as process() would one at a time."""
+    for o in batch:
+      self.process(o)
+
   def add_receiver(self, operation, output_index=0):
     """Adds a receiver operation for the specified output."""
     self.receivers[output_index].append(operation)
@@ -291,13 +319,20 @@ class ShuffleWriteOperation(Operation):
     if self.shuffle_sink is None:
       self.shuffle_sink = shuffle.ShuffleSink(
           self.spec.shuffle_writer_config, coder=self.spec.coders)
-    self.writer = self.shuffle_sink.writer()
+    self.writer = self.shuffle_sink.writer(counter_prefix=self.step_name)
     self.writer.__enter__()
 
   def finish(self):
     logging.debug('Finishing %s', self)
     self.writer.__exit__(None, None, None)
 
+  def itercounters(self):
+    for counter in super(ShuffleWriteOperation, self).itercounters():
+      yield counter
+    if self.writer is not None:
+      for counter in self.writer.itercounters():
+        yield counter
+
   def process(self, o):
     logging.debug('Processing [%s] in %s', o, self)
     assert isinstance(o, WindowedValue)
@@ -389,7 +424,7 @@ class DoOperation(Operation):
 
     # See fn_data in dataflow_runner.py
     fn, args, kwargs, tags_and_types, window_fn = (
-        pickler.loads(self.spec.serialized_fn))
+        self.load_fn(self.spec.serialized_fn))
 
     self.state.step_name = self.step_name
 
@@ -425,50 +460,65 @@ class DoOperation(Operation):
         logger, self.step_name)
 
     self.dofn_runner.start()
+    # The logging context is entered once for the whole bundle rather than
+    # for each element.
+    self._logging_context = logger.PerThreadLoggingContext(
+        step_name=self.step_name)
+    self._logging_context.__enter__()
 
   def finish(self):
-    self.dofn_runner.finish()
+    try:
+      self.dofn_runner.finish()
+    finally:
+      self._logging_context.__exit__(None, None, None)
 
   def process(self, o):
-    with logger.PerThreadLoggingContext(step_name=self.step_name):
-      self.dofn_runner.process(o)
+    self.dofn_runner.process(o)
 
+  def process_batch(self, batch):
+    process = self.dofn_runner.process
+    for o in batch:
+      process(o)
 
-class CombineOperation(Operation):
-  """A Combine operation executing a CombineFn for each input element."""
 
-  def __init__(self, spec):
-    super(CombineOperation, self).__init__(spec)
-    # Combiners do not accept deferred side-inputs (the ignored fourth argument)
-    # and therefore the code to handle the extra args/kwargs is simpler than for
-    # the DoFn's of ParDo.
-    fn, args, kwargs = pickler.loads(self.spec.serialized_fn)[:3]
+def curry_combine_fn(fn, args, kwargs):
+  """Returns a CombineFn calling fn with the given extra arguments."""
+  if not args and not kwargs:
+    return fn
 
-    if not args and not kwargs:
-      self.combine_fn = fn
-    else:
+  class CurriedFn(ptransform.CombineFn):
 
-      class CurriedFn(ptransform.CombineFn):
+    def create_accumulator(self):
+      return fn.create_accumulator(*args, **kwargs)
 
-        def create_accumulator(self):
-          return fn.create_accumulator(*args, **kwargs)
+    def add_input(self, accumulator, element):
+      return fn.add_input(accumulator, element, *args, **kwargs)
 
-        def add_input(self, accumulator, element):
-          return fn.add_input(accumulator, element, *args, **kwargs)
+    def add_inputs(self, accumulator, elements):
+      return fn.add_inputs(accumulator, elements, *args, **kwargs)
 
-        def add_inputs(self, accumulator, elements):
-          return fn.add_inputs(accumulator, elements, *args, **kwargs)
+    def merge_accumulators(self, accumulators):
+      return fn.merge_accumulators(accumulators, *args, **kwargs)
 
-        def merge_accumulators(self, accumulators):
-          return fn.merge_accumulators(accumulators, *args, **kwargs)
+    def extract_output(self, accumulator):
+      return fn.extract_output(accumulator, *args, **kwargs)
 
-        def extract_output(self, accumulator):
-          return fn.extract_output(accumulator, *args, **kwargs)
+    def apply(self, elements):
+      return fn.apply(elements, *args, **kwargs)
 
-        def apply(self, elements):
-          return fn.apply(elements, *args, **kwargs)
+  return CurriedFn()
 
-      self.combine_fn = CurriedFn()
+
+class CombineOperation(Operation):
+  """A Combine operation executing a CombineFn for each input element."""
+
+  def start(self):
+    super(CombineOperation, self).start()
+    # Combiners do not accept deferred side-inputs (the ignored fourth argument)
+    # and therefore the code to handle the extra args/kwargs is simpler than for
+    # the DoFn's of ParDo.
+    self.combine_fn = curry_combine_fn(
+        *self.load_fn(self.spec.serialized_fn)[:3])
 
     if self.spec.phase == 'all':
       self.apply = self.full_combine
@@ -508,42 +558,134 @@ class CombineOperation(Operation):
     return self.combine_fn.extract_output(accumulator)
 
 
+def _estimate_size(value):
+  """Estimates the memory held by a value and the containers it holds."""
+  if isinstance(value, (list, tuple, set, frozenset)):
+    return sys.getsizeof(value) + sum(_estimate_size(v) for v in value)
+  elif isinstance(value, dict):
+    return sys.getsizeof(value) + sum(
+        _estimate_size(k) + _estimate_size(v) for k, v in value.iteritems())
+  return sys.getsizeof(value)
+
+
 class PGBKOperation(Operation):
   """Partial group-by-key operation.
 
   This takes (windowed) input (key, value) tuples and outputs
   (key, [value]) tuples, performing a best effort group-by-key for
-  values in this bundle, memory permitting.
+  values in this bundle, memory permitting. If the spec carries a
+  combine_fn, values are instead added to an accumulator per key and window
+  as they arrive and (key, accumulator) tuples are output.
+
+  The table is bounded by the estimated size of its entries in bytes. Keys and
+  values are sized recursively; accumulators are sized by their encoding with
+  the accumulator coder of the combine_fn, measured again each time the number
+  of values added to them doubles. When the table outgrows max_size, the least
+  recently hit entries are output until its size is back under 90% of
+  max_size.
   """
 
-  def __init__(self, spec):
+  # The default bound on the estimated size of the table, in bytes.
+  DEFAULT_MAX_SIZE = 32 << 20
+  # The estimated size of a table entry, not counting its key and values.
+  ENTRY_OVERHEAD = 200
+
+  def __init__(self, spec, max_size=DEFAULT_MAX_SIZE):
     super(PGBKOperation, self).__init__(spec)
-    self.table = collections.defaultdict(list)
+    # Maps (key, windows) to [timestamp, values or accumulator, size, hit,
+    # number of values, last measured size of the accumulator].
+    self.table = {}
     self.size = 0
-    # TODO(robertwb) Make this configurable.
-    self.max_size = 10000
+    self.max_size = max_size
+    # Incremented on every element, so that the entries can be ordered by
+    # their last hit.
+    self.clock = 0
+
+  def start(self):
+    super(PGBKOperation, self).start()
+    if self.spec.combine_fn:
+      fn, args, kwargs = self.load_fn(self.spec.combine_fn)[:3]
+      self.combine_fn = curry_combine_fn(fn, args, kwargs)
+      self.accumulator_coder = fn.get_accumulator_coder()
+      # CombineFns may implement add_inputs rather than add_input.
+      if (type(fn).add_input.im_func is
+          ptransform.CombineFn.add_input.im_func):
+        self.add_input = lambda a, v: self.combine_fn.add_inputs(a, [v])
+      else:
+        self.add_input = self.combine_fn.add_input
+    else:
+      self.combine_fn = None
 
   def process(self, o):
     # TODO(robertwb): Structural (hashable) values.
-    key = o.value[0], tuple(o.windows)
-    self.table[key].append(o)
-    self.size += 1
+    key, value = o.value
+    kw = key, tuple(o.windows)
+    self.clock += 1
+    entry = self.table.get(kw)
+    if entry is None:
+      entry = self.table[kw] = [
+          o.timestamp,
+          [] if self.combine_fn is None
+          else self.combine_fn.create_accumulator(),
+          self.ENTRY_OVERHEAD + _estimate_size(key),
+          0,
+          0,
+          0]
+      self.size += entry[2]
+    entry[3] = self.clock
+    entry[4] += 1
+    if self.combine_fn is None:
+      entry[1].append(value)
+      value_size = _estimate_size(value) + 8  # Include the list slot.
+    else:
+      entry[1] = self.add_input(entry[1], value)
+      # Accumulators are measured again only as the number of values added to
+      # them doubles, bounding the cost of encoding them.
+      if entry[4] & (entry[4] - 1):
+        value_size = 0
+      else:
+        accumulator_size = self._estimate_accumulator_size(entry[1])
+        value_size = accumulator_size - entry[5]
+        entry[5] = accumulator_size
+    entry[2] += value_size
+    self.size += value_size
     if self.size > self.max_size:
       self.flush(9 * self.max_size // 10)
 
+  def _estimate_accumulator_size(self, accumulator):
+    if self.accumulator_coder is not None:
+      try:
+        return self.accumulator_coder.estimate_size(accumulator)
+      except Exception:  # pylint: disable=broad-except
+        logging.warning('Cannot estimate sizes with coder %s; approximating '
+                        'them instead.', self.accumulator_coder, exc_info=True)
+        self.accumulator_coder = None
+    return _estimate_size(accumulator)
+
   def finish(self):
     self.flush(0)
 
   def flush(self, target):
-    limit = self.size - target
-    for ix, (kw, vs) in enumerate(self.table.items()):
-      if ix >= limit:
-        break
-      del self.table[kw]
-      key, windows = kw
-      windowed_value = WindowedValue(
-          (key, [v.value[1] for v in vs]),
-          vs[0].timestamp, windows)
+    """Outputs table entries until their estimated size is at most target."""
+    if target <= 0:
+      evicted = self.table.items()
+      self.table = {}
+      self.size = 0
+    else:
+      evicted = []
+      while self.size > target:
+        # Select the least recently hit entries a tenth of the table at a time
+        # rather than sorting the whole table.
+        for kw, entry in heapq.nsmallest(len(self.table) // 10 + 1,
+                                         self.table.iteritems(),
+                                         key=lambda item: item[1][3]):
+          if self.size <= target:
+            break
+          del self.table[kw]
+          self.size -= entry[2]
+          evicted.append((kw, entry))
+    for (key, windows), (timestamp, values, _, _, _, _) in evicted:
+      windowed_value = WindowedValue((key, values), timestamp, windows)
       for receiver in self.receivers[0]:
         self.counters[0].update(windowed_value)
         receiver.process(windowed_value)
@@ -564,6 +706,16 @@ class FlattenOperation(Operation):
       self.counters[0].update(windowed_result)
       receiver.process(windowed_result)
 
+  def process_batch(self, batch):
+    logging.debug('Processing %d elements in %s', len(batch), self)
+    receivers = self.receivers[0]
+    counters = self.counters[0]
+    for o in batch:
+      windowed_result = WindowedValue(o.value, o.timestamp, o.windows)
+      for receiver in receivers:
+        counters.update(windowed_result)
+        receiver.process(windowed_result)
+
 
 class ReifyTimestampAndWindowsOperation(Operation):
   """ReifyTimestampAndWindows operation.
@@ -590,6 +742,102 @@ class ReifyTimestampAndWindowsOperation(Operation):
       self.counters[0].update(windowed_result)
       receiver.process(windowed_result)
 
+  def process_batch(self, batch):
+    logging.debug('Processing %d elements in %s', len(batch), self)
+    receivers = self.receivers[0]
+    counters = self.counters[0]
+    for o in batch:
+      k, v = o.value
+      windowed_result = window.WindowedValue(
+          (k, window.WindowedValue(v, o.timestamp, o.windows)),
+          o.timestamp, o.windows)
+      for receiver in receivers:
+        counters.update(windowed_result)
+        receiver.process(windowed_result)
+
+
+class OutputBuffer(object):
+  """A receiver passing the values given to it on to an operation in batches.
+
+  The values are passed on to the process_batch() method of the operation
+  once max_size of them are collected, or when flush() is called.
+  """
+
+  def __init__(self, operation, max_size):
+    self.operation = operation
+    self.max_size = max_size
+    self.values = []
+
+  def process(self, o):
+    self.values.append(o)
+    if len(self.values) >= self.max_size:
+      self.flush()
+
+  def flush(self):
+    """Passes the values collected so far on to the operation."""
+    if self.values:
+      values, self.values = self.values, []
+      self.operation.process_batch(values)
+
+  def str_internal(self, is_recursive=False):
+    return '<%s>' % self.__class__.__name__
+
+
+class FusedOperation(object):
+  """A linear chain of operations processing elements in micro-batches.
+
+  Each operation of the chain but the last has the next one as its only
+  receiver and no other receivers. The outputs of each of these operations
+  are collected into an OutputBuffer which passes them on to the next
+  operation every BATCH_SIZE outputs, rather than one at a time. Elements
+  passed to process() are buffered too, and every BATCH_SIZE elements the
+  batch runs through the operations, the buffers being flushed in turn.
+  """
+
+  BATCH_SIZE = 100
+
+  def __init__(self, operations):
+    self.operations = operations
+    self._buffers = []
+    for op, next_op in zip(operations, operations[1:]):
+      output_buffer = OutputBuffer(next_op, self.BATCH_SIZE)
+      op.receivers[0] = [output_buffer]
+      self._buffers.append(output_buffer)
+    self._batch = []
+
+  def __str__(self):
+    return self.str_internal()
+
+  def str_internal(self, is_recursive=False):
+    return '<%s [%s]>' % (self.__class__.__name__, ', '.join(
+        op.str_internal(is_recursive=True) for op in self.operations))
+
+  def start(self):
+    for op in reversed(self.operations):
+      op.start()
+
+  def process(self, o):
+    self._batch.append(o)
+    if len(self._batch) >= self.BATCH_SIZE:
+      self._process_batch()
+
+  def _process_batch(self):
+    batch, self._batch = self._batch, []
+    self.operations[0].process_batch(batch)
+    # Flushing a buffer may add outputs to the buffers after it.
+    for output_buffer in self._buffers:
+      output_buffer.flush()
+
+  def finish(self):
+    if self._batch:
+      self._process_batch()
+    for ix, op in enumerate(self.operations):
+      # Outputs emitted while finishing are processed by the next operation
+      # before it is finished in turn.
+      op.finish()
+      for output_buffer in self._buffers[ix:]:
+        output_buffer.flush()
+
 
 class BatchGroupAlsoByWindowsOperation(Operation):
   """BatchGroupAlsoByWindowsOperation operation.
@@ -599,7 +847,10 @@ class BatchGroupAlsoByWindowsOperation(Operation):
 
   def __init__(self, spec):
     super(BatchGroupAlsoByWindowsOperation, self).__init__(spec)
-    self.windowing = pickler.loads(self.spec.window_fn)
+
+  def start(self):
+    super(BatchGroupAlsoByWindowsOperation, self).start()
+    self.windowing = self.load_fn(self.spec.window_fn)
 
   def process(self, o):
     """Process a given value."""
@@ -633,18 +884,27 @@ class StreamingGroupAlsoByWindowsOperation(Operation):
 
   def __init__(self, spec):
     super(StreamingGroupAlsoByWindowsOperation, self).__init__(spec)
-    self.windowing = pickler.loads(self.spec.window_fn)
+
+  def start(self):
+    super(StreamingGroupAlsoByWindowsOperation, self).start()
+    self.windowing = self.load_fn(self.spec.window_fn)
 
   def process(self, o):
     logging.debug('Processing [%s] in %s', o, self)
     assert isinstance(o, WindowedValue)
     keyed_work = o.value
-    driver = trigger.create_trigger_driver(self.windowing)
+    driver = trigger.create_trigger_driver(
+        self.windowing, element_coder=keyed_work.coder.value_coder())
     state = self.spec.context.state
     for out_window, values in driver.process_elements(keyed_work.elements(),
                                                       state):
       self.output(window.WindowedValue((keyed_work.key, values),
                                        out_window.end, [out_window]))
+    for timer_id, timestamp in keyed_work.timers():
+      for out_window, values in driver.process_timer(timer_id, timestamp, None,
+                                                     state):
+        self.output(window.WindowedValue((keyed_work.key, values),
+                                         out_window.end, [out_window]))
 
   def output(self, windowed_result):
     for receiver in self.receivers[0]:
@@ -652,6 +912,11 @@ class StreamingGroupAlsoByWindowsOperation(Operation):
       receiver.process(windowed_result)
 
 
+# The operations that may be fused into a FusedOperation.
+FUSABLE_OPERATIONS = (DoOperation, FlattenOperation,
+                      ReifyTimestampAndWindowsOperation)
+
+
 class MapTaskExecutor(object):
   """A class for executing map tasks.
 
@@ -763,14 +1028,63 @@ class MapTaskExecutor(object):
     if map_task.step_names is not None:
       for ix, op in enumerate(self._ops):
         op.step_name = map_task.step_names[ix]
+    if map_task.output_coders is not None:
+      for ix, op in enumerate(self._ops):
+        op.output_coders = map_task.output_coders[ix]
+    for op in self._ops:
+      op.fn_cache = map_task.fn_cache
 
     # Attach the ops back to the map_task, so we can report their counters.
     map_task.executed_operations = self._ops
 
-    ix = len(self._ops)
-    for op in reversed(self._ops):
+    ops = self._fuse_operations()
+    ix = len(ops)
+    for op in reversed(ops):
       ix -= 1
       logging.debug('Starting op %d %s', ix, op)
       op.start()
-    for op in self._ops:
+    for op in ops:
       op.finish()
+
+  def _fuse_operations(self):
+    """Returns the operations to run, with linear chains of them fused.
+
+    A chain is made of operations of the FUSABLE_OPERATIONS types, each of
+    which but the last having the next one as its only receiver, and each of
+    which but the first having the previous one as its only input. The
+    operations of a chain are replaced by a FusedOperation at the place of
+    the first one, which is also substituted for it in the receivers of its
+    producer.
+    """
+    def sole_receiver(op):
+      outputs = [(index, ops) for index, ops in op.receivers.items() if ops]
+      if len(outputs) == 1 and outputs[0][0] == 0 and len(outputs[0][1]) == 1:
+        return outputs[0][1][0]
+
+    def inputs(op):
+      if hasattr(op.spec, 'input'):
+        return [op.spec.input]
+      return getattr(op.spec, 'inputs', [])
+
+    fused = set()
+    ops = []
+    for op in self._ops:
+      if op in fused:
+        continue
+      chain = [op]
+      if isinstance(op, FUSABLE_OPERATIONS) and len(inputs(op)) == 1:
+        receiver = sole_receiver(op)
+        while (isinstance(receiver, FUSABLE_OPERATIONS) and
+               len(inputs(receiver)) == 1):
+          chain.append(receiver)
+          receiver = sole_receiver(receiver)
+      if len(chain) == 1:
+        ops.append(op)
+        continue
+      fused_op = FusedOperation(chain)
+      fused.update(chain)
+      producer, index = inputs(op)[0]
+      producer_receivers = self._ops[producer].receivers[index]
+      producer_receivers[producer_receivers.index(op)] = fused_op
+      ops.append(fused_op)
+    return ops
@@ -14,6 +14,7 @@
 
 """Tests for work item executor functionality."""
 
+import collections
 import logging
 import tempfile
 import unittest
@@ -24,10 +25,12 @@ from google.cloud.dataflow.internal import util
 from google.cloud.dataflow.io import bigquery
 from google.cloud.dataflow.io import fileio
 import google.cloud.dataflow.transforms as ptransform
+from google.cloud.dataflow.transforms import combiners
 from google.cloud.dataflow.transforms import core
 from google.cloud.dataflow.transforms import window
 from google.cloud.dataflow.worker import executor
 from google.cloud.dataflow.worker import inmemory
+from google.cloud.dataflow.worker import logger
 from google.cloud.dataflow.worker import maptask
 import mock
 
@@ -76,6 +79,32 @@ class DoFnUsingStartBundle(ptransform.DoFn):
       f.write('finish called.')
 
 
+class BundleMarkingDoFn(ptransform.DoFn):
+  """A DoFn class outputting markers when starting and finishing bundles."""
+
+  def start_bundle(self, context, *args, **kwargs):
+    return ['start']
+
+  def process(self, context, *args, **kwargs):
+    return [context.element]
+
+  def finish_bundle(self, context, *args, **kwargs):
+    return ['finish']
+
+
+class BundleCountingDoFn(ptransform.DoFn):
+  """A DoFn class outputting the number of bundles it has started."""
+
+  def __init__(self):
+    self.bundles = 0
+
+  def start_bundle(self, context, *args, **kwargs):
+    self.bundles += 1
+
+  def process(self, context, *args, **kwargs):
+    return [(self.bundles, context.element)]
+
+
 class ProgressRequestRecordingInMemoryReader(inmemory.InMemoryReader):
 
   def __init__(self, source):
@@ -315,6 +344,131 @@ class ExecutorTest(unittest.TestCase):
     # only the first element appended.
     self.assertEqual(['abc:x', 'def:x', 'ghi:x'], output_buffer)
 
+  def test_fused_operations(self):
+    elements = range(250)
+    output_buffer = []
+    map_task = make_map_task([
+        maptask.WorkerRead(
+            inmemory.InMemorySource(
+                elements=[pickler.dumps(e) for e in elements],
+                start_index=0,
+                end_index=250),
+            tag=None),
+        maptask.WorkerDoFn(
+            serialized_fn=pickle_with_side_inputs(
+                ptransform.CallableWrapperDoFn(lambda x: [x, -x - 1])),
+            output_tags=['out'], input=(0, 0), side_inputs=None),
+        maptask.WorkerDoFn(
+            serialized_fn=pickle_with_side_inputs(BundleMarkingDoFn()),
+            output_tags=['out'], input=(1, 0), side_inputs=None),
+        maptask.WorkerFlatten(inputs=[(2, 0)]),
+        maptask.WorkerInMemoryWrite(
+            output_buffer=output_buffer, input=(3, 0))])
+    executor.MapTaskExecutor().execute(map_task)
+    ops = map_task.executed_operations
+    fused_op = ops[0].receivers[0][0]
+    self.assertIsInstance(fused_op, executor.FusedOperation)
+    self.assertEqual(ops[1:4], fused_op.operations)
+    self.assertEqual('start', output_buffer[0])
+    self.assertEqual('finish', output_buffer[-1])
+    self.assertEqual(range(-250, 250), sorted(output_buffer[1:-1]))
+    element_counts = dict(
+        (c.name, c.total) for op in ops for c in op.itercounters()
+        if c.name.endswith('ElementCount'))
+    self.assertEqual({'step-0-out0-ElementCount': 250,
+                      'step-1-out0-ElementCount': 500,
+                      'step-2-out0-ElementCount': 502,
+                      'step-3-out0-ElementCount': 502,
+                      'step-4-out0-ElementCount': 502},
+                     element_counts)
+
+  def test_fused_operations_bound_their_buffers(self):
+    output_buffer = []
+    map_task = make_map_task([
+        maptask.WorkerRead(
+            inmemory.InMemorySource(
+                elements=[pickler.dumps(e) for e in range(3)],
+                start_index=0,
+                end_index=3),
+            tag=None),
+        maptask.WorkerDoFn(
+            serialized_fn=pickle_with_side_inputs(
+                ptransform.CallableWrapperDoFn(
+                    lambda x: ((x, i) for i in range(1000)))),
+            output_tags=['out'], input=(0, 0), side_inputs=None),
+        maptask.WorkerDoFn(
+            serialized_fn=pickle_with_side_inputs(
+                ptransform.CallableWrapperDoFn(lambda (x, i): [x * 1000 + i])),
+            output_tags=['out'], input=(1, 0), side_inputs=None),
+        maptask.WorkerInMemoryWrite(
+            output_buffer=output_buffer, input=(2, 0))])
+    buffer_sizes = []
+    process = executor.OutputBuffer.process
+
+    def recording_process(output_buffer, o):
+      process(output_buffer, o)
+      buffer_sizes.append(len(output_buffer.values))
+
+    with mock.patch.object(executor.OutputBuffer, 'process', recording_process):
+      executor.MapTaskExecutor().execute(map_task)
+    self.assertIsInstance(map_task.executed_operations[0].receivers[0][0],
+                          executor.FusedOperation)
+    self.assertEqual(3000, len(buffer_sizes))
+    self.assertLess(max(buffer_sizes), executor.FusedOperation.BATCH_SIZE)
+    self.assertEqual(range(3000), output_buffer)
+
+  def test_logging_context_is_entered_once_per_bundle(self):
+    output_buffer = []
+    map_task = make_map_task([
+        maptask.WorkerRead(
+            inmemory.InMemorySource(
+                elements=[pickler.dumps(e) for e in range(5)],
+                start_index=0,
+                end_index=5),
+            tag=None),
+        maptask.WorkerDoFn(
+            serialized_fn=pickle_with_side_inputs(
+                ptransform.CallableWrapperDoFn(
+                    lambda x: [(x, logger.per_thread_worker_data.step_name)])),
+            output_tags=['out'], input=(0, 0), side_inputs=None),
+        maptask.WorkerInMemoryWrite(
+            output_buffer=output_buffer, input=(1, 0))])
+    enter = logger.PerThreadLoggingContext.__enter__
+    entered = []
+
+    def recording_enter(context):
+      entered.append(context.kwargs)
+      return enter(context)
+
+    with mock.patch.object(logger.PerThreadLoggingContext, '__enter__',
+                           recording_enter):
+      executor.MapTaskExecutor().execute(map_task)
+    self.assertEqual([(x, 'step-1') for x in range(5)], output_buffer)
+    # Once for the bundle, and once each by the DoFnRunner for starting and
+    # finishing it.
+    self.assertEqual([{'step_name': 'step-1'}] * 3, entered)
+    self.assertFalse(hasattr(logger.per_thread_worker_data, 'step_name'))
+
+  def test_reexecuted_map_task_reuses_fns(self):
+    output_buffer = []
+    map_task = make_map_task([
+        maptask.WorkerRead(
+            inmemory.InMemorySource(
+                elements=[pickler.dumps(e) for e in ['a', 'b']],
+                start_index=0,
+                end_index=2),
+            tag=None),
+        maptask.WorkerDoFn(
+            serialized_fn=pickle_with_side_inputs(BundleCountingDoFn()),
+            output_tags=['out'], input=(0, 0), side_inputs=None),
+        maptask.WorkerInMemoryWrite(
+            output_buffer=output_buffer, input=(1, 0))])
+    map_task.fn_cache = {}
+    executor.MapTaskExecutor().execute(map_task)
+    executor.MapTaskExecutor().execute(map_task)
+    self.assertEqual([(1, 'a'), (1, 'b'), (2, 'a'), (2, 'b')], output_buffer)
+    self.assertEqual(1, len(map_task.fn_cache))
+
   def test_in_memory_source_progress_reporting(self):
     elements = [101, 201, 301, 401, 501, 601, 701]
     output_buffer = []
@@ -514,12 +668,95 @@ class ExecutorTest(unittest.TestCase):
                                              ],
                                     start_index=0,
                                     end_index=100),
-            tag=None), maptask.WorkerPartialGroupByKey(input=(
-                0, 0)), maptask.WorkerInMemoryWrite(output_buffer=output_buffer,
-                                                    input=(1, 0))
+            tag=None), maptask.WorkerPartialGroupByKey(
+                combine_fn=None,
+                input=(0, 0)),
+        maptask.WorkerInMemoryWrite(output_buffer=output_buffer,
+                                    input=(1, 0))
     ]))
     self.assertEqual([('a', [1, 3, 4]), ('b', [2])], sorted(output_buffer))
 
+  def test_pgbk_with_combine_fn(self):
+    elements = [('a', 1), ('b', 2), ('a', 3), ('a', 4)]
+    output_buffer = []
+    executor.MapTaskExecutor().execute(make_map_task([
+        maptask.WorkerRead(
+            inmemory.InMemorySource(elements=[pickler.dumps(e) for e in elements
+                                             ],
+                                    start_index=0,
+                                    end_index=100),
+            tag=None), maptask.WorkerPartialGroupByKey(
+                combine_fn=pickler.dumps(
+                    (combiners.CountCombineFn(), (), {})),
+                input=(0, 0)),
+        maptask.WorkerInMemoryWrite(output_buffer=output_buffer,
+                                    input=(1, 0))
+    ]))
+    self.assertEqual([('a', 3), ('b', 1)], sorted(output_buffer))
+
+  def test_pgbk_evicts_least_recently_hit(self):
+    spec = maptask.WorkerPartialGroupByKey(combine_fn=pickler.dumps(
+        (combiners.CountCombineFn(), (), {})), input=(0, 0))
+    # The serialized CombineFn is left out of the debug string.
+    self.assertEqual('WorkerPartialGroupByKey(input=(0, 0))', str(spec))
+    op = executor.PGBKOperation(
+        spec, max_size=3 * executor.PGBKOperation.ENTRY_OVERHEAD)
+    op.step_name = 'pgbk'
+    output_buffer = []
+    write_op = executor.InMemoryWriteOperation(
+        maptask.WorkerInMemoryWrite(output_buffer=output_buffer, input=(0, 0)))
+    write_op.step_name = 'write'
+    op.add_receiver(write_op, 0)
+    op.start()
+    for key in ('hot', 'a', 'hot', 'b', 'hot', 'c', 'hot'):
+      op.process(window.WindowedValue((key, None), 0, [window.GlobalWindow()]))
+    # Adding 'b' and then 'c' outgrew the table, each time evicting the entry
+    # hit the longest ago.
+    self.assertEqual([('a', 1), ('b', 1)], output_buffer)
+    op.finish()
+    self.assertEqual([('a', 1), ('b', 1), ('c', 1), ('hot', 4)],
+                     sorted(output_buffer))
+
+  def run_pgbk(self, combine_fn, elements, max_size):
+    """Returns what a PGBKOperation outputs before and after finishing."""
+    spec = maptask.WorkerPartialGroupByKey(
+        combine_fn=combine_fn and pickler.dumps((combine_fn, (), {})),
+        input=(0, 0))
+    op = executor.PGBKOperation(spec, max_size=max_size)
+    op.step_name = 'pgbk'
+    output_buffer = []
+    write_op = executor.InMemoryWriteOperation(
+        maptask.WorkerInMemoryWrite(output_buffer=output_buffer, input=(0, 0)))
+    write_op.step_name = 'write'
+    op.add_receiver(write_op, 0)
+    op.start()
+    for element in elements:
+      op.process(window.WindowedValue(element, 0, [window.GlobalWindow()]))
+    evicted = list(output_buffer)
+    op.finish()
+    return evicted, output_buffer
+
+  def test_pgbk_sizes_values_recursively(self):
+    # Each value holds 10KB in strings, far more than the list itself.
+    elements = [(key, ['x' * 1000 + str(i) for i in range(10)])
+                for key in 'abcdefghij']
+    evicted, output = self.run_pgbk(None, elements, max_size=30 << 10)
+    self.assertTrue(evicted)
+    self.assertEqual(sorted((k, [v]) for k, v in elements), sorted(output))
+
+  def test_pgbk_sizes_accumulators_by_encoding(self):
+    elements = [(key, 'x' * 1000 + str(i))
+                for i in range(10) for key in 'abcdefghij']
+    evicted, output = self.run_pgbk(
+        combiners.ToListCombineFn(), elements, max_size=30 << 10)
+    self.assertTrue(evicted)
+    values = collections.defaultdict(list)
+    for key, accumulator in output:
+      values[key].extend(accumulator)
+    self.assertEqual(
+        dict((key, [v for k, v in elements if k == key]) for key in values),
+        values)
+
 if __name__ == '__main__':
   logging.getLogger().setLevel(logging.INFO)
   unittest.main()
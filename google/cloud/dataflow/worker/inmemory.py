@@ -66,11 +66,12 @@ class InMemoryReader(iobase.SourceReader):
     pass
 
   def __iter__(self):
-    for value in itertools.islice(self.source.elements,
-                                  self.source.start_index,
-                                  self.source.end_index):
+    for value in self.source.coder.get_impl().iter_decode_each(
+        itertools.islice(self.source.elements,
+                         self.source.start_index,
+                         self.source.end_index)):
       self.current_index += 1
-      yield self.source.coder.decode(value)
+      yield value
 
   def get_progress(self):
     if (self.current_index >= self.source.end_index or
@@ -17,24 +17,27 @@
 import logging
 import unittest
 
+from google.cloud.dataflow import coders
 from google.cloud.dataflow.worker import inmemory
 
 
-class FakeCoder(object):
+class FakeCoder(coders.Coder):
 
   def decode(self, value):
-    return value + 10
+    return int(value) + 10
 
 
 class InMemoryIO(unittest.TestCase):
 
   def test_inmemory(self):
-    source = inmemory.InMemorySource([1, 2, 3, 4, 5], FakeCoder(), 1, 3)
+    source = inmemory.InMemorySource(
+        ['1', '2', '3', '4', '5'], FakeCoder(), 1, 3)
     with source.reader() as reader:
       self.assertItemsEqual([12, 13], [i for i in reader])
 
   def test_norange(self):
-    source = inmemory.InMemorySource([1, 2, 3, 4, 5], coder=FakeCoder())
+    source = inmemory.InMemorySource(
+        ['1', '2', '3', '4', '5'], coder=FakeCoder())
     with source.reader() as reader:
       self.assertItemsEqual([11, 12, 13, 14, 15], [i for i in reader])
 
@@ -44,7 +47,7 @@ class InMemoryIO(unittest.TestCase):
       self.assertEqual(1, reader.get_progress().percent_complete)
 
   def test_in_memory_source_updates_progress_one(self):
-    source = inmemory.InMemorySource([1], coder=FakeCoder())
+    source = inmemory.InMemorySource(['1'], coder=FakeCoder())
     with source.reader() as reader:
       self.assertEqual(0, reader.get_progress().percent_complete)
       i = 0
@@ -56,7 +59,8 @@ class InMemoryIO(unittest.TestCase):
       self.assertEqual(1, reader.get_progress().percent_complete)
 
   def test_in_memory_source_updates_progress_many(self):
-    source = inmemory.InMemorySource([1, 2, 3, 4, 5], coder=FakeCoder())
+    source = inmemory.InMemorySource(
+        ['1', '2', '3', '4', '5'], coder=FakeCoder())
     with source.reader() as reader:
       self.assertEqual(0, reader.get_progress().percent_complete)
       i = 0
@@ -27,26 +27,33 @@ per_thread_worker_data = threading.local()
 
 
 class PerThreadLoggingContext(object):
-  """A context manager to add per thread attributes."""
+  """A context manager to add per thread attributes.
+
+  A context may be entered again after being exited, so callers entering the
+  same context for each element they process only need to create it once.
+  """
 
   def __init__(self, *args, **kwargs):
     if args:
       raise ValueError(
           'PerThreadLoggingContext expects only keyword arguments.')
     self.kwargs = kwargs
-    self.previous = {}
+    self._previous_stack = []
 
   def __enter__(self):
+    previous = {}
     for key in self.kwargs:
       if hasattr(per_thread_worker_data, key):
-        self.previous[key] = getattr(per_thread_worker_data, key)
+        previous[key] = getattr(per_thread_worker_data, key)
       setattr(per_thread_worker_data, key, self.kwargs[key])
+    self._previous_stack.append(previous)
     return self
 
   def __exit__(self, exn_type, exn_value, exn_traceback):
+    previous = self._previous_stack.pop()
     for key in self.kwargs:
-      if key in self.previous:
-        setattr(per_thread_worker_data, key, self.previous[key])
+      if key in previous:
+        setattr(per_thread_worker_data, key, previous[key])
       else:
         delattr(per_thread_worker_data, key)
 
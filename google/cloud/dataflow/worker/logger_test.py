@@ -66,6 +66,18 @@ class PerThreadLoggingContextTest(unittest.TestCase):
       self.assertEqual(logger.per_thread_worker_data.xyz, 'value')
     self.assertFalse(hasattr(logger.per_thread_worker_data, 'xyz'))
 
+  def test_reentered_context(self):
+    context = logger.PerThreadLoggingContext(xyz='value')
+    for _ in range(2):
+      with context:
+        self.assertEqual(logger.per_thread_worker_data.xyz, 'value')
+        with logger.PerThreadLoggingContext(xyz='value2'):
+          with context:
+            self.assertEqual(logger.per_thread_worker_data.xyz, 'value')
+          self.assertEqual(logger.per_thread_worker_data.xyz, 'value2')
+        self.assertEqual(logger.per_thread_worker_data.xyz, 'value')
+      self.assertFalse(hasattr(logger.per_thread_worker_data, 'xyz'))
+
 
 class JsonLogFormatterTest(unittest.TestCase):
 
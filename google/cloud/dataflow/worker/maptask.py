@@ -20,6 +20,7 @@ source, write to a sink, parallel do, etc.
 
 import base64
 import collections
+import logging
 
 from google.cloud.dataflow import coders
 from google.cloud.dataflow import io
@@ -60,7 +61,7 @@ def worker_printable_fields(workerproto):
           # want to output value 0 but not None nor []
           if (value or value == 0)
           and name not in
-          ('coder', 'coders', 'elements', 'serialized_fn',
+          ('coder', 'coders', 'elements', 'serialized_fn', 'combine_fn',
            'append_trailing_newlines', 'strip_trailing_newlines',
            'compression_type',
            'start_shuffle_position', 'end_shuffle_position',
@@ -244,9 +245,12 @@ Attributes:
 
 WorkerPartialGroupByKey = build_worker_instruction(
     'WorkerPartialGroupByKey',
-    ['input'])
+    ['combine_fn', 'input'])
 """Worker details needed to run a partial group-by-key.
 Attributes:
+  combine_fn: A serialized CombineFn whose add_input is applied to the values
+    of each key and window as they are grouped, or None to output the values
+    themselves.
   input: A (producer index, output index) tuple representing the
     ParallelInstruction operation whose output feeds into this operation.
     The output index is 0 except for multi-output operations (like ParDo).
@@ -515,10 +519,32 @@ def get_partial_gbk_work_item(instruction, unused_env, unused_context):
   Returns:
     A WorkerPartialGroupByKey object.
   """
+  combine_fn = None
+  if instruction.partialGroupByKey.valueCombiningFn:
+    specs = {p.key: from_json_value(p.value)
+             for p in (instruction.partialGroupByKey.valueCombiningFn
+                       .additionalProperties)}
+    combine_fn = specs['serialized_fn']['value']
   return WorkerPartialGroupByKey(
+      combine_fn=combine_fn,
       input=get_input_spec(instruction.partialGroupByKey.input))
 
 
+def get_output_coder(output):
+  """Returns the coder of an InstructionOutput, or None if it is unknown."""
+  if not output.codec:
+    return None
+  codec_specs = {p.key: from_json_value(p.value)
+                 for p in output.codec.additionalProperties}
+  try:
+    return get_coder_from_spec(codec_specs)
+  except Exception:  # pylint: disable=broad-except
+    # Output coders are only used to measure elements, so a coder that cannot
+    # be decoded by this SDK is not an error.
+    logging.info('Unknown output coder: %s', codec_specs, exc_info=True)
+    return None
+
+
 class MapTask(object):
   """A map task decoded into operations and ready to be executed.
 
@@ -527,12 +553,20 @@ class MapTask(object):
       within the map task.
     stage_name: The name of this map task execution stage.
     step_names: The names of the step corresponding to each map task operation.
+    output_coders: For each map task operation, the coders of its outputs,
+      None for those whose coder is unknown. None if no coder is known.
+    fn_cache: A dict in which the operations store the fns they unpickle, so
+      that executing the map task again reuses them, or None to unpickle the
+      fns on every execution. A map task with an fn_cache must not be executed
+      concurrently.
   """
 
-  def __init__(self, operations, stage_name, step_names):
+  def __init__(self, operations, stage_name, step_names, output_coders=None):
     self.operations = operations
     self.stage_name = stage_name
     self.step_names = step_names
+    self.output_coders = output_coders
+    self.fn_cache = None
 
   def __str__(self):
     return '<%s %s steps=%s>' % (self.__class__.__name__, self.stage_name,
@@ -759,10 +793,12 @@ def decode_map_task(map_task_proto, env=WorkerEnvironment(),
   operations = []
   stage_name = map_task_proto.stageName
   step_names = []
+  output_coders = []
   context.worker_environment = env
   # Parse the MapTask instructions.
   for work in map_task_proto.instructions:
     step_names.append(work.name)
+    output_coders.append([get_output_coder(o) for o in work.outputs])
     if work.read is not None:
       operations.append(get_read_work_item(work, env, context))
     elif work.write is not None:
@@ -775,4 +811,4 @@ def decode_map_task(map_task_proto, env=WorkerEnvironment(),
       operations.append(get_partial_gbk_work_item(work, env, context))
     else:
       raise NotImplementedError('Unknown instruction: %r' % work)
-  return MapTask(operations, stage_name, step_names)
+  return MapTask(operations, stage_name, step_names, output_coders)
@@ -16,33 +16,98 @@
 
 from __future__ import absolute_import
 
+import logging
 from numbers import Number
+import random
 
+from google.cloud.dataflow import coders
 from google.cloud.dataflow.utils.counters import Counter
 
 
 class OperationCounters(object):
-  """The set of basic counters to attach to an Operation."""
+  """The set of basic counters to attach to an Operation.
 
-  def __init__(self, step_name, output_index=0):
-    self.element_counter = Counter(
+  Counting an element only bumps an integer; the counters are brought up to
+  date when accessed. The size of elements is measured on a sample of them:
+  the first SAMPLING_CUTOFF elements are all measured, after which the n-th
+  element is measured with a probability of about SAMPLING_CUTOFF / n. The
+  byte count is extrapolated from the mean size of the measured elements.
+  Elements are measured with the coder of the output if it is known, and
+  approximated from their values otherwise.
+  """
+
+  SAMPLING_CUTOFF = 10
+  # The largest number of elements skipped between two measured elements.
+  MAX_SAMPLING_GAP = 10000
+
+  def __init__(self, step_name, output_index=0, coder=None):
+    self._element_counter = Counter(
         '%s-out%d-ElementCount' % (step_name, output_index), Counter.SUM)
-    self.mean_byte_counter = Counter(
+    self._mean_byte_counter = Counter(
         '%s-out%d-MeanByteCount' % (step_name, output_index), Counter.MEAN)
+    self.coder = coder
+    self._encodes_windowed_values = isinstance(
+        coder, coders.WindowedValueCoder)
+    self._element_count = 0
+    # The index of the next element to measure.
+    self._next_sample = 0
+    self._sampled_elements = 0
+    self._sampled_bytes = 0
+
+  @property
+  def element_counter(self):
+    self._update_counters()
+    return self._element_counter
+
+  @property
+  def mean_byte_counter(self):
+    self._update_counters()
+    return self._mean_byte_counter
 
   def update(self, windowed_value):
     """Add one value to this counter."""
-    if isinstance(windowed_value.value, Number):
-      size = 4  # numbers take 4 bytes
+    count = self._element_count
+    self._element_count = count + 1
+    if count == self._next_sample:
+      self._sample(windowed_value, count)
+
+  def _sample(self, windowed_value, count):
+    self._sampled_bytes += self._estimate_size(windowed_value)
+    self._sampled_elements += 1
+    if count < self.SAMPLING_CUTOFF:
+      self._next_sample = count + 1
     else:
+      self._next_sample = count + 1 + int(random.random() * min(
+          2 * count // self.SAMPLING_CUTOFF, self.MAX_SAMPLING_GAP))
+
+  def _estimate_size(self, windowed_value):
+    if self.coder is not None:
       try:
-        # len() gives the right answer for at least strings
-        size = len(windowed_value.value)
-      except (AttributeError, TypeError):
-        # it's an object, not data, and there's nothing to count.
-        size = 0
-    self.mean_byte_counter.update(size)
-    self.element_counter.update(1)
+        if self._encodes_windowed_values:
+          return self.coder.estimate_size(windowed_value)
+        else:
+          return self.coder.estimate_size(windowed_value.value)
+      except Exception:  # pylint: disable=broad-except
+        logging.warning('Cannot estimate sizes with coder %s for %s; '
+                        'approximating them instead.', self.coder,
+                        self._element_counter.name, exc_info=True)
+        self.coder = None
+    if isinstance(windowed_value.value, Number):
+      return 4  # numbers take 4 bytes
+    try:
+      # len() gives the right answer for at least strings
+      return len(windowed_value.value)
+    except (AttributeError, TypeError):
+      # it's an object, not data, and there's nothing to count.
+      return 0
+
+  def _update_counters(self):
+    count = self._element_count
+    self._element_counter.total = self._element_counter.elements = count
+    self._mean_byte_counter.elements = count
+    if self._sampled_elements:
+      self._mean_byte_counter.total = int(round(
+          float(self._sampled_bytes) * count / self._sampled_elements))
 
   def __iter__(self):
     """Iterator over all our counters."""
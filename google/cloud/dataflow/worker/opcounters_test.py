@@ -17,6 +17,7 @@
 import logging
 import unittest
 
+from google.cloud.dataflow import coders
 from google.cloud.dataflow.transforms.window import GlobalWindows
 from google.cloud.dataflow.worker.opcounters import OperationCounters
 
@@ -73,6 +74,35 @@ class OperationCountersTest(unittest.TestCase):
     opcounts.update(GlobalWindows.WindowedValue('defghij'))
     self.verify_counters(opcounts, 2, 12)  # the strings add up to 12 characters
 
+  def test_update_with_coder(self):
+    opcounts = OperationCounters('some-name', coder=coders.VarIntCoder())
+    opcounts.update(GlobalWindows.WindowedValue(1000))
+    self.verify_counters(opcounts, 1, 2)  # 1000 is encoded in 2 bytes
+
+  def test_update_with_windowed_value_coder(self):
+    coder = coders.WindowedValueCoder(coders.BytesCoder())
+    windowed_value = GlobalWindows.WindowedValue('abcde')
+    opcounts = OperationCounters('some-name', coder=coder)
+    opcounts.update(windowed_value)
+    self.verify_counters(opcounts, 1, len(coder.encode(windowed_value)))
+
+  def test_sampled_sizes(self):
+
+    class CountingCoder(coders.BytesCoder):
+
+      calls = 0
+
+      def estimate_size(self, value):
+        CountingCoder.calls += 1
+        return super(CountingCoder, self).estimate_size(value)
+
+    opcounts = OperationCounters('some-name', coder=CountingCoder())
+    for _ in range(100000):
+      opcounts.update(GlobalWindows.WindowedValue('abcde'))
+    self.verify_counters(opcounts, 100000, 500000)
+    self.assertLess(CountingCoder.calls, 1000)
+    self.assertGreater(CountingCoder.calls, OperationCounters.SAMPLING_CUTOFF)
+
 
 if __name__ == '__main__':
   logging.getLogger().setLevel(logging.INFO)
@@ -34,12 +34,17 @@ have indefinite lifetimes, are stateless and immutable.
 from __future__ import absolute_import
 
 import base64
+import collections
 import cStringIO as StringIO
 import logging
 import struct
+import sys
+import threading
+import time
 
 from google.cloud.dataflow.io import iobase
 from google.cloud.dataflow.io import range_trackers
+from google.cloud.dataflow.utils.counters import Counter
 
 
 # The following import works perfectly fine for the Dataflow SDK properly
@@ -52,6 +57,13 @@ try:
 except ImportError:
   pass
 
+# pylint: disable=g-import-not-at-top
+try:
+  from google.cloud.dataflow.worker.shufflechunk import ShuffleChunk
+except ImportError:
+  from google.cloud.dataflow.worker.slow_shufflechunk import ShuffleChunk
+# pylint: enable=g-import-not-at-top
+
 
 def _shuffle_decode(parameter):
   """Decodes a shuffle parameter.
@@ -147,144 +159,224 @@ class ShuffleEntry(object):
     return ShuffleEntry(key, secondary_key, value, position)
 
 
-class ShuffleEntriesIterable(object):
-  """An iterable over all entries between two positions filtered by key.
+# The default bound on the size of the chunks read ahead of the chunk being
+# decoded. A value of 0 disables reading ahead. Reading ahead holds up to that
+# many more bytes per shuffle reader, so it is only enabled by sources created
+# with a positive max_prefetch_bytes.
+DEFAULT_MAX_PREFETCH_BYTES = 0
 
-  The method can be used to iterate over all values in the shuffle if key is
-  None and start and nd positions are ''.
-  """
 
-  def __init__(self, reader, start_position='', end_position='', key=None):
-    """Constructs an iterable for reading sequentially entries in a range.
+class SynchronizedShuffleReader(object):
+  """Serializes the Read calls of a shuffle reader shared between threads."""
 
-    The iterable object can be used to get all the shuffle entries associated
-    with a key (repeatedly) or simply iterating over all entries (if key is
-    None).
+  def __init__(self, reader):
+    self.reader = reader
+    self._lock = threading.Lock()
 
-    Args:
-      reader: A shuffle reader object. These are shared among all iterables
-        since there are networking costs associated to setting one up.
-      start_position: The first shuffle position to read from.
-      end_position: The shuffle position where reading will stop.
-      key: The key to match for all shuffle entries if not None. The iteration
-        stops when a record with a different key is encountered.
+  def Read(self, start_position, end_position):  # pylint: disable=invalid-name
+    with self._lock:
+      return self.reader.Read(start_position, end_position)
 
-    """
-    self.reader = reader
-    self.start_position = start_position
-    self.end_position = end_position
-    self.key = key
-    self._pushed_back_entry = None
 
-  def push_back(self, entry):
-    """Pushes back one entry to support simple look ahead scenarios."""
-    if self._pushed_back_entry is not None:
-      raise RuntimeError('There is already an entry pushed back.')
-    self._pushed_back_entry = entry
+class ShuffleChunkPrefetcher(object):
+  """Reads the chunks of a position range ahead on a background thread.
 
-  def __iter__(self):
-    last_chunk_seen = False
-    start_position = self.start_position
-    end_position = self.end_position
-    while not last_chunk_seen:
-      chunk, next_position = self.reader.Read(start_position, end_position)
-      if not next_position:  # An empty string signals the last chunk.
-        last_chunk_seen = True
-      # Yield records inside the chunk just read.
-      read_bytes, total_bytes = 0, len(chunk)
-      stream = StringIO.StringIO(chunk)
-      while read_bytes < total_bytes:
-        entry = ShuffleEntry.from_stream(stream)
-        if self.key is not None and self.key != entry.key:
-          return
-        read_bytes += entry.size
-        yield entry
-        # Check if anything was pushed back. We do this until there is no
-        # value pushed back since it is quite possible to have values pushed
-        # back multiple times by the upper callers.
-        while self._pushed_back_entry is not None:
-          to_return, self._pushed_back_entry = self._pushed_back_entry, None
-          yield to_return
-      # Move on to the next chunk.
-      start_position = next_position
-
-
-class ShuffleEntriesIterator(object):
-  """An iterator object for a ShuffleEntryIterable with push back support.
-
-  The class supports also the iterable protocol (__iter__) and it is careful
-  to not create a new iterator from the underlying iterable when iter() is
-  called. This is important because shuffle entries iterators are passed
-  around and we want to keep reading sequentially while the passing happens.
-  More specifically they are kept as the underlying iterators for the key values
-  iterables returned for each key.
+  The chunks are read sequentially from start_position to end_position, as
+  the shuffle reader returns them. Reading pauses while the chunks waiting to
+  be consumed add up to max_prefetch_bytes or more, so at most one chunk
+  beyond that bound is buffered.
   """
 
-  def __init__(self, iterable):
-    self.iterable = iterable
-    self.iterator = iter(self.iterable)
+  def __init__(self, reader, start_position, end_position, max_prefetch_bytes):
+    self._reader = reader
+    self._start_position = start_position
+    self._end_position = end_position
+    self._max_prefetch_bytes = max_prefetch_bytes
+    self._chunks = collections.deque()
+    self._prefetched_bytes = 0
+    self._exc_info = None
+    self._closed = False
+    self._lock = threading.Condition()
+    self._thread = threading.Thread(target=self._prefetch_chunks)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _prefetch_chunks(self):
+    position = self._start_position
+    try:
+      while True:
+        with self._lock:
+          while (not self._closed and self._chunks and
+                 self._prefetched_bytes >= self._max_prefetch_bytes):
+            self._lock.wait()
+          if self._closed:
+            return
+        chunk, next_position = self._reader.Read(position, self._end_position)
+        with self._lock:
+          if self._closed:
+            return
+          self._chunks.append((chunk, next_position))
+          self._prefetched_bytes += len(chunk)
+          self._lock.notify_all()
+        if not next_position:  # An empty string signals the last chunk.
+          return
+        position = next_position
+    except Exception:  # pylint: disable=broad-except
+      with self._lock:
+        self._exc_info = sys.exc_info()
+        self._lock.notify_all()
 
-  def __iter__(self):
-    return self
+  def next_chunk(self):
+    """Returns the next (chunk, next_position) pair, as reader.Read() would.
 
-  def push_back(self, entry):
-    self.iterable.push_back(entry)
+    Raises:
+      The exception raised by the shuffle reader, if reading failed.
+    """
+    with self._lock:
+      while not (self._chunks or self._exc_info or self._closed):
+        self._lock.wait()
+      if self._closed:
+        raise RuntimeError('Reading from a closed shuffle chunk prefetcher.')
+      if not self._chunks:
+        raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+      chunk, next_position = self._chunks.popleft()
+      self._prefetched_bytes -= len(chunk)
+      self._lock.notify_all()
+      return chunk, next_position
+
+  def close(self):
+    """Stops reading ahead and releases the chunks not consumed."""
+    with self._lock:
+      self._closed = True
+      self._chunks.clear()
+      self._prefetched_bytes = 0
+      self._lock.notify_all()
+
+
+class ShuffleChunkCursor(object):
+  """A cursor over the entries of the shuffle chunks in a position range.
+
+  Chunks are read from the shuffle reader as the cursor advances. Entries are
+  addressed by their index in the current chunk, so the grouped and ungrouped
+  read paths can decode keys and values without creating ShuffleEntry
+  objects.
+
+  If max_prefetch_bytes is positive, the following chunks are read on a
+  background thread while the current one is decoded. The cursor must then be
+  closed once it is no longer needed, and the reader must support concurrent
+  calls (see SynchronizedShuffleReader).
+  """
 
-  def next(self):
-    return next(self.iterator)
+  def __init__(self, reader, start_position='', end_position='',
+               max_prefetch_bytes=0):
+    self.reader = reader
+    self.end_position = end_position
+    self.chunk = None
+    self.index = 0
+    self._next_position = start_position
+    self._last_chunk_seen = False
+    self._prefetcher = None
+    if max_prefetch_bytes > 0:
+      self._prefetcher = ShuffleChunkPrefetcher(
+          reader, start_position, end_position, max_prefetch_bytes)
+
+  def close(self):
+    if self._prefetcher is not None:
+      self._prefetcher.close()
+
+  def has_entry(self):
+    """Returns whether the cursor is at an entry, reading chunks as needed."""
+    while self.chunk is None or self.index >= len(self.chunk):
+      if self._last_chunk_seen:
+        return False
+      if self._prefetcher is not None:
+        chunk, next_position = self._prefetcher.next_chunk()
+      else:
+        chunk, next_position = self.reader.Read(
+            self._next_position, self.end_position)
+      if not next_position:  # An empty string signals the last chunk.
+        self._last_chunk_seen = True
+      self.chunk = ShuffleChunk(chunk)
+      self.index = 0
+      self._next_position = next_position
+    return True
+
+  def iter_values(self, value_coder_impl):
+    """Yields the decoded values of all remaining entries."""
+    while self.has_entry():
+      chunk = self.chunk
+      buffer = chunk.buffer
+      while self.index < len(chunk):
+        index = self.index
+        self.index += 1
+        yield value_coder_impl.decode_range(
+            buffer, chunk.value_start(index), chunk.value_end(index))
+
+  def iter_key_values(self, key, value_coder_impl):
+    """Yields the decoded values of the entries at the cursor having key.
+
+    Iteration stops at the first entry with a different key, or if the cursor
+    is moved elsewhere while the iteration is suspended.
+    """
+    while self.has_entry():
+      chunk = self.chunk
+      buffer = chunk.buffer
+      group_end = chunk.group_end(self.index, key)
+      while self.chunk is chunk and self.index < group_end:
+        index = self.index
+        self.index += 1
+        yield value_coder_impl.decode_range(
+            buffer, chunk.value_start(index), chunk.value_end(index))
+      if self.chunk is not chunk or group_end < len(chunk):
+        return
 
-  def clone(self, start_position, end_position, key):
-    """Clones the current iterator with a new key, start, and end position."""
-    return ShuffleEntriesIterator(
-        ShuffleEntriesIterable(
-            self.iterable.reader, start_position, end_position, key))
+  def skip_key(self, key):
+    """Advances the cursor past the entries at the cursor having key."""
+    while self.has_entry():
+      self.index = self.chunk.group_end(self.index, key)
+      if self.index < len(self.chunk):
+        return
 
 
 class ShuffleKeyValuesIterable(object):
   """An iterable over all values associated with a key.
 
-  The class supports reiteration over the values by cloning the underlying
-  iterables every time __iter__ gets called. This way the values can be
-  reiterated. The first time __iter__ is called no cloning happens.
-  This supports the very common case of going once over all values for all keys.
+  The first iteration reads the values from the cursor shared with the
+  grouped reader. The class supports reiteration over the values by reading
+  the key's entries again with a new cursor every time __iter__ gets called
+  after that, or after the shared cursor has moved past the key. This
+  supports the very common case of going once over all values for all keys.
   """
 
-  def __init__(self, entries_iterator, key, value_coder,
+  def __init__(self, cursor, key, value_coder,
                start_position, end_position=''):
+    self.cursor = cursor
     self.key = key
     self.value_coder = value_coder
     self.start_position = start_position
     self.end_position = end_position
-    self.entries_iterator = entries_iterator
-    self.first_values_iterator = None
+    self._iterated = False
+    self._drained = False
 
   def __iter__(self):
-    if self.first_values_iterator is None:
-      # We safe the first values iterator returned because upper layers
-      # can use it to drain the values in it. This is an optimization needed
-      # to make efficient the very common case of iterating over all key values
-      # available.
-      self.first_values_iterator = self.values_iterator()
-      return self.first_values_iterator
+    value_coder_impl = self.value_coder.get_impl()
+    if not self._iterated and not self._drained:
+      self._iterated = True
+      return self.cursor.iter_key_values(self.key, value_coder_impl)
     else:
-      # If this is not the first time __iter__ is called we will clone the
-      # underlying iterables so that we can reiterate as many times as we
-      # want over the key's values.
-      return ShuffleKeyValuesIterable(
-          self.entries_iterator.clone(
-              self.start_position, self.end_position, self.key),
-          self.key, self.value_coder,
-          self.start_position, self.end_position).values_iterator()
-
-  def values_iterator(self):
-    for entry in self.entries_iterator:
-      if self.key != entry.key:
-        # Remember the end_position so that if we reiterate over the values
-        # we can do that without reading too much beyond the key.
-        self.end_position = entry.position
-        self.entries_iterator.push_back(entry)
-        break
-      yield self.value_coder.decode(entry.value)
+      return ShuffleChunkCursor(
+          self.cursor.reader, self.start_position,
+          self.end_position).iter_key_values(self.key, value_coder_impl)
+
+  def drain(self):
+    """Advances the shared cursor past the remaining values of the key."""
+    if not self._drained:
+      self._drained = True
+      self.cursor.skip_key(self.key)
+      # Remember the end_position so that if we reiterate over the values
+      # we can do that without reading too much beyond the key.
+      if self.cursor.has_entry():
+        self.end_position = self.cursor.chunk.position(self.cursor.index)
 
 
 class ShuffleReaderBase(iobase.SourceReader):
@@ -293,21 +385,34 @@ class ShuffleReaderBase(iobase.SourceReader):
   def __init__(self, shuffle_source, reader=None):
     self.source = shuffle_source
     self.reader = reader
-    self.entries_iterable = None
+    self._cursors = []
 
   def __enter__(self):
     if self.reader is None:
       self.reader = shuffle_client.PyShuffleReader(
           _shuffle_decode(self.source.config_bytes))
-    # Initialize the shuffle entries iterable. For now we read from start to
-    # end which is enough for plain GroupByKey operations.
-    if self.entries_iterable is None:
-      self.entries_iterable = ShuffleEntriesIterable(
-          self.reader, self.source.start_position, self.source.end_position)
     return self
 
+  def _cursor(self):
+    """Returns a cursor over the source's range, reading ahead if enabled."""
+    max_prefetch_bytes = self.source.max_prefetch_bytes
+    reader = self.reader
+    if max_prefetch_bytes > 0:
+      # Reiterating over grouped values reads from the same reader while the
+      # chunks are prefetched.
+      reader = SynchronizedShuffleReader(reader)
+    # For now we read from start to end which is enough for plain GroupByKey
+    # operations.
+    cursor = ShuffleChunkCursor(
+        reader, self.source.start_position, self.source.end_position,
+        max_prefetch_bytes=max_prefetch_bytes)
+    self._cursors.append(cursor)
+    return cursor
+
   def __exit__(self, exception_type, exception_value, traceback):
-    pass
+    for cursor in self._cursors:
+      cursor.close()
+    self._cursors = []
 
 
 class GroupedShuffleReader(ShuffleReaderBase):
@@ -320,13 +425,21 @@ class GroupedShuffleReader(ShuffleReaderBase):
         decoded_stop_pos=shuffle_source.end_position)
 
   def __iter__(self):
-    entries_iterator = ShuffleEntriesIterator(self.entries_iterable)
-    for entry in entries_iterator:
-      entries_iterator.push_back(entry)
+    cursor = self._cursor()
+    try:
+      for key_and_values in self._iter_groups(cursor):
+        yield key_and_values
+    finally:
+      # Stop reading ahead once done, e.g. after a dynamic split.
+      cursor.close()
+
+  def _iter_groups(self, cursor):
+    key_coder_impl = self.source.key_coder.get_impl()
+    while cursor.has_entry():
+      key = cursor.chunk.key(cursor.index)
+      group_start = cursor.chunk.position(cursor.index)
       key_values = ShuffleKeyValuesIterable(
-          entries_iterator,
-          entry.key, self.source.value_coder, entry.position)
-      group_start = entry.position
+          cursor, key, self.source.value_coder, group_start)
 
       last_group_start = self._range_tracker.last_group_start
       is_at_split_point = (
@@ -339,16 +452,11 @@ class GroupedShuffleReader(ShuffleReaderBase):
         # source.
         return
 
-      yield (self.source.key_coder.decode(entry.key), key_values)
-      # We need to drain the iterator returned just in case this
-      # was not done by the caller. Otherwise we will not properly advance
-      # to the next key but rather return the next entry for the current
-      # key (if there are multiple values).
-      drain_iterator = key_values.first_values_iterator
-      if drain_iterator is None:
-        drain_iterator = iter(key_values)
-      for _ in drain_iterator:
-        pass
+      yield (key_coder_impl.decode(key), key_values)
+      # We need to skip the values not consumed by the caller. Otherwise we
+      # will not properly advance to the next key but rather return the next
+      # entry for the current key (if there are multiple values).
+      key_values.drain()
 
   def get_progress(self):
     last_group_start = self._range_tracker.last_group_start
@@ -390,15 +498,21 @@ class UngroupedShuffleReader(ShuffleReaderBase):
     super(UngroupedShuffleReader, self).__init__(shuffle_source, reader)
 
   def __iter__(self):
-    for entry in self.entries_iterable:
-      yield self.source.value_coder.decode(entry.value)
+    cursor = self._cursor()
+    try:
+      for value in cursor.iter_values(self.source.value_coder.get_impl()):
+        yield value
+    finally:
+      cursor.close()
 
 
 class ShuffleSourceBase(iobase.Source):
   """A base class for grouped and ungrouped shuffle sources."""
 
-  def __init__(self, config_bytes, coder, start_position='', end_position=''):
+  def __init__(self, config_bytes, coder, start_position='', end_position='',
+               max_prefetch_bytes=DEFAULT_MAX_PREFETCH_BYTES):
     self.config_bytes = config_bytes
+    self.max_prefetch_bytes = max_prefetch_bytes
     self.key_coder, self.value_coder = (
         coder if isinstance(coder, tuple) else (coder, coder))
     self.start_position = (start_position if not start_position
@@ -428,51 +542,193 @@ class UngroupedShuffleSource(ShuffleSourceBase):
     return UngroupedShuffleReader(self, reader=test_reader)
 
 
+# The default size of the buffers of encoded entries passed to the shuffle
+# writer.
+DEFAULT_WRITE_BUFFER_BYTES = 10 << 20
+
+# The default number of filled buffers that may be waiting to be written, or
+# being written, while the next buffer is filled. A value of 0 makes writes
+# synchronous.
+DEFAULT_MAX_IN_FLIGHT_WRITE_BUFFERS = 2
+
+
+class ShuffleBufferFlusher(object):
+  """Writes filled buffers to a shuffle writer on a background thread.
+
+  Buffers are written one at a time, in the order they were added. Adding a
+  buffer blocks while max_in_flight_buffers buffers are already waiting to be
+  written or being written.
+  """
+
+  def __init__(self, writer, max_in_flight_buffers, flush_msecs_counter):
+    self._writer = writer
+    self._max_in_flight_buffers = max_in_flight_buffers
+    self._flush_msecs_counter = flush_msecs_counter
+    self._buffers = collections.deque()
+    self._exc_info = None
+    self._closed = False
+    self._lock = threading.Condition()
+    self._thread = threading.Thread(target=self._flush_buffers)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _flush_buffers(self):
+    try:
+      while True:
+        with self._lock:
+          while not (self._buffers or self._closed):
+            self._lock.wait()
+          if not self._buffers:
+            return
+          # The buffer stays queued while being written, so that it counts
+          # against max_in_flight_buffers.
+          buf = self._buffers[0]
+        start_time = time.time()
+        self._writer.Write(buf)
+        self._flush_msecs_counter.update(
+            int((time.time() - start_time) * 1000))
+        with self._lock:
+          self._buffers.popleft()
+          self._lock.notify_all()
+    except Exception:  # pylint: disable=broad-except
+      with self._lock:
+        self._exc_info = sys.exc_info()
+        self._buffers.clear()
+        self._lock.notify_all()
+
+  def _raise_if_failed(self):
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+  def add(self, buf):
+    """Queues a buffer to be written, waiting for room if needed.
+
+    Returns:
+      The number of seconds spent waiting for room.
+
+    Raises:
+      The exception raised by the shuffle writer, if writing a buffer failed.
+    """
+    with self._lock:
+      start_time = time.time()
+      while (not self._exc_info and
+             len(self._buffers) >= self._max_in_flight_buffers):
+        self._lock.wait()
+      self._raise_if_failed()
+      self._buffers.append(buf)
+      self._lock.notify_all()
+      return time.time() - start_time
+
+  def close(self):
+    """Waits until all the queued buffers are written.
+
+    Raises:
+      The exception raised by the shuffle writer, if writing a buffer failed.
+    """
+    with self._lock:
+      self._closed = True
+      self._lock.notify_all()
+    self._thread.join()
+    self._raise_if_failed()
+
+
 class ShuffleSinkWriter(iobase.NativeSinkWriter):
-  """A sink writer for ShuffleSink."""
+  """A sink writer for ShuffleSink.
+
+  Entries are encoded into a buffer that is handed to the shuffle writer once
+  it holds the sink's write_buffer_bytes. Unless the sink allows no in-flight
+  buffers, the shuffle writer is called on a background thread so that
+  encoding the next buffer overlaps with writing the previous ones.
+  """
 
-  def __init__(self, shuffle_sink, writer=None):
+  def __init__(self, shuffle_sink, writer=None, counter_prefix='ShuffleSink'):
     self.sink = shuffle_sink
     self.writer = writer
     self.stream = StringIO.StringIO()
     self.bytes_buffered = 0
+    self.key_coder_impl = shuffle_sink.key_coder.get_impl()
+    self.value_coder_impl = shuffle_sink.value_coder.get_impl()
+    self.flusher = None
+    self.bytes_written_counter = Counter(
+        '%s-ShuffleBytesWritten' % counter_prefix, Counter.SUM)
+    self.flush_msecs_counter = Counter(
+        '%s-ShuffleFlushMsecs' % counter_prefix, Counter.SUM)
+    self.blocked_msecs_counter = Counter(
+        '%s-ShuffleWriteBlockedMsecs' % counter_prefix, Counter.SUM)
 
   def __enter__(self):
     if self.writer is None:
       self.writer = shuffle_client.PyShuffleWriter(
           _shuffle_decode(self.sink.config_bytes))
+    if self.sink.max_in_flight_write_buffers > 0:
+      self.flusher = ShuffleBufferFlusher(
+          self.writer, self.sink.max_in_flight_write_buffers,
+          self.flush_msecs_counter)
     return self
 
   def __exit__(self, exception_type, exception_value, traceback):
-    value = self.stream.getvalue()
-    if value:
-      self.writer.Write(value)
-      self.bytes_buffered = 0
-    self.stream.close()
-    self.writer.Close()
+    try:
+      try:
+        if self.bytes_buffered:
+          self._flush()
+      finally:
+        if self.flusher is not None:
+          self.flusher.close()
+    finally:
+      self.stream.close()
+      self.writer.Close()
 
   def Write(self, key, secondary_key, value):
+    # Entries are encoded as they are written, so that the buffer is bounded
+    # in bytes and holds no references to objects which the DoFn may mutate.
+    encoded_key = self.key_coder_impl.encode(key)
+    # The secondary key is usually the key itself; avoid encoding it twice.
+    if secondary_key is key:
+      encoded_secondary_key = encoded_key
+    else:
+      encoded_secondary_key = self.key_coder_impl.encode(secondary_key)
     entry = ShuffleEntry(
-        self.sink.key_coder.encode(key),
-        self.sink.key_coder.encode(secondary_key),
-        self.sink.value_coder.encode(value),
-        position=None)
+        encoded_key, encoded_secondary_key,
+        self.value_coder_impl.encode(value), position=None)
     entry.to_bytes(self.stream, with_position=False)
     self.bytes_buffered += entry.size
-    if self.bytes_buffered > 10 << 20:
-      self.writer.Write(self.stream.getvalue())
-      self.stream.close()
-      self.stream = StringIO.StringIO()
-      self.bytes_buffered = 0
+    if self.bytes_buffered >= self.sink.write_buffer_bytes:
+      self._flush()
+
+  def itercounters(self):
+    yield self.bytes_written_counter
+    yield self.flush_msecs_counter
+    yield self.blocked_msecs_counter
+
+  def _flush(self):
+    """Hands the encoded entries over to the shuffle writer."""
+    buf = self.stream.getvalue()
+    self.stream.close()
+    self.stream = StringIO.StringIO()
+    self.bytes_buffered = 0
+    if self.flusher is None:
+      start_time = time.time()
+      self.writer.Write(buf)
+      blocked_secs = time.time() - start_time
+      self.flush_msecs_counter.update(int(blocked_secs * 1000))
+    else:
+      blocked_secs = self.flusher.add(buf)
+    self.blocked_msecs_counter.update(int(blocked_secs * 1000))
+    self.bytes_written_counter.update(len(buf))
 
 
 class ShuffleSink(iobase.NativeSink):
   """A sink that writes to a shuffled dataset."""
 
-  def __init__(self, config_bytes, coder):
+  def __init__(self, config_bytes, coder,
+               write_buffer_bytes=DEFAULT_WRITE_BUFFER_BYTES,
+               max_in_flight_write_buffers=DEFAULT_MAX_IN_FLIGHT_WRITE_BUFFERS):
     self.config_bytes = config_bytes
+    self.write_buffer_bytes = write_buffer_bytes
+    self.max_in_flight_write_buffers = max_in_flight_write_buffers
     self.key_coder, self.value_coder = (
         coder if isinstance(coder, tuple) else (coder, coder))
 
-  def writer(self, test_writer=None):
-    return ShuffleSinkWriter(self, writer=test_writer)
+  def writer(self, test_writer=None, counter_prefix='ShuffleSink'):
+    return ShuffleSinkWriter(self, writer=test_writer,
+                             counter_prefix=counter_prefix)
@@ -17,16 +17,21 @@
 import base64
 import cStringIO as StringIO
 import logging
+import threading
 import unittest
 
+from google.cloud.dataflow import coders
 from google.cloud.dataflow.io import iobase
 from google.cloud.dataflow.worker.shuffle import GroupedShuffleSource
+from google.cloud.dataflow.worker.shuffle import ShuffleBufferFlusher
+from google.cloud.dataflow.worker.shuffle import ShuffleChunkPrefetcher
 from google.cloud.dataflow.worker.shuffle import ShuffleEntry
 from google.cloud.dataflow.worker.shuffle import ShuffleSink
 from google.cloud.dataflow.worker.shuffle import UngroupedShuffleSource
+import mock
 
 
-class Base64Coder(object):
+class Base64Coder(coders.Coder):
   """Simple base64 coder used throughout the tests."""
 
   def decode(self, o):
@@ -101,9 +106,14 @@ class FakeShuffleWriter(object):
     # The list of (key, 2nd-key, value) tuples written. The attribute will
     # get its real value only when close() is called.
     self.values = []
+    self.bytes_written = 0
+    self.buffer_sizes = []
+    self.closed = False
     self._entries = []
 
   def Write(self, entries):  # pylint: disable=invalid-name
+    self.bytes_written += len(entries)
+    self.buffer_sizes.append(len(entries))
     stream = StringIO.StringIO(entries)
     # TODO(silviuc): Find a better way to detect EOF for a string stream.
     while stream.tell() < len(stream.getvalue()):
@@ -111,6 +121,7 @@ class FakeShuffleWriter(object):
           ShuffleEntry.from_stream(stream, with_position=False))
 
   def Close(self):  # pylint: disable=invalid-name
+    self.closed = True
     coder = Base64Coder()
     for entry in self._entries:
       self.values.append((
@@ -119,6 +130,51 @@ class FakeShuffleWriter(object):
           coder.decode(entry.value)))
 
 
+class BlockingShuffleWriter(FakeShuffleWriter):
+  """A fake shuffle writer whose writes wait until they are released."""
+
+  def __init__(self):
+    super(BlockingShuffleWriter, self).__init__()
+    self.writes_started = 0
+    self.write_started = threading.Event()
+    self.released = threading.Event()
+    self._lock = threading.Lock()
+
+  def Write(self, entries):  # pylint: disable=invalid-name
+    with self._lock:
+      self.writes_started += 1
+    self.write_started.set()
+    self.released.wait()
+    super(BlockingShuffleWriter, self).Write(entries)
+
+
+class RecordingEntries(object):
+  """An iterable of entries recording how many were taken from it."""
+
+  def __init__(self, entries):
+    self.entries = entries
+    self.taken = 0
+    self.taken_changed = threading.Condition()
+
+  def __iter__(self):
+    for entry in self.entries:
+      with self.taken_changed:
+        self.taken += 1
+        self.taken_changed.notify_all()
+      yield entry
+
+  def wait_for_taken(self, count):
+    with self.taken_changed:
+      while self.taken < count:
+        self.taken_changed.wait(1)
+
+
+class FailingShuffleWriter(FakeShuffleWriter):
+
+  def Write(self, entries):  # pylint: disable=invalid-name
+    raise IOError('Shuffle unavailable.')
+
+
 class TestShuffleEntry(unittest.TestCase):
 
   def test_basics(self):
@@ -311,6 +367,25 @@ class TestGroupedShuffleSource(unittest.TestCase):
     self.assertEqual(list(saved_iterators['b']), ['0', '1'])
     self.assertEqual(list(saved_iterators['c']), ['0', '1', '2', '3', '4'])
 
+  def test_reiteration_while_reading(self):
+    source = GroupedShuffleSource(
+        config_bytes='not used', coder=Base64Coder())
+
+    chunks = [TEST_CHUNK1, TEST_CHUNK2]
+    result = []
+    with source.reader(test_reader=FakeShuffleReader(chunks)) as reader:
+      for key, key_values in reader:
+        values = iter(key_values)
+        first = next(values)
+        # Reiterating reads the key's values again without disturbing the
+        # values iterator that is in progress.
+        result.append((key, first, list(key_values), list(values)))
+    self.assertEqual(
+        [('a', '1', ['1'], []),
+         ('b', '0', ['0', '1'], ['1']),
+         ('c', '0', ['0', '1', '2', '3', '4'], ['1', '2', '3', '4'])],
+        result)
+
   def test_iterator_drained(self):
     result = []
     source = GroupedShuffleSource(
@@ -329,6 +404,98 @@ class TestGroupedShuffleSource(unittest.TestCase):
     self.assertEqual([('a', '1'), ('b', '0'), ('c', '0')], result)
 
 
+class RecordingShuffleReader(FakeShuffleReader):
+  """A fake shuffle reader recording the positions read from."""
+
+  def __init__(self, chunk_descriptors):
+    super(RecordingShuffleReader, self).__init__(chunk_descriptors)
+    self.reads = []
+    self.reads_changed = threading.Condition()
+
+  def Read(self, first, last):  # pylint: disable=invalid-name
+    result = super(RecordingShuffleReader, self).Read(first, last)
+    with self.reads_changed:
+      self.reads.append((first, last))
+      self.reads_changed.notify_all()
+    return result
+
+  def wait_for_reads(self, count):
+    with self.reads_changed:
+      while len(self.reads) < count:
+        self.reads_changed.wait(1)
+
+
+class FailingShuffleReader(object):
+
+  def Read(self, first, last):  # pylint: disable=invalid-name
+    raise IOError('Shuffle unavailable.')
+
+
+class TestShuffleChunkPrefetcher(unittest.TestCase):
+
+  def test_reads_all_chunks(self):
+    chunks = [TEST_CHUNK1, TEST_CHUNK2, TEST_CHUNK1]
+    reader = FakeShuffleReader(chunks)
+    prefetcher = ShuffleChunkPrefetcher(reader, '', '', 1 << 20)
+    expected, position = [], ''
+    for _ in chunks:
+      expected.append(reader.Read(position, ''))
+      position = expected[-1][1]
+    self.assertEqual(expected, [prefetcher.next_chunk() for _ in chunks])
+
+  def test_bounded_read_ahead(self):
+    reader = RecordingShuffleReader([TEST_CHUNK1, TEST_CHUNK2, TEST_CHUNK1])
+    prefetcher = ShuffleChunkPrefetcher(reader, '', '', 1)
+    # Wait until the first chunk is buffered. It exceeds the bound, so from
+    # then on the prefetch thread is blocked until the chunk is consumed.
+    with prefetcher._lock:  # pylint: disable=protected-access
+      while not prefetcher._chunks:  # pylint: disable=protected-access
+        prefetcher._lock.wait()  # pylint: disable=protected-access
+      self.assertEqual([('', '')], reader.reads)
+    prefetcher.next_chunk()
+    reader.wait_for_reads(2)
+    self.assertEqual([('', ''), ('4', '')], reader.reads)
+    prefetcher.close()
+    with self.assertRaises(RuntimeError):
+      prefetcher.next_chunk()
+
+  def test_read_error(self):
+    prefetcher = ShuffleChunkPrefetcher(FailingShuffleReader(), '', '', 1)
+    with self.assertRaises(IOError):
+      prefetcher.next_chunk()
+
+  def test_grouped_read_with_and_without_prefetching(self):
+    chunks = [TEST_CHUNK1, TEST_CHUNK2, [('d', '0')]]
+    for max_prefetch_bytes in (0, 1, 1 << 20):
+      source = GroupedShuffleSource(
+          config_bytes='not used', coder=Base64Coder(),
+          max_prefetch_bytes=max_prefetch_bytes)
+      result = []
+      with source.reader(test_reader=FakeShuffleReader(chunks)) as reader:
+        for key, key_values in reader:
+          result.append((key, list(key_values), list(key_values)))
+      self.assertEqual(
+          [('a', ['1'], ['1']), ('b', ['0', '1'], ['0', '1']),
+           ('c', ['0', '1', '2', '3', '4'], ['0', '1', '2', '3', '4']),
+           ('d', ['0'], ['0'])],
+          result)
+
+  def test_no_read_ahead_by_default(self):
+    source = GroupedShuffleSource(config_bytes='not used', coder=Base64Coder())
+    recording_reader = RecordingShuffleReader([TEST_CHUNK1, TEST_CHUNK2])
+    with source.reader(test_reader=recording_reader) as reader:
+      key, key_values = next(iter(reader))
+      self.assertEqual(('a', ['1']), (key, list(key_values)))
+      # Only the chunk being decoded was read.
+      self.assertEqual([('', '')], recording_reader.reads)
+
+  def test_grouped_read_error(self):
+    source = GroupedShuffleSource(config_bytes='not used', coder=Base64Coder())
+    with source.reader(test_reader=FailingShuffleReader()) as reader:
+      with self.assertRaises(IOError):
+        list(reader)
+
+
 class TestUngroupedShuffleSource(unittest.TestCase):
 
   def test_basics(self):
@@ -355,6 +522,110 @@ class TestShuffleSink(unittest.TestCase):
         writer.Write(*entry)
     self.assertEqual(entries, fake_writer.values)
 
+  def test_batches_across_flushes(self):
+    source = ShuffleSink(config_bytes='not used', coder=Base64Coder())
+    entries = [(str(i), str(i) if i % 3 else '2nd', str(i * i))
+               for i in range(2500)]
+    fake_writer = FakeShuffleWriter()
+    with source.writer(test_writer=fake_writer) as writer:
+      for entry in entries:
+        writer.Write(*entry)
+    self.assertEqual(entries, fake_writer.values)
+
+  def _write_entries(self, sink, fake_writer, entries, counter_prefix='s1'):
+    with sink.writer(test_writer=fake_writer,
+                     counter_prefix=counter_prefix) as writer:
+      for entry in entries:
+        writer.Write(*entry)
+    return writer
+
+  def _expected_buffers(self, entries, write_buffer_bytes):
+    coder = Base64Coder()
+    buffers, bytes_buffered = 0, 0
+    for key, secondary_key, value in entries:
+      bytes_buffered += ShuffleEntry(
+          coder.encode(key), coder.encode(secondary_key), coder.encode(value),
+          position=None).size
+      if bytes_buffered >= write_buffer_bytes:
+        buffers, bytes_buffered = buffers + 1, 0
+    return buffers + (1 if bytes_buffered else 0)
+
+  def test_synchronous_and_asynchronous_writes(self):
+    entries = [(str(i), str(i), str(i * i)) for i in range(5500)]
+    for max_in_flight_buffers in (0, 1, 3):
+      sink = ShuffleSink(config_bytes='not used', coder=Base64Coder(),
+                         write_buffer_bytes=1 << 10,
+                         max_in_flight_write_buffers=max_in_flight_buffers)
+      fake_writer = FakeShuffleWriter()
+      writer = self._write_entries(sink, fake_writer, entries)
+      self.assertEqual(entries, fake_writer.values)
+      counters = dict((c.name, c) for c in writer.itercounters())
+      bytes_written = counters['s1-ShuffleBytesWritten']
+      # Entries are buffered until they reach write_buffer_bytes.
+      buffers = len(fake_writer.buffer_sizes)
+      self.assertEqual(self._expected_buffers(entries, 1 << 10), buffers)
+      self.assertEqual(buffers, bytes_written.elements)
+      self.assertEqual(fake_writer.bytes_written, bytes_written.total)
+      self.assertEqual(buffers, counters['s1-ShuffleFlushMsecs'].elements)
+      self.assertEqual(
+          buffers, counters['s1-ShuffleWriteBlockedMsecs'].elements)
+
+  def test_bounded_in_flight_buffers(self):
+    entries = [(str(i), str(i), str(i)) for i in range(50)]
+    recording_entries = RecordingEntries(entries)
+    sink = ShuffleSink(config_bytes='not used', coder=Base64Coder(),
+                       write_buffer_bytes=1,
+                       max_in_flight_write_buffers=2)
+    fake_writer = BlockingShuffleWriter()
+    thread = threading.Thread(
+        target=self._write_entries,
+        args=(sink, fake_writer, recording_entries))
+    thread.start()
+    # Every entry fills a buffer. Once the first buffer is being written and
+    # the third entry was taken, the second buffer waits and the producer can
+    # only hand over the third one when the first write completes.
+    fake_writer.write_started.wait()
+    recording_entries.wait_for_taken(3)
+    self.assertEqual(1, fake_writer.writes_started)
+    self.assertEqual(3, recording_entries.taken)
+    self.assertTrue(thread.is_alive())
+    fake_writer.released.set()
+    thread.join()
+    self.assertEqual(len(entries), fake_writer.writes_started)
+    self.assertEqual(entries, fake_writer.values)
+
+  def test_write_error(self):
+    entries = [(str(i), str(i), str(i)) for i in range(5000)]
+    for max_in_flight_buffers in (0, 2):
+      sink = ShuffleSink(config_bytes='not used', coder=Base64Coder(),
+                         write_buffer_bytes=1,
+                         max_in_flight_write_buffers=max_in_flight_buffers)
+      with self.assertRaises(IOError):
+        self._write_entries(sink, FailingShuffleWriter(), entries)
+
+  def test_close_after_flush_error(self):
+    sink = ShuffleSink(config_bytes='not used', coder=Base64Coder(),
+                       max_in_flight_write_buffers=2)
+    fake_writer = FakeShuffleWriter()
+    writer = sink.writer(test_writer=fake_writer)
+    with mock.patch.object(ShuffleBufferFlusher, 'add',
+                           side_effect=IOError('Flush failed.')):
+      with self.assertRaisesRegexp(IOError, 'Flush failed.'):
+        with writer:
+          writer.Write('a', 'a', '1')
+    # pylint: disable=protected-access
+    self.assertFalse(writer.flusher._thread.is_alive())
+    self.assertTrue(fake_writer.closed)
+
+  def test_close_after_write_error(self):
+    for max_in_flight_buffers in (0, 2):
+      sink = ShuffleSink(config_bytes='not used', coder=Base64Coder(),
+                         max_in_flight_write_buffers=max_in_flight_buffers)
+      fake_writer = FailingShuffleWriter()
+      with self.assertRaises(IOError):
+        self._write_entries(sink, fake_writer, [('a', 'a', '1')])
+      self.assertTrue(fake_writer.closed)
+
 
 if __name__ == '__main__':
   logging.getLogger().setLevel(logging.INFO)
@@ -0,0 +1,134 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+cimport libc.stdint
+cimport libc.stdlib
+cimport libc.string
+
+
+cdef inline libc.stdint.uint32_t _read_uint32(const unsigned char* p):
+  return ((<libc.stdint.uint32_t>p[0] << 24) | (p[1] << 16) | (p[2] << 8)
+          | p[3])
+
+
+cdef class ShuffleChunk(object):
+  """An index over the entries of a chunk read from shuffle.
+
+  A chunk is a sequence of entries, each made of a position, a key, a
+  secondary key and a value, every field prefixed by its length as a 32-bit
+  big-endian integer. The chunk is scanned once on construction, recording
+  where each field starts; fields are then accessed by entry index without
+  further parsing.
+  """
+
+  # The offsets of the position, key, secondary key and value of each entry.
+  cdef libc.stdint.uint32_t* offsets
+  cdef Py_ssize_t count
+  cdef Py_ssize_t capacity
+  cdef char* data
+  cdef readonly bytes buffer
+
+  def __cinit__(self, bytes buffer):
+    cdef size_t length = len(buffer)
+    cdef size_t pos = 0
+    cdef libc.stdint.uint32_t field_length
+    cdef int field
+    cdef libc.stdint.uint32_t* offsets
+    if length > 0xFFFFFFFF:
+      raise ValueError('Shuffle chunks are limited to 4GB.')
+    self.buffer = buffer
+    self.data = buffer
+    while pos < length:
+      if self.count == self.capacity:
+        self.capacity = 2 * self.capacity + 64
+        offsets = <libc.stdint.uint32_t*>libc.stdlib.realloc(
+            self.offsets, 4 * self.capacity * sizeof(libc.stdint.uint32_t))
+        if offsets == NULL:
+          raise MemoryError()
+        self.offsets = offsets
+      for field in range(4):
+        if length - pos < 4:
+          raise ValueError('Truncated shuffle chunk.')
+        field_length = _read_uint32(<unsigned char*>self.data + pos)
+        pos += 4
+        if field_length > length - pos:
+          raise ValueError('Truncated shuffle chunk.')
+        self.offsets[4 * self.count + field] = pos
+        pos += field_length
+      self.count += 1
+
+  def __dealloc__(self):
+    if self.offsets:
+      libc.stdlib.free(self.offsets)
+
+  def __len__(self):
+    return self.count
+
+  cdef inline _check_index(self, Py_ssize_t i):
+    if not 0 <= i < self.count:
+      raise IndexError('Shuffle chunk entry index out of range: %d.' % i)
+
+  cdef inline size_t _field_end(self, Py_ssize_t i, int field):
+    if field < 3:
+      return self.offsets[4 * i + field + 1] - 4
+    elif i + 1 < self.count:
+      return self.offsets[4 * (i + 1)] - 4
+    else:
+      return len(self.buffer)
+
+  cdef inline bytes _field(self, Py_ssize_t i, int field):
+    self._check_index(i)
+    return self.data[self.offsets[4 * i + field]:self._field_end(i, field)]
+
+  cpdef bytes position(self, Py_ssize_t i):
+    return self._field(i, 0)
+
+  cpdef bytes key(self, Py_ssize_t i):
+    return self._field(i, 1)
+
+  cpdef bytes secondary_key(self, Py_ssize_t i):
+    return self._field(i, 2)
+
+  cpdef bytes value(self, Py_ssize_t i):
+    return self._field(i, 3)
+
+  cpdef size_t value_start(self, Py_ssize_t i) except? -1:
+    self._check_index(i)
+    return self.offsets[4 * i + 3]
+
+  cpdef size_t value_end(self, Py_ssize_t i) except? -1:
+    self._check_index(i)
+    return self._field_end(i, 3)
+
+  cpdef size_t entry_size(self, Py_ssize_t i) except? -1:
+    """Returns the size of the serialized entry, including length prefixes."""
+    self._check_index(i)
+    return self._field_end(i, 3) - self.offsets[4 * i] + 4
+
+  cpdef bint key_equals(self, Py_ssize_t i, bytes key) except -1:
+    cdef size_t start
+    self._check_index(i)
+    start = self.offsets[4 * i + 1]
+    return (self._field_end(i, 1) - start == len(key)
+            and libc.string.memcmp(self.data + start, <char*>key,
+                                   len(key)) == 0)
+
+  cpdef Py_ssize_t group_end(self, Py_ssize_t i, bytes key) except -1:
+    """Returns the index of the first entry from i on not having key.
+
+    Returns len(self) if all remaining entries have the key.
+    """
+    while i < self.count and self.key_equals(i, key):
+      i += 1
+    return i
@@ -0,0 +1,90 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the shuffle chunk index implementations."""
+
+import struct
+import unittest
+
+from google.cloud.dataflow.worker import slow_shufflechunk
+
+
+def encode_entries(entries):
+  return ''.join(
+      ''.join(struct.pack('>I', len(field)) + field for field in entry)
+      for entry in entries)
+
+
+class ShuffleChunkTest(unittest.TestCase):
+  ShuffleChunk = slow_shufflechunk.ShuffleChunk
+
+  ENTRIES = [('p0', 'a', '', 'v0'),
+             ('p1', 'b', 's', ''),
+             ('p2', 'b', 's', 'value2'),
+             ('p3', 'bb', '', 'v3')]
+
+  def test_empty(self):
+    self.assertEqual(0, len(self.ShuffleChunk('')))
+
+  def test_fields(self):
+    buffer = encode_entries(self.ENTRIES)
+    chunk = self.ShuffleChunk(buffer)
+    self.assertEqual(len(self.ENTRIES), len(chunk))
+    for i, (position, key, secondary_key, value) in enumerate(self.ENTRIES):
+      self.assertEqual(position, chunk.position(i))
+      self.assertEqual(key, chunk.key(i))
+      self.assertEqual(secondary_key, chunk.secondary_key(i))
+      self.assertEqual(value, chunk.value(i))
+      self.assertEqual(
+          value, buffer[chunk.value_start(i):chunk.value_end(i)])
+      self.assertEqual(len(encode_entries([self.ENTRIES[i]])),
+                       chunk.entry_size(i))
+    self.assertEqual(len(buffer), sum(chunk.entry_size(i)
+                                      for i in range(len(chunk))))
+    with self.assertRaises(IndexError):
+      chunk.key(len(self.ENTRIES))
+    with self.assertRaises(IndexError):
+      chunk.value_start(-1)
+
+  def test_groups(self):
+    chunk = self.ShuffleChunk(encode_entries(self.ENTRIES))
+    self.assertTrue(chunk.key_equals(1, 'b'))
+    self.assertFalse(chunk.key_equals(3, 'b'))
+    self.assertEqual(1, chunk.group_end(0, 'a'))
+    self.assertEqual(3, chunk.group_end(1, 'b'))
+    self.assertEqual(2, chunk.group_end(2, 'a'))
+    self.assertEqual(4, chunk.group_end(3, 'bb'))
+    self.assertEqual(4, chunk.group_end(4, 'bb'))
+
+  def test_truncated(self):
+    buffer = encode_entries(self.ENTRIES)
+    for size in (3, len(buffer) - 1):
+      with self.assertRaises(ValueError):
+        self.ShuffleChunk(buffer[:size])
+
+
+try:
+  # pylint: disable=g-import-not-at-top
+  from google.cloud.dataflow.worker import shufflechunk
+
+  class FastShuffleChunkTest(ShuffleChunkTest):
+    """Runs the test with the compiled shuffle chunk index."""
+    ShuffleChunk = shufflechunk.ShuffleChunk
+
+except ImportError:
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,92 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A pure Python implementation of shufflechunk.pyx."""
+
+import array
+import struct
+
+
+class ShuffleChunk(object):
+  """A pure Python implementation of shufflechunk.ShuffleChunk."""
+
+  def __init__(self, buffer):
+    self.buffer = buffer
+    # The offsets of the position, key, secondary key and value of each entry.
+    self._offsets = offsets = array.array('L')
+    length = len(buffer)
+    pos = 0
+    unpack_from = struct.unpack_from
+    while pos < length:
+      for _ in range(4):
+        if length - pos < 4:
+          raise ValueError('Truncated shuffle chunk.')
+        field_length = unpack_from('>I', buffer, pos)[0]
+        pos += 4
+        if field_length > length - pos:
+          raise ValueError('Truncated shuffle chunk.')
+        offsets.append(pos)
+        pos += field_length
+    self._count = len(offsets) // 4
+
+  def __len__(self):
+    return self._count
+
+  def _check_index(self, i):
+    if not 0 <= i < self._count:
+      raise IndexError('Shuffle chunk entry index out of range: %d.' % i)
+
+  def _field_end(self, i, field):
+    if field < 3:
+      return self._offsets[4 * i + field + 1] - 4
+    elif i + 1 < self._count:
+      return self._offsets[4 * (i + 1)] - 4
+    else:
+      return len(self.buffer)
+
+  def _field(self, i, field):
+    self._check_index(i)
+    return self.buffer[self._offsets[4 * i + field]:self._field_end(i, field)]
+
+  def position(self, i):
+    return self._field(i, 0)
+
+  def key(self, i):
+    return self._field(i, 1)
+
+  def secondary_key(self, i):
+    return self._field(i, 2)
+
+  def value(self, i):
+    return self._field(i, 3)
+
+  def value_start(self, i):
+    self._check_index(i)
+    return self._offsets[4 * i + 3]
+
+  def value_end(self, i):
+    self._check_index(i)
+    return self._field_end(i, 3)
+
+  def entry_size(self, i):
+    self._check_index(i)
+    return self._field_end(i, 3) - self._offsets[4 * i] + 4
+
+  def key_equals(self, i, key):
+    return self.key(i) == key
+
+  def group_end(self, i, key):
+    while i < self._count and self.key_equals(i, key):
+      i += 1
+    return i
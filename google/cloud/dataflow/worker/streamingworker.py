@@ -16,8 +16,11 @@
 
 from __future__ import absolute_import
 
+import collections
 import logging
 import random
+import sys
+import threading
 import time
 import traceback
 
@@ -71,13 +74,40 @@ class WindmillClient(object):
 # pylint: enable=invalid-name
 
 
+# A work item scheduled for execution, with the context needed to execute it.
+# The size is the number of bytes of the work item counted against the
+# in-flight bytes of the worker until its results are committed.
+_Work = collections.namedtuple(
+    '_Work', ['computation_id', 'map_task_proto', 'input_data_watermark',
+              'work_item', 'size'])
+
+
 class StreamingWorker(object):
-  """A streaming worker that communicates with Windmill."""
+  """A streaming worker that communicates with Windmill.
+
+  Work items are fetched from Windmill by the dispatch loop, executed by a
+  pool of work threads and their results are committed back to Windmill in
+  batches by a commit thread. Work items of a given key are executed one at a
+  time, in the order they were received: a work item is only executed once the
+  results of the previous work item for its key have been committed. Fetching
+  work stops while the work items fetched but not yet committed exceed the
+  worker's maximum in-flight bytes.
+  """
 
   # Maximum size of the result of a GetWork request.
   MAX_GET_WORK_FETCH_BYTES = 64 << 20  # 64m
   # Maximum number of items to return in a GetWork request.
   MAX_GET_WORK_ITEMS = 100
+  # Maximum size of a CommitWork request, unless a single work item commit is
+  # larger.
+  MAX_COMMIT_BYTES = 32 << 20  # 32m
+
+  # Default number of threads executing work items.
+  DEFAULT_NUM_WORK_THREADS = 4
+  # Default maximum size of the work items fetched but not yet committed.
+  DEFAULT_MAX_IN_FLIGHT_BYTES = 256 << 20  # 256m
+  # Default maximum size of the state cached across work items.
+  DEFAULT_STATE_CACHE_BYTES = 64 << 20  # 64m
 
   # TODO(altay): Remove windmill default port and host.
   WINDMILL_DEFAULT_PORT = 12355
@@ -101,19 +131,81 @@ class StreamingWorker(object):
                  windmill_port)
     self.windmill = WindmillClient(windmill_host, windmill_port)
 
+    self.num_work_threads = int(properties.get(
+        'streaming.num_work_threads',
+        StreamingWorker.DEFAULT_NUM_WORK_THREADS))
+    self.max_in_flight_bytes = int(properties.get(
+        'streaming.max_in_flight_bytes',
+        StreamingWorker.DEFAULT_MAX_IN_FLIGHT_BYTES))
+    self.state_cache = windmillstate.WindmillStateCache(int(properties.get(
+        'streaming.state_cache_bytes',
+        StreamingWorker.DEFAULT_STATE_CACHE_BYTES)))
+
     self.instruction_map = {}
     self.system_name_to_computation_id_map = {}
 
+    # Guards the attributes below, which are shared between the dispatch loop,
+    # the work threads and the commit thread.
+    self._lock = threading.Condition()
+    # Work items ready to be executed.
+    self._ready_work = collections.deque()
+    # The keys having a work item being executed or committed, as
+    # (computation_id, key) tuples, mapped to the deque of work items received
+    # for the key in the meantime.
+    self._active_keys = {}
+    # Executed work items waiting to be committed, as (work, commit request,
+    # state cache, commit request size) tuples.
+    self._pending_commits = collections.deque()
+    # The number of work items being executed by the work threads.
+    self._num_executing = 0
+    self._in_flight_bytes = 0
+    self._exc_info = None
+    self.running = False
+    # Holds the map tasks decoded by each work thread, see get_map_task().
+    self._thread_state = threading.local()
+
   def run(self):
     self.running = True
-    # TODO(ccy): support multi-threaded or multi-process execution.
-    self.dispatch_loop()
-
-  def get_work(self):
+    threads = [threading.Thread(target=self.work_loop)
+               for _ in range(self.num_work_threads)]
+    threads.append(threading.Thread(target=self.commit_loop))
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    try:
+      self.dispatch_loop()
+    finally:
+      self.stop()
+    for thread in threads:
+      thread.join()
+    self._raise_if_failed()
+
+  def stop(self):
+    """Stops fetching and executing work.
+
+    The results of the work items executed so far are still committed.
+    """
+    with self._lock:
+      self.running = False
+      self._lock.notify_all()
+
+  def _fail(self):
+    """Records the exception being handled and stops the worker."""
+    with self._lock:
+      if not self._exc_info:
+        self._exc_info = sys.exc_info()
+      self.running = False
+      self._lock.notify_all()
+
+  def _raise_if_failed(self):
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+  def get_work(self, max_bytes=MAX_GET_WORK_FETCH_BYTES):
     request = windmill_pb2.GetWorkRequest(
         client_id=self.client_id,
         max_items=StreamingWorker.MAX_GET_WORK_ITEMS,
-        max_bytes=StreamingWorker.MAX_GET_WORK_FETCH_BYTES)
+        max_bytes=max_bytes)
     return self.windmill.GetWork(request)
 
   def add_computation(self, map_task):
@@ -141,15 +233,40 @@ class StreamingWorker(object):
 
     return response
 
+  def wait_for_capacity(self):
+    """Waits until the in-flight bytes leave room to fetch more work.
+
+    Returns:
+      The number of bytes of work that can be fetched, or 0 if the worker was
+      stopped in the meantime.
+
+    Raises:
+      The exception raised while executing or committing a work item, if any.
+    """
+    with self._lock:
+      while (self.running and
+             self._in_flight_bytes >= self.max_in_flight_bytes):
+        self._lock.wait()
+      self._raise_if_failed()
+      if not self.running:
+        return 0
+      return min(StreamingWorker.MAX_GET_WORK_FETCH_BYTES,
+                 self.max_in_flight_bytes - self._in_flight_bytes)
+
   def dispatch_loop(self):
     while self.running:
       backoff_seconds = 0.001
       while self.running:
-        work_response = self.get_work()
+        max_bytes = self.wait_for_capacity()
+        if not max_bytes:
+          return
+        work_response = self.get_work(max_bytes)
         if work_response.work:
           break
         time.sleep(backoff_seconds)
         backoff_seconds = min(1.0, backoff_seconds * 2)
+      else:
+        return
 
       for computation_work in work_response.work:
         computation_id = computation_work.computation_id
@@ -158,48 +275,168 @@ class StreamingWorker(object):
           self.get_config(computation_id)
         map_task_proto = self.instruction_map[computation_id]
         for work_item in computation_work.work:
-          try:
-            self.process(computation_id, map_task_proto, input_data_watermark,
-                         work_item)
-          except:
-            logging.error(
-                'Exception while processing work item for computation %r: '
-                '%s, %s', computation_id, work_item, traceback.format_exc())
-            raise
+          self.schedule(_Work(computation_id, map_task_proto,
+                              input_data_watermark, work_item,
+                              work_item.ByteSize()))
+
+  def schedule(self, work):
+    """Queues a work item for execution once its key is no longer active."""
+    key = (work.computation_id, work.work_item.key)
+    with self._lock:
+      self._in_flight_bytes += work.size
+      if key in self._active_keys:
+        self._active_keys[key].append(work)
+      else:
+        self._active_keys[key] = collections.deque()
+        self._ready_work.append(work)
+        self._lock.notify_all()
+
+  def work_loop(self):
+    """Executes ready work items and queues their results to be committed."""
+    try:
+      while True:
+        with self._lock:
+          while self.running and not self._ready_work:
+            self._lock.wait()
+          if not self.running:
+            return
+          work = self._ready_work.popleft()
+          self._num_executing += 1
+        try:
+          workitem_commit_request, state_cache = self.process(
+              work.computation_id, work.map_task_proto,
+              work.input_data_watermark, work.work_item)
+        except:
+          logging.error(
+              'Exception while processing work item for computation %r: '
+              '%s, %s', work.computation_id, work.work_item,
+              traceback.format_exc())
+          with self._lock:
+            self._num_executing -= 1
+          raise
+        commit_size = workitem_commit_request.ByteSize()
+        with self._lock:
+          self._num_executing -= 1
+          self._pending_commits.append(
+              (work, workitem_commit_request, state_cache, commit_size))
+          self._lock.notify_all()
+    except:  # pylint: disable=bare-except
+      self._fail()
+
+  def commit_loop(self):
+    """Commits the results of executed work items to Windmill in batches.
+
+    Once a work item is committed, the state it committed is cached, its bytes
+    are released and the next work item received for its key, if any, becomes
+    ready for execution. After the worker is stopped, the loop keeps
+    committing until the work items being executed are done and their results
+    are committed.
+    """
+    try:
+      while True:
+        with self._lock:
+          while (not self._pending_commits and
+                 (self.running or self._num_executing)):
+            self._lock.wait()
+          if not self._pending_commits:
+            return
+          commits = [self._pending_commits.popleft()]
+          commit_bytes = commits[0][3]
+          while (self._pending_commits and
+                 commit_bytes + self._pending_commits[0][3] <=
+                 StreamingWorker.MAX_COMMIT_BYTES):
+            commits.append(self._pending_commits.popleft())
+            commit_bytes += commits[-1][3]
+        self.commit(
+            [(work.computation_id, workitem_commit_request)
+             for work, workitem_commit_request, _, _ in commits])
+        for _, _, state_cache, _ in commits:
+          state_cache.commit()
+        with self._lock:
+          for work, _, _, _ in commits:
+            self._in_flight_bytes -= work.size
+            key = (work.computation_id, work.work_item.key)
+            queued_work = self._active_keys[key]
+            if queued_work:
+              self._ready_work.append(queued_work.popleft())
+            else:
+              del self._active_keys[key]
+          self._lock.notify_all()
+    except:  # pylint: disable=bare-except
+      logging.error('Exception while committing work: %s',
+                    traceback.format_exc())
+      self._fail()
+
+  def commit(self, workitem_commit_requests):
+    """Sends a single commit request to Windmill.
+
+    Args:
+      workitem_commit_requests: A list of (computation_id,
+        WorkItemCommitRequest) tuples.
+    """
+    commit_request = windmill_pb2.CommitWorkRequest()
+    computation_commit_requests = {}
+    for computation_id, workitem_commit_request in workitem_commit_requests:
+      if computation_id not in computation_commit_requests:
+        computation_commit_requests[computation_id] = (
+            commit_request.requests.add(computation_id=computation_id))
+      computation_commit_requests[computation_id].requests.extend(
+          [workitem_commit_request])
+    self.windmill.CommitWork(commit_request)
+
+  def get_map_task(self, computation_id, map_task_proto):
+    """Returns the decoded map task of a computation and its context.
+
+    Each work thread decodes the map task of a computation once, as the first
+    work item of the computation is executed, and then reuses it, along with
+    the fns unpickled by its operations, for all later work items: each work
+    item only starts the execution context anew. Map tasks are not shared
+    between threads, since the operations of a map task are not thread-safe.
+
+    Returns:
+      A (MapTask, StreamingExecutionContext) tuple.
+    """
+    map_tasks = getattr(self._thread_state, 'map_tasks', None)
+    if map_tasks is None:
+      map_tasks = self._thread_state.map_tasks = {}
+    if computation_id not in map_tasks:
+      context = maptask.StreamingExecutionContext()
+      map_task = maptask.decode_map_task(
+          map_task_proto, maptask.WorkerEnvironment(), context)
+      map_task.fn_cache = {}
+      map_tasks[computation_id] = map_task, context
+    return map_tasks[computation_id]
 
   def process(self, computation_id, map_task_proto, input_data_watermark,
               work_item):
-    """Process a work item."""
+    """Process a work item.
+
+    Returns:
+      A (WorkItemCommitRequest, WindmillKeyStateCache) tuple: the request
+      holding the results of the work item, to be committed to Windmill, and
+      the view of the state cache to commit once it is.
+    """
     workitem_commit_request = windmill_pb2.WorkItemCommitRequest(
         key=work_item.key,
         work_token=work_item.work_token)
 
-    env = maptask.WorkerEnvironment()
-    context = maptask.StreamingExecutionContext()
+    map_task, context = self.get_map_task(computation_id, map_task_proto)
 
     reader = windmillstate.WindmillStateReader(
         computation_id,
         work_item.key,
         work_item.work_token,
         self.windmill)
-    state_internals = windmillstate.WindmillStateInternals(reader)
+    state_cache = self.state_cache.for_key(
+        computation_id, work_item.key, work_item.cache_token,
+        work_item.work_token)
+    state_internals = windmillstate.WindmillStateInternals(reader, state_cache)
     state = windmillstate.WindmillUnmergedState(state_internals)
 
     context.start(computation_id, work_item, input_data_watermark,
                   workitem_commit_request, self.windmill, state)
 
     map_task_executor = executor.MapTaskExecutor()
-    map_task = maptask.decode_map_task(map_task_proto, env, context)
-
     map_task_executor.execute(map_task)
     state_internals.persist_to(workitem_commit_request)
-
-    # Send result to Windmill.
-    # TODO(ccy): in the future, this will not be done serially with respect to
-    # work execution.
-    commit_request = windmill_pb2.CommitWorkRequest()
-    computation_commit_request = windmill_pb2.ComputationCommitWorkRequest(
-        computation_id=computation_id,
-        requests=[workitem_commit_request])
-    commit_request.requests.extend([computation_commit_request])
-    self.windmill.CommitWork(commit_request)
+    return workitem_commit_request, state_cache
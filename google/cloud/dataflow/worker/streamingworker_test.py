@@ -0,0 +1,257 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the scheduling of work items by the streaming worker."""
+
+import logging
+import threading
+import unittest
+
+from google.cloud.dataflow.internal import windmill_pb2
+from google.cloud.dataflow.worker import streamingworker
+import mock
+
+
+class FakeWindmillClient(object):
+  """A fake Windmill client handing out work items and recording commits."""
+
+  def __init__(self, work_items):
+    # The (key, work_token) pairs of the work items, all returned by the first
+    # GetWork request.
+    self.work_items = list(work_items)
+    # The (key, work_token) pairs of each CommitWork request.
+    self.commits = []
+    self.committed = set()
+    self.lock = threading.Condition()
+
+  def GetWork(self, request):  # pylint: disable=invalid-name
+    response = windmill_pb2.GetWorkResponse()
+    if self.work_items:
+      computation_work = response.work.add(
+          computation_id='comp', input_data_watermark=0)
+      for key, work_token in self.work_items:
+        computation_work.work.add(
+            key=key, work_token=work_token, cache_token=1)
+      self.work_items = []
+    return response
+
+  def CommitWork(self, request):  # pylint: disable=invalid-name
+    commit = [(workitem_commit_request.key, workitem_commit_request.work_token)
+              for computation_request in request.requests
+              for workitem_commit_request in computation_request.requests]
+    with self.lock:
+      self.commits.append(commit)
+      self.committed.update(commit)
+      self.lock.notify_all()
+
+  def wait_for_commits(self, count):
+    with self.lock:
+      while len(self.committed) < count:
+        self.lock.wait(1)
+
+
+class FakeStateCache(object):
+
+  def commit(self):
+    pass
+
+
+class StreamingWorkerTest(unittest.TestCase):
+
+  def create_worker(self, windmill, num_work_threads=4):
+    properties = {
+        'project_id': 'project',
+        'job_id': 'job',
+        'worker_id': 'worker',
+        'dataflow.worker.logging.location': 'not used',
+        'streaming.num_work_threads': num_work_threads,
+    }
+    with mock.patch.object(streamingworker.logger, 'initialize'):
+      with mock.patch.object(streamingworker, 'WindmillClient',
+                             return_value=windmill):
+        worker = streamingworker.StreamingWorker(properties)
+    worker.instruction_map['comp'] = None
+    return worker
+
+  def run_worker(self, worker, windmill, num_work_items):
+    """Runs the worker until the given number of work items are committed."""
+    def stop_when_committed():
+      windmill.wait_for_commits(num_work_items)
+      worker.stop()
+    thread = threading.Thread(target=stop_when_committed)
+    thread.start()
+    try:
+      worker.run()
+    finally:
+      worker.stop()
+      thread.join()
+
+  def test_work_items_of_a_key_are_executed_in_turn(self):
+    work_items = [('k%d' % (i % 3), i) for i in range(30)]
+    windmill = FakeWindmillClient(work_items)
+    worker = self.create_worker(windmill)
+    lock = threading.Lock()
+    executing_keys = set()
+    executed = []
+    violations = []
+
+    def process(computation_id, unused_map_task_proto,
+                unused_input_data_watermark, work_item):
+      key, work_token = work_item.key, work_item.work_token
+      with lock:
+        if key in executing_keys:
+          violations.append('%s is already executing' % key)
+        executing_keys.add(key)
+      # All the previous work items of the key must have been committed.
+      with windmill.lock:
+        for previous_key, previous_token in work_items:
+          if (previous_key == key and previous_token < work_token and
+              (previous_key, previous_token) not in windmill.committed):
+            violations.append('%s executed before %s was committed' % (
+                (key, work_token), (previous_key, previous_token)))
+      with lock:
+        executing_keys.remove(key)
+        executed.append((key, work_token))
+      return (windmill_pb2.WorkItemCommitRequest(key=key,
+                                                 work_token=work_token),
+              FakeStateCache())
+
+    worker.process = process
+    self.run_worker(worker, windmill, len(work_items))
+    self.assertEqual([], violations)
+    for key in ('k0', 'k1', 'k2'):
+      self.assertEqual([item for item in work_items if item[0] == key],
+                       [item for item in executed if item[0] == key])
+    self.assertEqual(set(work_items), windmill.committed)
+    # pylint: disable=protected-access
+    self.assertEqual(0, worker._in_flight_bytes)
+
+  def test_commits_are_batched(self):
+    work_items = [('k%d' % i, i) for i in range(10)]
+    windmill = FakeWindmillClient(work_items)
+    worker = self.create_worker(windmill)
+    commit_sizes = {}
+    all_executed = threading.Event()
+    lock = threading.Lock()
+
+    def process(computation_id, unused_map_task_proto,
+                unused_input_data_watermark, work_item):
+      request = windmill_pb2.WorkItemCommitRequest(
+          key=work_item.key, work_token=work_item.work_token)
+      with lock:
+        commit_sizes[work_item.key, work_item.work_token] = request.ByteSize()
+        if len(commit_sizes) == len(work_items):
+          all_executed.set()
+      return request, FakeStateCache()
+
+    commit_work = windmill.CommitWork
+
+    def delayed_commit_work(request):
+      # Hold the first commit until all the work items were executed, so that
+      # the others are batched.
+      all_executed.wait()
+      commit_work(request)
+
+    worker.process = process
+    windmill.CommitWork = delayed_commit_work
+    max_commit_bytes = 40
+    with mock.patch.object(streamingworker.StreamingWorker, 'MAX_COMMIT_BYTES',
+                           max_commit_bytes):
+      self.run_worker(worker, windmill, len(work_items))
+    self.assertEqual(set(work_items), windmill.committed)
+    self.assertEqual(
+        len(work_items), sum(len(commit) for commit in windmill.commits))
+    self.assertTrue(any(len(commit) > 1 for commit in windmill.commits))
+    for commit in windmill.commits:
+      if len(commit) > 1:
+        self.assertLessEqual(
+            sum(commit_sizes[item] for item in commit), max_commit_bytes)
+
+  def test_stop_commits_executed_work(self):
+    work_items = [('k%d' % (i % 2), i) for i in range(4)]
+    windmill = FakeWindmillClient(work_items)
+    worker = self.create_worker(windmill, num_work_threads=1)
+
+    def process(computation_id, unused_map_task_proto,
+                unused_input_data_watermark, work_item):
+      # Stop while the first work item is being executed.
+      worker.stop()
+      return (windmill_pb2.WorkItemCommitRequest(
+          key=work_item.key, work_token=work_item.work_token),
+              FakeStateCache())
+
+    worker.process = process
+    worker.run()
+    self.assertEqual([[('k0', 0)]], windmill.commits)
+    # Only the bytes of the work items never executed are still in flight.
+    self.assertEqual(
+        sum(windmill_pb2.WorkItem(
+            key=key, work_token=work_token, cache_token=1).ByteSize()
+            for key, work_token in work_items[1:]),
+        worker._in_flight_bytes)  # pylint: disable=protected-access
+
+  def test_work_item_failure_stops_the_worker(self):
+    work_items = [('k%d' % i, i) for i in range(10)]
+    windmill = FakeWindmillClient(work_items)
+    worker = self.create_worker(windmill)
+
+    def process(computation_id, unused_map_task_proto,
+                unused_input_data_watermark, work_item):
+      if work_item.work_token == 5:
+        raise ValueError('Failed work item.')
+      return (windmill_pb2.WorkItemCommitRequest(
+          key=work_item.key, work_token=work_item.work_token),
+              FakeStateCache())
+
+    worker.process = process
+    with self.assertRaisesRegexp(ValueError, 'Failed work item.'):
+      worker.run()
+    self.assertFalse(worker.running)
+    self.assertNotIn(('k5', 5), windmill.committed)
+
+  def test_map_tasks_are_reused_per_thread(self):
+    worker = self.create_worker(FakeWindmillClient([]))
+    decoded = []
+
+    def decode_map_task(map_task_proto, unused_env, unused_context):
+      map_task = mock.Mock(name=map_task_proto)
+      decoded.append(map_task)
+      return map_task
+
+    map_tasks = {}
+
+    def get_map_tasks(name):
+      map_tasks[name] = [
+          worker.get_map_task(computation_id, computation_id + '-proto')[0]
+          for computation_id in ('c1', 'c2', 'c1', 'c2')]
+
+    with mock.patch.object(streamingworker.maptask, 'decode_map_task',
+                           side_effect=decode_map_task):
+      get_map_tasks('main')
+      thread = threading.Thread(target=get_map_tasks, args=('other',))
+      thread.start()
+      thread.join()
+    # Each thread decodes the map task of a computation once.
+    self.assertEqual(4, len(decoded))
+    for name in ('main', 'other'):
+      c1, c2, c1_again, c2_again = map_tasks[name]
+      self.assertIsNot(c1, c2)
+      self.assertIs(c1, c1_again)
+      self.assertIs(c2, c2_again)
+    self.assertIsNot(map_tasks['main'][0], map_tasks['other'][0])
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -18,6 +18,7 @@ Windmill sources and sinks are used internally in streaming pipelines.
 
 from __future__ import absolute_import
 
+import itertools
 import time
 
 from google.cloud.dataflow.io import coders
@@ -27,6 +28,18 @@ from google.cloud.dataflow.transforms.window import GlobalWindows
 from google.cloud.dataflow.transforms.window import WindowedValue
 
 
+def windowed_value_coder(coder):
+  """Returns the coder for windowed values of a KV coder from a Windmill spec.
+
+  The windows are encoded with the window coder of coder if it is a
+  WindowedValueCoder, and pickled otherwise.
+  """
+  window_coder = (coder.window_coder
+                  if isinstance(coder, coders.WindowedValueCoder) else None)
+  return coders.WindowedValueCoder(coder.value_coder(),
+                                   window_coder=window_coder)
+
+
 def harness_to_windmill_timestamp(float_timestamp):
   # The timestamp taken by Windmill is in microseconds.
   return int(float_timestamp * 1000000)
@@ -56,10 +69,11 @@ class PubSubWindmillReader(iobase.SourceReader):
 
   def __iter__(self):
     for bundle in self.source.context.work_item.message_bundles:
-      for message in bundle.messages:
+      values = self.source.coder.get_impl().iter_decode_each(
+          message.data for message in bundle.messages)
+      for message, value in itertools.izip(bundle.messages, values):
         yield GlobalWindows.WindowedValue(
-            self.source.coder.decode(message.data),
-            timestamp=windmill_to_harness_timestamp(message.timestamp))
+            value, timestamp=windmill_to_harness_timestamp(message.timestamp))
 
   def __enter__(self):
     return self
@@ -141,8 +155,7 @@ class WindmillWriter(iobase.NativeSinkWriter):
     self.sink = sink
 
     self.key_coder = self.sink.coder.key_coder()
-    value_coder = self.sink.coder.value_coder()
-    self.wv_coder = coders.WindowedValueCoder(value_coder)
+    self.wv_coder = windowed_value_coder(self.sink.coder)
 
     # Avoid dependency on gRPC during testing.
     # pylint: disable=g-import-not-at-top
@@ -168,6 +181,8 @@ class WindmillWriter(iobase.NativeSinkWriter):
     windows = windowed_kv.windows
     windowed_value = WindowedValue(value, timestamp, windows)
 
+    # Values are encoded as they are written, so that the writer holds no
+    # references to objects which the DoFn may later mutate.
     encoded_key = self.key_coder.encode(key)
     encoded_value = self.wv_coder.encode(windowed_value)
     # TODO(ccy): In the future, we will populate metadata with PaneInfo
@@ -197,14 +212,23 @@ class KeyedWorkItem(object):
     self.work_item = work_item
     self.coder = coder
     self.key_coder = coder.key_coder()
-    value_coder = coder.value_coder()
-    self.wv_coder = coders.WindowedValueCoder(value_coder)
+    self.wv_coder = windowed_value_coder(coder)
     self.key = self.key_coder.decode(work_item.key)
 
   def elements(self):
-    for bundle in self.work_item.message_bundles:
-      for message in bundle.messages:
-        yield self.wv_coder.decode(message.data)
+    return self.wv_coder.get_impl().iter_decode_each(
+        message.data
+        for bundle in self.work_item.message_bundles
+        for message in bundle.messages)
+
+  def timers(self):
+    """Yields a (timer id, timestamp) tuple for each timer fired for the key.
+
+    The timer id is the Windmill tag of the timer, which the state of the work
+    item maps back to the window of the timer.
+    """
+    for timer in self.work_item.timers.timers:
+      yield timer.tag, windmill_to_harness_timestamp(timer.timestamp)
 
   def __repr__(self):
     return 'KeyedWorkItem(%r)' % self.key
@@ -18,10 +18,13 @@ from __future__ import absolute_import
 
 from abc import ABCMeta
 from abc import abstractmethod
+import collections
 import cPickle as pickle
 import logging
+import threading
 
 
+from google.cloud.dataflow.coders import coders
 from google.cloud.dataflow.internal import windmill_pb2
 from google.cloud.dataflow.transforms import trigger
 
@@ -30,6 +33,14 @@ from google.cloud.dataflow.transforms import trigger
 MAX_TIMESTAMP = 0x7fffffffffffffff
 
 
+def to_windmill_timestamp(timestamp):
+  """Converts seconds to Windmill microseconds, clamped to MAX_TIMESTAMP."""
+  # The end of the global window is infinite.
+  if timestamp >= MAX_TIMESTAMP / 1000000:
+    return MAX_TIMESTAMP
+  return int(timestamp * 1000000)
+
+
 class WindmillUnmergedState(trigger.UnmergedState):
   """UnmergedState implementation, backed by Windmill."""
 
@@ -42,16 +53,27 @@ class WindmillUnmergedState(trigger.UnmergedState):
   def get_global_state(self, tag, default=None):
     return self.internals.access('_global_', tag).get() or default
 
+  def add_global_state(self, tag, value):
+    self.internals.access('_global_', tag).add(value)
+
+  def clear_global_state(self, tag):
+    self.internals.access('_global_', tag).clear()
+
   def set_timer(self, window, tag, timestamp):
-    # TODO(ccy): implement this.
-    logging.info('Ignoring set_timer(%s).', (window, tag, timestamp))
+    self.internals.set_timer(self._encode_timer(window, tag), timestamp)
 
   def clear_timer(self, window, tag):
-    # TODO(ccy): implement this.
-    logging.info('Ignoring clear_timer(%s).', (window, tag))
+    self.internals.clear_timer(self._encode_timer(window, tag))
 
   def get_window(self, timer_id):
-    return timer_id
+    # Timer ids are the Windmill tags of fired timers.
+    namespace, _, _ = timer_id.partition('/')
+    return int(namespace)
+
+  def _encode_timer(self, window, tag):
+    # The namespace of a window cannot contain "/", see
+    # WindmillStateInternals.access().
+    return '%s/%s' % (self._encode_window(window), tag)
 
   def _encode_window(self, window):
     # TODO(robertwb): This is only true for merging windows (but we currently
@@ -67,6 +89,10 @@ class WindmillUnmergedState(trigger.UnmergedState):
     namespace = self._encode_window(window)
     return self.internals.access(namespace, tag).get()
 
+  def prefetch_state(self, window, tag):
+    namespace = self._encode_window(window)
+    self.internals.access(namespace, tag).prefetch()
+
   def clear_state(self, window, tag):
     if tag is None:
       # TODO(ccy): either implement this, or if this primitive is not supported
@@ -80,9 +106,16 @@ class WindmillUnmergedState(trigger.UnmergedState):
 class WindmillStateInternals(object):
   """Internal interface to access data in Windmill via state tags."""
 
-  def __init__(self, reader):
+  DEFAULT_CODER = coders.PickleCoder()
+
+  def __init__(self, reader, cache=None):
     self.reader = reader
+    # A WindmillKeyStateCache for the key of the work item, if any.
+    self.cache = cache
     self.accessed = {}
+    # Maps the Windmill tags of the timers set by the work item to their
+    # timestamp, or to None for cleared timers.
+    self.timers = {}
 
   def access(self, namespace, state_tag):
     """Returns accessor for given namespace and state tag."""
@@ -91,27 +124,181 @@ class WindmillStateInternals(object):
     # construction of the state_key below.
     state_key = '%s/%s' % (namespace, state_tag.tag)
     if state_key not in self.accessed:
+      # State is encoded with the coder of its tag, or pickled if it has none.
+      coder = StateCoder(
+          state_tag.coder or WindmillStateInternals.DEFAULT_CODER)
       if isinstance(state_tag, trigger.ListStateTag):
         # List state.
-        self.accessed[state_key] = WindmillBagAccessor(self.reader, state_key)
+        self.accessed[state_key] = WindmillBagAccessor(
+            self.reader, state_key, coder)
       elif isinstance(state_tag, trigger.ValueStateTag):
         # Value state without combiner.
-        self.accessed[state_key] = WindmillValueAccessor(self.reader, state_key)
+        self.accessed[state_key] = WindmillValueAccessor(
+            self.reader, state_key, coder)
       elif isinstance(state_tag, trigger.CombiningValueStateTag):
         # Value state with combiner.
         self.accessed[state_key] = WindmillCombiningValueAccessor(
-            self.reader, state_key, state_tag.combine_fn)
+            self.reader, state_key, state_tag.combine_fn, coder)
       else:
         raise ValueError('Invalid state tag.')
+      if self.cache is not None:
+        cached = self.cache.get(state_key)
+        if cached is not None:
+          self.accessed[state_key].load_cached(cached)
     return self.accessed[state_key]
 
+  def set_timer(self, timer_tag, timestamp):
+    self.timers[timer_tag] = timestamp
+
+  def clear_timer(self, timer_tag):
+    self.timers[timer_tag] = None
+
   def persist_to(self, commit_request):
-    for unused_key, accessor in self.accessed.iteritems():
+    for state_key, accessor in self.accessed.iteritems():
       accessor.persist_to(commit_request)
+      if self.cache is not None:
+        self.cache.stage(state_key, accessor.get_cacheable())
+    for timer_tag, timestamp in self.timers.iteritems():
+      timer = commit_request.output_timers.add(
+          tag=timer_tag,
+          type=windmill_pb2.Timer.WATERMARK,
+          state_family='')
+      # A timer without a timestamp deletes the timer.
+      if timestamp is not None:
+        timer.timestamp = to_windmill_timestamp(timestamp)
+
+
+class WindmillStateCache(object):
+  """A cache of Windmill state shared by all the work items of a worker.
+
+  Entries are keyed by (computation id, key, state key) and evicted in least
+  recently used order once the cached state exceeds max_bytes.  The entries of
+  a key are only valid for a work item with the same cache token as the work
+  item which last committed them, and with a later work token; Windmill
+  assigns a new cache token to a key whenever its state may have been changed
+  by another worker.
+  """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    # Maps (computation_id, key, state_key) to (cached, size) tuples.
+    self._entries = collections.OrderedDict()
+    # Maps (computation_id, key) to the (cache_token, work_token) of the work
+    # item which last committed the key, and to the state keys cached for it.
+    self._tokens = {}
+    self._state_keys = {}
+    self._bytes = 0
+
+  def for_key(self, computation_id, key, cache_token, work_token):
+    """Returns a WindmillKeyStateCache for the given work item."""
+    return WindmillKeyStateCache(
+        self, computation_id, key, cache_token, work_token)
+
+  def get(self, computation_id, key, cache_token, work_token, state_key):
+    """Returns the cached state at the given state key, or None."""
+    with self._lock:
+      tokens = self._tokens.get((computation_id, key))
+      if (not cache_token or tokens is None or tokens[0] != cache_token or
+          tokens[1] >= work_token):
+        return None
+      entry_key = computation_id, key, state_key
+      entry = self._entries.pop(entry_key, None)
+      if entry is None:
+        return None
+      self._entries[entry_key] = entry
+      return entry[0]
+
+  def put(self, computation_id, key, cache_token, work_token, updates):
+    """Updates the cache with the state committed by a work item.
+
+    Args:
+      computation_id: the computation of the work item.
+      key: the key of the work item.
+      cache_token: the cache token of the work item.
+      work_token: the work token of the work item.
+      updates: a dict mapping the state keys accessed by the work item to
+        their committed state, as (cached, size) tuples, or to None if the
+        committed state is not known.
+    """
+    with self._lock:
+      tokens = self._tokens.get((computation_id, key))
+      if tokens is not None and tokens[0] != cache_token:
+        for state_key in list(self._state_keys.get((computation_id, key), ())):
+          self._remove((computation_id, key, state_key))
+      if not cache_token:
+        self._tokens.pop((computation_id, key), None)
+        return
+      self._tokens[computation_id, key] = cache_token, work_token
+      for state_key, entry in updates.iteritems():
+        entry_key = computation_id, key, state_key
+        # The key keeps its tokens even if this was its only cached entry.
+        self._drop_entry(entry_key)
+        if entry is not None:
+          self._entries[entry_key] = entry
+          self._state_keys.setdefault(
+              (computation_id, key), set()).add(state_key)
+          self._bytes += entry[1]
+      while self._bytes > self.max_bytes and self._entries:
+        self._remove(next(iter(self._entries)))
+
+  def _drop_entry(self, entry_key):
+    """Drops a cache entry, returning whether its key has no entries left."""
+    entry = self._entries.pop(entry_key, None)
+    if entry is None:
+      return False
+    self._bytes -= entry[1]
+    computation_id, key, state_key = entry_key
+    state_keys = self._state_keys[computation_id, key]
+    state_keys.discard(state_key)
+    if not state_keys:
+      del self._state_keys[computation_id, key]
+      return True
+    return False
+
+  def _remove(self, entry_key):
+    """Drops a cache entry, and the tokens of its key after the last one."""
+    if self._drop_entry(entry_key):
+      computation_id, key, _ = entry_key
+      self._tokens.pop((computation_id, key), None)
+
+
+class WindmillKeyStateCache(object):
+  """The view of a WindmillStateCache for a single work item.
+
+  Cached state is read through get().  The state committed by the work item is
+  staged as it is persisted, and only added to the cache by commit(), once the
+  work item was committed to Windmill.
+  """
+
+  def __init__(self, cache, computation_id, key, cache_token, work_token):
+    self.cache = cache
+    self.computation_id = computation_id
+    self.key = key
+    self.cache_token = cache_token
+    self.work_token = work_token
+    self.updates = {}
+
+  def get(self, state_key):
+    return self.cache.get(self.computation_id, self.key, self.cache_token,
+                          self.work_token, state_key)
+
+  def stage(self, state_key, cacheable):
+    self.updates[state_key] = cacheable
+
+  def commit(self):
+    self.cache.put(self.computation_id, self.key, self.cache_token,
+                   self.work_token, self.updates)
 
 
 class WindmillStateReader(object):
-  """Reader of raw state from Windmill."""
+  """Reader of raw state from Windmill.
+
+  Reads are batched: state tags may be queued with prefetch_value() and
+  prefetch_list(), and the next read of a tag that was not fetched yet fetches
+  it together with all queued tags in a single GetData request.  Fetched state
+  is kept for the lifetime of the reader, i.e. for a single work item.
+  """
 
   MAX_LIST_BYTES = 8 << 20  # 8MB
 
@@ -121,29 +308,66 @@ class WindmillStateReader(object):
     self.work_token = work_token
     self.windmill = windmill
 
+    self._pending_values = set()
+    self._pending_lists = set()
+    # Fetched values and lists, keyed by state key.
+    self._values = {}
+    self._lists = {}
+
+  def prefetch_value(self, state_key):
+    """Queues the value at given state tag to be fetched with the next read."""
+    if state_key not in self._values:
+      self._pending_values.add(state_key)
+
+  def prefetch_list(self, state_key):
+    """Queues the list at given state tag to be fetched with the next read."""
+    if state_key not in self._lists:
+      self._pending_lists.add(state_key)
+
   def fetch_value(self, state_key):
-    """Get the value at given state tag."""
-    request = windmill_pb2.GetDataRequest()
-    computation_request = windmill_pb2.ComputationGetDataRequest(
-        computation_id=self.computation_id)
-    keyed_request = windmill_pb2.KeyedGetDataRequest(
-        key=self.key,
-        work_token=self.work_token)
-    keyed_request.values_to_fetch.add(
-        tag=state_key,
-        state_family='')
-    computation_request.requests.extend([keyed_request])
-    request.requests.extend([computation_request])
-    return self.windmill.GetData(request)
+    """Get the value at given state tag.
+
+    Returns:
+      The windmill_pb2.Value at the given state tag, or None if Windmill
+      returned no value for it.
+    """
+    if state_key not in self._values:
+      self._pending_values.add(state_key)
+      self._fetch_pending()
+    return self._values[state_key]
 
   def fetch_list(self, state_key):
-    """Get the list at given state tag."""
-    # TODO(ccy): refactor to support continuation tokens for paginated reading.
-    # The current implementation returns up to one page of values from the
-    # list from windmill.
-    request = windmill_pb2.GetDataRequest()
-    computation_request = windmill_pb2.ComputationGetDataRequest(
-        computation_id=self.computation_id)
+    """Get the list at given state tag.
+
+    Only the first page of the list is fetched (and kept) when called; later
+    pages are fetched one at a time, using the continuation token of the
+    previous page, as iteration reaches them.
+
+    Returns:
+      An iterator over the windmill_pb2.Value items of the list at the given
+      state tag.
+    """
+    if state_key not in self._lists:
+      self._pending_lists.add(state_key)
+      self._fetch_pending()
+    values, continuation_token = self._lists[state_key]
+    return self._iter_list(state_key, values, continuation_token)
+
+  def _iter_list(self, state_key, values, continuation_token):
+    while True:
+      for value in values:
+        yield value
+      if not continuation_token:
+        return
+      values, continuation_token = self._fetch_list_page(
+          state_key, continuation_token)
+
+  def _fetch_list_page(self, state_key, request_token):
+    """Fetches the page of a list following the given continuation token.
+
+    Returns:
+      A (values, continuation_token) tuple for the fetched page.
+    """
     keyed_request = windmill_pb2.KeyedGetDataRequest(
         key=self.key,
         work_token=self.work_token)
@@ -151,19 +375,79 @@ class WindmillStateReader(object):
         tag=state_key,
         state_family='',
         end_timestamp=MAX_TIMESTAMP,
+        request_token=request_token,
         fetch_max_bytes=WindmillStateReader.MAX_LIST_BYTES)
+    values, continuation_token = [], ''
+    for datum in self._get_data(keyed_request):
+      for item in datum.lists:
+        values.extend(item.values)
+        continuation_token = item.continuation_token
+    return values, continuation_token
+
+  def _fetch_pending(self):
+    """Fetches all queued state tags in a single GetData request."""
+    keyed_request = windmill_pb2.KeyedGetDataRequest(
+        key=self.key,
+        work_token=self.work_token)
+    for state_key in self._pending_values:
+      keyed_request.values_to_fetch.add(
+          tag=state_key,
+          state_family='')
+      self._values[state_key] = None
+    for state_key in self._pending_lists:
+      keyed_request.lists_to_fetch.add(
+          tag=state_key,
+          state_family='',
+          end_timestamp=MAX_TIMESTAMP,
+          fetch_max_bytes=WindmillStateReader.MAX_LIST_BYTES)
+      self._lists[state_key] = [], ''
+    self._pending_values = set()
+    self._pending_lists = set()
+
+    for datum in self._get_data(keyed_request):
+      for item in datum.values:
+        self._values[item.tag] = item.value
+      for item in datum.lists:
+        values, _ = self._lists[item.tag]
+        values.extend(item.values)
+        self._lists[item.tag] = values, item.continuation_token
+
+  def _get_data(self, keyed_request):
+    """Sends a GetData request for this key.
+
+    Returns:
+      The KeyedGetDataResponse messages of the response.
+    """
+    request = windmill_pb2.GetDataRequest()
+    computation_request = windmill_pb2.ComputationGetDataRequest(
+        computation_id=self.computation_id)
     computation_request.requests.extend([keyed_request])
     request.requests.extend([computation_request])
-    return self.windmill.GetData(request)
+    result = self.windmill.GetData(request)
+    return [datum for wrapper in result.data for datum in wrapper.data]
 
 
-# TODO(ccy): investigate use of coders for Windmill state data.
-def encode_value(value):
-  return pickle.dumps(value)
+class StateCoder(object):
+  """Encodes state with the coder of its tag, and decodes older state too.
 
+  Workers used to pickle all state with cPickle's default text protocol, whose
+  output always starts with a printable opcode. State encoded with the coder
+  of its tag is prefixed with a non-printable version byte instead, so that
+  state pickled by earlier workers is still unpickled when read.
+  """
 
-def decode_value(encoded):
-  return pickle.loads(encoded)
+  VERSION = '\x01'
+
+  def __init__(self, coder):
+    self.coder = coder
+
+  def encode(self, value):
+    return StateCoder.VERSION + self.coder.encode(value)
+
+  def decode(self, encoded):
+    if encoded[:1] == StateCoder.VERSION:
+      return self.coder.decode(encoded[1:])
+    return pickle.loads(encoded)
 
 
 class StateAccessor(object):
@@ -199,6 +483,27 @@ class StateAccessor(object):
     """Clears the state at the bound tag."""
     pass
 
+  def prefetch(self):
+    """Queues the state at the bound tag to be fetched with the next read."""
+    pass
+
+  def load_cached(self, cached):
+    """Initializes the state from a value returned by get_cacheable().
+
+    Accessors whose get_cacheable() returns None cache nothing, so they ignore
+    the value and read the state from Windmill.
+    """
+    pass
+
+  def get_cacheable(self):
+    """Returns the state once persisted, for caching.
+
+    Returns:
+      A (cached, size) tuple, where size is the approximate size of cached in
+      bytes, or None if the persisted state is not known.
+    """
+    return None
+
   @abstractmethod
   def persist_to(self, commit_request):
     """Writes state changes to the given WorkItemCommitRequest message."""
@@ -208,11 +513,14 @@ class StateAccessor(object):
 class WindmillValueAccessor(StateAccessor):
   """Accessor for value state in Windmill."""
 
-  def __init__(self, reader, state_key):
+  def __init__(self, reader, state_key, coder):
     self.reader = reader
     self.state_key = state_key
+    self.coder = coder
 
     self.value = None
+    # The encoded value, once fetched or persisted.
+    self.encoded = None
     self.fetched = False
     self.modified = False
 
@@ -232,169 +540,253 @@ class WindmillValueAccessor(StateAccessor):
     self.modified = True
     self.value = None
 
+  def prefetch(self):
+    if not self.fetched and not self.modified:
+      self.reader.prefetch_value(self.state_key)
+
   def _fetch(self):
     """Fetch state from Windmill."""
-    result = self.reader.fetch_value(self.state_key)
-    for wrapper in result.data:
-      for item in wrapper.data:
-        for value in item.values:
-          if value.value.data == '':  # pylint: disable=g-explicit-bool-comparison
-            # When uninitialized, Windmill returns the empty string as the
-            # initial value.
-            self.value = None
-          else:
-            try:
-              self.value = decode_value(value.value.data)
-            except Exception:  # pylint: disable=broad-except
-              logging.error(
-                  'Error: could not decode value for key %r; '
-                  'setting to None: %r.',
-                  self.state_key, value.value.data)
-              self.value = None
+    value = self.reader.fetch_value(self.state_key)
+    self._load(value.data if value is not None else '')
+
+  def _load(self, encoded):
+    if encoded == '':  # pylint: disable=g-explicit-bool-comparison
+      # When uninitialized, Windmill returns the empty string as the
+      # initial value.
+      self.value = None
+    else:
+      try:
+        self.value = self.coder.decode(encoded)
+      except Exception:  # pylint: disable=broad-except
+        logging.error(
+            'Error: could not decode value for key %r; '
+            'setting to None: %r.',
+            self.state_key, encoded)
+        self.value = None
+    self.encoded = encoded
     self.fetched = True
 
+  def load_cached(self, cached):
+    self._load(cached)
+
+  def get_cacheable(self):
+    if self.encoded is None:
+      return None
+    return self.encoded, len(self.encoded) + len(self.state_key)
+
   def persist_to(self, commit_request):
     if not self.modified:
       return
 
+    if self.value is None:
+      self.encoded = ''
+    else:
+      self.encoded = self.coder.encode(self.value)
     commit_request.value_updates.add(
         tag=self.state_key,
         state_family='',
         value=windmill_pb2.Value(
-            data=encode_value(self.value),
+            data=self.encoded,
             timestamp=MAX_TIMESTAMP))
 
 
 class WindmillCombiningValueAccessor(StateAccessor):
-  """Accessor for combining value state in Windmill."""
+  """Accessor for combining value state in Windmill.
+
+  Accumulators are stored in Windmill as list state, so that adding values is a
+  blind write: added values are combined into a new accumulator which is
+  appended to the list when persisted, without first reading the state.  Reads
+  merge all the stored accumulators with the new one; if more than one
+  accumulator was stored, the merged accumulator replaces them when persisted.
 
-  def __init__(self, reader, state_key, combine_fn):
+  Earlier workers stored the accumulator as value state at the same tag. Reads
+  fetch that value along with the list, and an accumulator found there is
+  merged into the list and cleared when persisted.
+  """
+
+  def __init__(self, reader, state_key, combine_fn, coder):
     self.reader = reader
     self.state_key = state_key
     self.combine_fn = combine_fn
+    self.coder = coder
 
-    self.accum = None
+    self.fetched_accum = None
+    self.new_accum = None
+    # The number of accumulators stored in Windmill, once fetched.
+    self.num_fetched = 0
     self.fetched = False
-    self.modified = False
+    self.compact = False
     self.cleared = False
+    # Whether an accumulator stored as value state was fetched.
+    self.fetched_legacy_accum = False
 
   def get(self):
-    if not self.fetched:
-      self._fetch()
-    if self.cleared:
-      return (
-          self.combine_fn.extract_output(self.combine_fn.create_accumulator()))
-    return self.combine_fn.extract_output(self.accum)
+    accums = []
+    if not self.cleared:
+      if not self.fetched:
+        self._fetch()
+      if self.fetched_accum is not None:
+        accums.append(self.fetched_accum)
+    if self.new_accum is not None:
+      accums.append(self.new_accum)
+    return self.combine_fn.extract_output(self._merge(accums))
 
   def add(self, value):
-    # TODO(ccy): once WindmillStateReader supports asynchronous I/O, we won't
-    # have to do this synchronously, i.e. we can fire off the fetch here and
-    # return, queuing up (possibly eagerly-combined) values to be accumulated
-    # for until we have the response.  We also want to do blind writes, combine
-    # new values in persist, and combine all values in fetch.
-    if not self.fetched:
-      self._fetch()
-    if self.cleared:
-      self.accum = self.combine_fn.create_accumulator()
-      self.cleared = False
-
-    self.modified = True
-    self.accum = self.combine_fn.add_inputs(self.accum, [value])
+    if self.new_accum is None:
+      self.new_accum = self.combine_fn.create_accumulator()
+    self.new_accum = self.combine_fn.add_inputs(self.new_accum, [value])
 
   def clear(self):
-    self.modified = True
     self.cleared = True
+    self.fetched_accum = None
+    self.new_accum = None
+
+  def prefetch(self):
+    if not self.fetched and not self.cleared:
+      self.reader.prefetch_list(self.state_key)
+      self.reader.prefetch_value(self.state_key)
+
+  def _merge(self, accums):
+    if not accums:
+      return self.combine_fn.create_accumulator()
+    elif len(accums) == 1:
+      return accums[0]
+    return self.combine_fn.merge_accumulators(accums)
 
   def _fetch(self):
     """Fetch state from Windmill."""
-    result = self.reader.fetch_value(self.state_key)
-    for wrapper in result.data:
-      for item in wrapper.data:
-        for value in item.values:
-          if value.value.data == '':  # pylint: disable=g-explicit-bool-comparison
-            # When uninitialized, Windmill returns the empty string as the
-            # initial value.
-            self.accum = self.combine_fn.create_accumulator()
-          else:
-            try:
-              self.accum = decode_value(value.value.data)
-            except Exception:  # pylint: disable=broad-except
-              logging.error(
-                  'Error: could not decode value; resetting accumulator: %r.',
-                  value.value.data)
-              self.accum = self.combine_fn.create_accumulator()
+    self.prefetch()
+    encoded_accums = [
+        value.data for value in self.reader.fetch_list(self.state_key)]
+    legacy_value = self.reader.fetch_value(self.state_key)
+    if legacy_value is not None and legacy_value.data:
+      encoded_accums.append(legacy_value.data)
+      self.fetched_legacy_accum = True
+    accums = []
+    for encoded_accum in encoded_accums:
+      try:
+        accums.append(self.coder.decode(encoded_accum))
+      except Exception:  # pylint: disable=broad-except
+        logging.error(
+            'Error: could not decode accumulator for key %r; ignoring it: %r.',
+            self.state_key, encoded_accum)
+    if accums:
+      self.fetched_accum = self._merge(accums)
+    self.num_fetched = len(accums)
+    self.compact = len(accums) > 1 or self.fetched_legacy_accum
     self.fetched = True
 
+  def load_cached(self, cached):
+    encoded_accum, self.num_fetched = cached
+    if encoded_accum:
+      self.fetched_accum = self.coder.decode(encoded_accum)
+    self.compact = self.num_fetched > 1
+    self.fetched = True
+
+  def get_cacheable(self):
+    if not self.fetched and not self.cleared:
+      return None
+    accums = []
+    if not self.cleared and self.fetched_accum is not None:
+      accums.append(self.fetched_accum)
+    if self.new_accum is not None:
+      accums.append(self.new_accum)
+    if self.cleared or self.compact:
+      num_stored = min(len(accums), 1)
+    else:
+      num_stored = self.num_fetched + (self.new_accum is not None)
+    encoded_accum = self.coder.encode(self._merge(accums)) if accums else ''
+    return ((encoded_accum, num_stored),
+            len(encoded_accum) + len(self.state_key))
+
   def persist_to(self, commit_request):
-    if not self.modified:
+    if self.cleared or self.fetched_legacy_accum:
+      # Clear the accumulator stored as value state, if any.
+      commit_request.value_updates.add(
+          tag=self.state_key,
+          state_family='',
+          value=windmill_pb2.Value(data='', timestamp=MAX_TIMESTAMP))
+    accums = []
+    if self.cleared or self.compact:
+      # Replace the stored accumulators.
+      commit_request.list_updates.add(
+          tag=self.state_key,
+          state_family='',
+          end_timestamp=MAX_TIMESTAMP)
+      if self.fetched_accum is not None:
+        accums.append(self.fetched_accum)
+    if self.new_accum is not None:
+      accums.append(self.new_accum)
+    if not accums:
       return
 
-    if self.cleared:
-      encoded_value = ''
-    else:
-      encoded_value = encode_value(self.accum)
-    commit_request.value_updates.add(
+    list_updates = commit_request.list_updates.add(
         tag=self.state_key,
-        state_family='',
-        value=windmill_pb2.Value(
-            data=encoded_value,
-            timestamp=MAX_TIMESTAMP))
+        state_family='')
+    list_updates.values.add(
+        data=self.coder.encode(self._merge(accums)),
+        timestamp=MAX_TIMESTAMP)
 
 
 class WindmillBagAccessor(StateAccessor):
   """Accessor for list state in Windmill."""
 
   class WindmillBagIterable(object):
+    """The contents of the bag at the time it was read.
 
-    def __init__(self, accessor):
+    Values are fetched from Windmill and decoded page by page on each
+    iteration, so the bag never needs to be held in memory as a whole.
+    """
+
+    def __init__(self, accessor, cleared, encoded_new_values):
       self.accessor = accessor
+      self.cleared = cleared
+      # clear() replaces the list of new values, and add() only appends to
+      # it, so a prefix of the current list is a snapshot of the new values.
+      self.encoded_new_values = encoded_new_values
+      self.num_new_values = len(encoded_new_values)
 
     def __iter__(self):
-      return self.accessor._get_iter()  # pylint: disable=protected-access
+      if not self.cleared:
+        for value in self.accessor._fetch():  # pylint: disable=protected-access
+          yield value
+      for i in xrange(self.num_new_values):
+        yield self.accessor.coder.decode(self.encoded_new_values[i])
 
-  def __init__(self, reader, state_key):
+  def __init__(self, reader, state_key, coder):
     self.reader = reader
     self.state_key = state_key
+    self.coder = coder
 
     self.cleared = False
     self.encoded_new_values = []
 
+  def prefetch(self):
+    if not self.cleared:
+      self.reader.prefetch_list(self.state_key)
+
   def get(self):
     # Don't directly iterate here; we want to return an iterable object so that
     # the user may restart iteration if desired.
-    return WindmillBagAccessor.WindmillBagIterable(self)
-
-  def _get_iter(self):
-    if not self.cleared:
-      pass
-    # Fetch values from Windmill, followed by values added in this sesison.
-    for value in self._fetch():
-      yield value
-    for value in self.encoded_new_values:
-      yield decode_value(value)
+    return WindmillBagAccessor.WindmillBagIterable(
+        self, self.cleared, self.encoded_new_values)
 
   def _fetch(self):
-    """Fetch state from Windmill."""
-    # TODO(ccy): currently, we only look at the first page of the result
-    # since we do not support pagination.  We should support pagination.
-    # TODO(ccy): the Java SDK caches the first page and at the start of each
-    # page of values, fires off an asynchronous read for the next page.  We
-    # should do this too once we have asynchronous Windmill state reading.
-    result = self.reader.fetch_list(self.state_key)
-    for wrapper in result.data:
-      for datum in wrapper.data:
-        for item in datum.lists:
-          for value in item.values:
-            try:
-              yield decode_value(value.data)
-            except Exception:  # pylint: disable=broad-except
-              logging.error('Could not decode value: %r.', value.data)
-              yield None
+    """Fetch state from Windmill, decoding it page by page."""
+    # TODO(ccy): the Java SDK fires off an asynchronous read for the next page
+    # at the start of each page of values.  We should do this too once we
+    # have asynchronous Windmill state reading.
+    for value in self.reader.fetch_list(self.state_key):
+      try:
+        yield self.coder.decode(value.data)
+      except Exception:  # pylint: disable=broad-except
+        logging.error('Could not decode value: %r.', value.data)
+        yield None
 
   def add(self, value):
     # Encode the value here to ensure further mutations of the value don't
     # affect the value eventually committed to Windmill.
-    self.encoded_new_values.append(encode_value(value))
+    self.encoded_new_values.append(self.coder.encode(value))
 
   def clear(self):
     self.cleared = True
@@ -0,0 +1,190 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for Windmill state."""
+
+import cPickle as pickle
+import logging
+import unittest
+
+from google.cloud.dataflow.coders import coders
+from google.cloud.dataflow.internal import windmill_pb2
+from google.cloud.dataflow.transforms import combiners
+from google.cloud.dataflow.transforms import trigger
+from google.cloud.dataflow.worker import windmillstate
+
+
+class WindmillStateCacheTest(unittest.TestCase):
+
+  def commit(self, cache, key, cache_token, work_token, updates):
+    key_cache = cache.for_key('comp', key, cache_token, work_token)
+    for state_key, cacheable in updates.iteritems():
+      key_cache.stage(state_key, cacheable)
+    key_cache.commit()
+
+  def get(self, cache, key, cache_token, work_token, state_key):
+    return cache.for_key('comp', key, cache_token, work_token).get(state_key)
+
+  def test_hits_across_commits(self):
+    cache = windmillstate.WindmillStateCache(1000)
+    for work_token in range(1, 7):
+      self.commit(cache, 'k', 'c1', work_token, {'tag': (work_token, 10)})
+      self.assertEqual(
+          work_token, self.get(cache, 'k', 'c1', work_token + 1, 'tag'))
+
+  def test_token_validation(self):
+    cache = windmillstate.WindmillStateCache(1000)
+    self.commit(cache, 'k', 'c1', 5, {'tag': ('v', 10)})
+    self.assertEqual('v', self.get(cache, 'k', 'c1', 6, 'tag'))
+    # Stale or replayed work items, and other cache tokens, miss.
+    self.assertIsNone(self.get(cache, 'k', 'c1', 5, 'tag'))
+    self.assertIsNone(self.get(cache, 'k', 'c1', 4, 'tag'))
+    self.assertIsNone(self.get(cache, 'k', 'c2', 6, 'tag'))
+    self.assertIsNone(self.get(cache, 'k', None, 6, 'tag'))
+    self.assertIsNone(self.get(cache, 'other', 'c1', 6, 'tag'))
+
+  def test_unknown_committed_state_is_dropped(self):
+    cache = windmillstate.WindmillStateCache(1000)
+    self.commit(cache, 'k', 'c1', 1, {'a': ('a', 10), 'b': ('b', 10)})
+    self.commit(cache, 'k', 'c1', 2, {'a': None})
+    self.assertIsNone(self.get(cache, 'k', 'c1', 3, 'a'))
+    self.assertEqual('b', self.get(cache, 'k', 'c1', 3, 'b'))
+
+  def test_cache_token_change(self):
+    cache = windmillstate.WindmillStateCache(1000)
+    self.commit(cache, 'k', 'c1', 1, {'a': ('a', 10), 'b': ('b', 10)})
+    self.commit(cache, 'k', 'c2', 2, {'a': ('new a', 10)})
+    self.assertEqual('new a', self.get(cache, 'k', 'c2', 3, 'a'))
+    # State cached under the old cache token is gone.
+    self.assertIsNone(self.get(cache, 'k', 'c2', 3, 'b'))
+    self.assertIsNone(self.get(cache, 'k', 'c1', 3, 'a'))
+    # A work item without a cache token invalidates the key.
+    self.commit(cache, 'k', None, 4, {'a': ('a', 10)})
+    self.assertIsNone(self.get(cache, 'k', 'c2', 5, 'a'))
+
+  def test_bytes_bounded_eviction(self):
+    cache = windmillstate.WindmillStateCache(25)
+    self.commit(cache, 'k1', 'c', 1, {'tag': ('v1', 10)})
+    self.commit(cache, 'k2', 'c', 1, {'tag': ('v2', 10)})
+    # Reading k1 makes k2 the least recently used entry.
+    self.assertEqual('v1', self.get(cache, 'k1', 'c', 2, 'tag'))
+    self.commit(cache, 'k3', 'c', 1, {'tag': ('v3', 10)})
+    self.assertIsNone(self.get(cache, 'k2', 'c', 2, 'tag'))
+    self.assertEqual('v1', self.get(cache, 'k1', 'c', 2, 'tag'))
+    self.assertEqual('v3', self.get(cache, 'k3', 'c', 2, 'tag'))
+    # Replacing an entry accounts for its new size.
+    self.commit(cache, 'k1', 'c', 2, {'tag': ('big', 20)})
+    self.assertEqual('big', self.get(cache, 'k1', 'c', 3, 'tag'))
+    self.assertIsNone(self.get(cache, 'k3', 'c', 2, 'tag'))
+
+
+class StateCoderTest(unittest.TestCase):
+
+  def test_round_trip(self):
+    coder = windmillstate.StateCoder(coders.VarIntCoder())
+    for value in (0, 5, 1 << 40):
+      encoded = coder.encode(value)
+      self.assertEqual(
+          windmillstate.StateCoder.VERSION + coders.VarIntCoder().encode(value),
+          encoded)
+      self.assertEqual(value, coder.decode(encoded))
+
+  def test_decodes_pickled_state(self):
+    coder = windmillstate.StateCoder(coders.VarIntCoder())
+    for value in (0, 5, 1 << 40, {'1': 2}):
+      self.assertEqual(value, coder.decode(pickle.dumps(value)))
+
+
+class FakeStateReader(object):
+  """A fake WindmillStateReader serving fixed values and lists."""
+
+  def __init__(self, values=None, lists=None):
+    self.values = values or {}
+    self.lists = lists or {}
+
+  def prefetch_value(self, state_key):
+    pass
+
+  def prefetch_list(self, state_key):
+    pass
+
+  def fetch_value(self, state_key):
+    if state_key in self.values:
+      return windmill_pb2.Value(data=self.values[state_key])
+
+  def fetch_list(self, state_key):
+    return iter([windmill_pb2.Value(data=data)
+                 for data in self.lists.get(state_key, [])])
+
+
+class WindmillCombiningValueAccessorTest(unittest.TestCase):
+
+  def create_accessor(self, reader):
+    combine_fn = combiners.CountCombineFn()
+    return windmillstate.WindmillCombiningValueAccessor(
+        reader, 'tag', combine_fn,
+        windmillstate.StateCoder(combine_fn.get_accumulator_coder()))
+
+  def test_reads_accumulator_stored_as_value(self):
+    coder = windmillstate.StateCoder(coders.VarIntCoder())
+    accessor = self.create_accessor(FakeStateReader(
+        values={'tag': pickle.dumps(5)}, lists={'tag': [coder.encode(2)]}))
+    accessor.add('x')
+    self.assertEqual(8, accessor.get())
+    commit_request = windmill_pb2.WorkItemCommitRequest()
+    accessor.persist_to(commit_request)
+    # The value is cleared and the merged accumulator replaces the list.
+    self.assertEqual(
+        [('tag', '')],
+        [(update.tag, update.value.data)
+         for update in commit_request.value_updates])
+    self.assertEqual(
+        [[], [coder.encode(8)]],
+        [[value.data for value in update.values]
+         for update in commit_request.list_updates])
+
+  def test_without_accumulator_stored_as_value(self):
+    coder = windmillstate.StateCoder(coders.VarIntCoder())
+    accessor = self.create_accessor(FakeStateReader(
+        lists={'tag': [coder.encode(2)]}))
+    accessor.add('x')
+    self.assertEqual(3, accessor.get())
+    commit_request = windmill_pb2.WorkItemCommitRequest()
+    accessor.persist_to(commit_request)
+    self.assertFalse(commit_request.value_updates)
+    self.assertEqual(
+        [[coder.encode(1)]],
+        [[value.data for value in update.values]
+         for update in commit_request.list_updates])
+
+
+class WindmillStateInternalsTest(unittest.TestCase):
+
+  def test_cached_bag_is_read_from_windmill(self):
+    coder = windmillstate.StateCoder(coders.VarIntCoder())
+    cache = windmillstate.WindmillStateCache(1000)
+    key_cache = cache.for_key('comp', 'k', 'c1', 1)
+    key_cache.stage('w/bag', ([5], 10))
+    key_cache.commit()
+    internals = windmillstate.WindmillStateInternals(
+        FakeStateReader(lists={'w/bag': [coder.encode(1), coder.encode(2)]}),
+        cache=cache.for_key('comp', 'k', 'c1', 2))
+    accessor = internals.access(
+        'w', trigger.ListStateTag('bag', coders.VarIntCoder()))
+    self.assertEqual([1, 2], list(accessor.get()))
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()